@@ -0,0 +1,310 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Bounded-memory streaming of the stimuli of a run.
+
+preload.load_assets keeps every stimulus of a run loaded until its end, so
+that memory grows with the length of the run. With --stream-assets,
+AssetWindow only keeps the stimuli of the events of the next `lookahead` ms,
+within a memory budget:
+
+- a background thread reads and decodes the files of the upcoming events,
+  as long as the budget allows it;
+- between two events (from the poll function of the scheduler), the main
+  thread, the only one allowed to touch the display, creates the stimuli of
+  the decoded files and frees those that will not be presented again or,
+  when the decoder waits for memory, the least recently used ones that are
+  not needed in the window.
+
+The presentation loop indexes the window like the list of the stimuli of the
+events, at their onsets. A stimulus which is not ready then is loaded on the
+spot, delaying the event: such deadline misses are reported, together with
+the peak memory usage, at the end of the run.
+"""
+
+import os.path as op
+import sys
+import time
+import threading
+from collections import OrderedDict
+
+import timeline
+import preload
+import stimpack
+
+
+MB = 1024 * 1024
+
+
+def peak_rss():
+    """ peak resident memory of the process in bytes (None if unknown) """
+    try:
+        import resource
+    except ImportError:   # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def payload_size(kind, path, payload):
+    """ memory used by a decoded file, in bytes """
+    if kind == 'sound':
+        import pygame
+        init = pygame.mixer.get_init()
+        if init is not None:
+            frequency, size, channels = init
+            return int(payload.get_length() * frequency * channels * abs(size) // 8)
+    elif kind == 'picture':
+        return payload.get_width() * payload.get_height() * payload.get_bytesize()
+    return op.getsize(path)
+
+
+def stimulus_size(stim):
+    width, height = stim.surface_size
+    return 4 * width * height
+
+
+class AssetWindow:
+    """ Stimuli of the events of a run, loaded `lookahead` ms ahead.
+
+    schedule: timeline.Schedule of the run
+    bp: directory of the stimuli files
+    make_text: function returning the preloaded stimulus of a text
+    tables: dict kind -> {id: stimulus} of the stimuli loaded beforehand
+            (e.g. the shared 'blank' and 'fs'), which are not streamed
+    budget: memory allowed for the decoded stimuli, in bytes
+    lookahead: duration of the window, in ms
+    margin: no stimulus is created less than `margin` ms before an onset
+    """
+
+    def __init__(self, schedule, bp, make_text, tables, budget,
+                 lookahead=10000, margin=20):
+        self.schedule = schedule
+        self.bp = bp
+        self.make_text = make_text
+        self.tables = tables
+        self.budget = budget
+        self.lookahead = lookahead
+        self.margin = margin
+        self.clock = None   # run clock, set before the presentation
+
+        self._keys = [(kind, id) if kind in timeline.ASSET_KINDS and kind not in tables else None
+                      for kind, id in zip(schedule.kinds, schedule.ids)]
+        self._last_use = dict()
+        for i, key in enumerate(self._keys):
+            if key is not None:
+                self._last_use[key] = i
+
+        self._loaded = OrderedDict()   # key -> (stimulus, size), least recently used first
+        self._decoded = dict()         # key -> (payload, size), decoded by the thread
+        self._decoding = set()         # keys being decoded or attached
+        self._draining = dict()        # key -> time until which a sound plays
+        self._sounds = dict()          # key -> duration of a sound in ms
+        self._wanted = 0               # bytes the thread waits for
+        self._cursor = 0               # next event to present
+        self._released = 0             # _cursor at the last release
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._decoder, daemon=True)
+
+        self.used = 0          # bytes of the loaded and decoded stimuli
+        self.peak = 0
+        self.decodes = 0
+        self.redecodes = 0
+        self.evictions = 0
+        self.misses = []       # (event index, ms spent loading its stimulus)
+        self._seen = set()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, i):
+        """ stimulus of event i, called by the loop at its onset (the stimuli
+        which are no longer needed are freed later, by service()) """
+        self._cursor = i + 1
+        key = self._keys[i]
+        if key is None:
+            return self.tables[self.schedule.kinds[i]][self.schedule.ids[i]]
+        entry = self._loaded.get(key)
+        if entry is None:
+            start = time.perf_counter()
+            self._attach(key, self._take(key))
+            entry = self._loaded[key]
+            self.misses.append((i, 1000 * (time.perf_counter() - start)))
+        self._loaded.move_to_end(key)
+        if key in self._sounds and self.clock is not None:
+            self._draining[key] = self.schedule.onsets[i] + self._sounds[key]
+        return entry[0]
+
+    def _window(self):
+        """ asset keys of the events of the next `lookahead` ms (at least the
+        next event), in order """
+        onsets, keys = self.schedule.onsets, self._keys
+        start = self._cursor
+        if start >= len(keys):
+            return
+        now = self.clock.now() if self.clock is not None else 0
+        end = max(onsets[start], now + self.lookahead)
+        for j in range(start, len(keys)):
+            if onsets[j] > end:
+                return
+            if keys[j] is not None:
+                yield keys[j]
+
+    # --- decoding thread
+    def _decoder(self):
+        while True:
+            with self._cond:
+                key = None
+                while not self._stop:
+                    key = self._next_to_decode()
+                    if key is not None:
+                        path = op.join(self.bp, key[1])
+                        estimate = stimpack.size(path)
+                        if self.used + estimate <= self.budget or self.used == 0:
+                            self._wanted = 0
+                            self._decoding.add(key)
+                            break
+                        self._wanted = estimate
+                    self._cond.wait(0.05)
+                if self._stop:
+                    return
+            payload, _ = preload.decode(key[0], path)
+            size = payload_size(key[0], path, payload)
+            with self._cond:
+                self._decoded[key] = (payload, size)
+                self._decoding.discard(key)
+                self._count(key, size)
+                self._cond.notify_all()
+
+    def _next_to_decode(self):
+        for key in self._window():
+            if (key[0] != 'text' and key not in self._loaded
+                    and key not in self._decoded and key not in self._decoding):
+                return key
+        return None
+
+    def _count(self, key, size):
+        self.used += size
+        self.peak = max(self.peak, self.used)
+        self.decodes += 1
+        if key in self._seen:
+            self.redecodes += 1
+        self._seen.add(key)
+
+    # --- main thread
+    def _take(self, key):
+        """ returns the decoded payload of `key`, decoding it now if needed """
+        if key[0] == 'text':
+            return None
+        with self._cond:
+            while key in self._decoding:
+                self._cond.wait()
+            self._decoding.add(key)   # until attached
+            if key in self._decoded:
+                return self._decoded.pop(key)
+        path = op.join(self.bp, key[1])
+        payload, _ = preload.decode(key[0], path)
+        size = payload_size(key[0], path, payload)
+        with self._cond:
+            self._count(key, size)
+        return payload, size
+
+    def _attach(self, key, decoded):
+        kind, id = key
+        if kind == 'text':
+            stim = self.make_text(id)
+            size = stimulus_size(stim)
+            with self._cond:
+                self._count(key, size)
+        else:
+            payload, size = decoded
+            stim = preload.attach(kind, op.join(self.bp, id), payload)
+            if kind == 'sound':
+                self._sounds[key] = 1000 * payload.get_length()
+        with self._cond:
+            self._loaded[key] = (stim, size)
+            self._decoding.discard(key)
+
+    def _free(self, key):
+        self._draining.pop(key, None)
+        with self._cond:
+            _, size = self._loaded.pop(key)
+            self.used -= size
+            self._cond.notify_all()
+
+    def _release(self, i):
+        """ frees the stimuli that will not be presented again """
+        now = self.clock.now() if self.clock is not None else None
+        for key in [k for k in self._loaded if self._last_use[k] < i]:
+            until = self._draining.get(key)
+            if until is None or (now is not None and now > until):
+                self._free(key)
+
+    def _evict(self):
+        """ frees least recently used stimuli until the thread can decode the next file """
+        needed = set(self._window())
+        now = self.clock.now() if self.clock is not None else None
+        for key in list(self._loaded):
+            if self.used + self._wanted <= self.budget:
+                return
+            until = self._draining.get(key)
+            if key in needed or (until is not None and (now is None or now <= until)):
+                continue
+            self._free(key)
+            self.evictions += 1
+
+    def service(self):
+        """ creates the stimuli of the window and frees memory; to be called between events """
+        onsets = self.schedule.onsets
+        deadline = onsets[self._cursor] - self.margin if self._cursor < len(onsets) else None
+        if self.clock is not None and deadline is not None and self.clock.now() > deadline:
+            return
+        if self._released < self._cursor or self._draining:
+            # the stimuli used before the last event presented
+            self._release(self._cursor - 1)
+            self._released = self._cursor
+        if self._wanted:
+            self._evict()
+        for key in self._window():
+            if key in self._loaded:
+                continue
+            if self.clock is not None and deadline is not None and self.clock.now() > deadline:
+                return
+            if key[0] == 'text':
+                self._attach(key, None)
+            else:
+                with self._cond:
+                    decoded = self._decoded.pop(key, None)
+                    if decoded is not None:
+                        self._decoding.add(key)   # until attached
+                if decoded is not None:
+                    self._attach(key, decoded)
+
+    def prime(self):
+        """ starts the thread and waits until the first window is loaded """
+        self._thread.start()
+        while True:
+            self.service()
+            with self._cond:
+                blocked = self._wanted > 0
+            if blocked or all(key in self._loaded for key in self._window()):
+                return
+            time.sleep(0.005)
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def report(self):
+        rss = peak_rss()
+        print(f"asset window: peak {self.peak / MB:.1f} MB for a budget of "
+              f"{self.budget / MB:.0f} MB, {self.decodes} stimuli loaded "
+              f"({self.redecodes} again after eviction), {self.evictions} evictions, "
+              f"{len(self.misses)} deadline misses"
+              + (f", peak RSS {rss / MB:.1f} MB" if rss is not None else ""))
+        for i, duration in self.misses:
+            print(f"  deadline miss: event {i} ({self.schedule.stypes[i]} "
+                  f"{self.schedule.ids[i]}) not ready, loaded in {duration:.1f} ms")
@@ -0,0 +1,294 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Low-latency playback of the sounds of a run, and measure of the audio latency.
+
+stimuli.Audio.present() hands the sound to the pygame mixer, whose buffer
+(and that of the system) delay its actual output by an unknown amount. With
+`--audio-engine pcm`, the wav files of a run are instead read (with the wave
+module) into one contiguous, preallocated PCM buffer, and played through a
+PortAudio output stream with small blocks (sounddevice, an optional
+dependency: `pip install sounddevice`). present() only points the callback of
+the stream at the slice of the sound, which starts in the next block. The
+callback also gets the time at which that block reaches the DAC, i.e. the
+output latency of every sound, which is reported at the end of the run.
+
+The sounds must all have the sample rate, width and channels of the first
+one. One sound plays at a time: a new one interrupts the previous one, which
+never happens in the runs of the localizer.
+
+`--cali` measures the latency of the audio path of the machine: clicks are
+played and recorded back through a loopback cable from the output to the
+input given by `--loopback-device`; without it, the time at which the
+stream reports the clicks reach the DAC stands in for the recording. The
+latency is stored in LATENCY_FILE, keyed by host name, and the schedulers
+start the sounds that much ahead of their onsets.
+"""
+
+import os
+import os.path as op
+import json
+import time
+import wave
+import socket
+import datetime
+import threading
+from array import array
+
+import stimpack
+
+
+LATENCY_FILE = op.join('calibration', 'audio_latency.json')
+ENGINES = ('expyriment', 'pcm')
+
+
+def available():
+    """ whether the pcm engine can be used """
+    try:
+        import sounddevice
+    except (ImportError, OSError):   # OSError: PortAudio library not found
+        return False
+    return True
+
+
+class PcmBank:
+    """ PCM data of sounds sharing a format, stored in one buffer
+
+    slices: dict key -> (offset, length) in bytes
+    """
+
+    def __init__(self, rate, channels, width, chunks):
+        self.rate, self.channels, self.width = rate, channels, width
+        self.data = bytearray(sum(len(pcm) for _, pcm in chunks))
+        self.slices = dict()
+        view = memoryview(self.data)
+        offset = 0
+        for key, pcm in chunks:
+            view[offset:offset + len(pcm)] = pcm
+            self.slices[key] = (offset, len(pcm))
+            offset += len(pcm)
+
+    @classmethod
+    def from_files(cls, paths):
+        """ reads wav files, or takes them from the stimuli archive of their
+        directory (see stimpack.py); the keys of the slices are their paths """
+        fmt = None
+        chunks = []
+        packed = [stimpack.find(path) for path in paths]
+        for path, found in zip(paths, packed):
+            if found is not None:
+                entry = found[0].index[found[1]]
+                params = (entry['rate'], entry['channels'], entry['width'])
+                pcm = found[0].view(found[1])
+            else:
+                with wave.open(path, 'rb') as w:
+                    params = (w.getframerate(), w.getnchannels(), w.getsampwidth())
+                    pcm = w.readframes(w.getnframes())
+            if fmt is None:
+                fmt = params
+            elif params != fmt:
+                raise ValueError(f"{path}: format {params} differs from {fmt} "
+                                 "(rate, channels, width) of the other sounds")
+            chunks.append((path, pcm))
+
+        packs = {id(found[0]): found[0] for found in packed if found is not None}
+        if paths and all(packed) and len(packs) == 1:
+            # all in one archive: play them from its mapping, without copy
+            bank = cls(*fmt, [])
+            pack = packs.popitem()[1]
+            bank.data = pack.data()
+            bank.slices = {path: (pack.offset(name), pack.index[name]['length'])
+                           for path, (_, name) in zip(paths, packed)}
+            return bank
+        return cls(*(fmt or (44100, 1, 2)), chunks)
+
+
+def click(rate, duration=5.0, silence=100.0):
+    """ 16-bit mono pcm of a full-scale square click followed by silence """
+    half_period = max(1, rate // 2000)   # 1 kHz
+    samples = array('h', [32767 if (i // half_period) % 2 == 0 else -32767
+                          for i in range(int(rate * duration / 1000))])
+    samples.extend([0] * int(rate * silence / 1000))
+    return samples.tobytes()
+
+
+class PcmOutput:
+    """ Output stream playing slices of a PcmBank
+
+    blocksize: frames per block (the smaller, the lower the latency)
+    device: PortAudio output device (None for the default one)
+    """
+
+    DTYPES = {1: 'int8', 2: 'int16', 3: 'int24', 4: 'int32'}
+
+    def __init__(self, bank, blocksize=128, device=None):
+        import sounddevice
+        self.bank = bank
+        self._data = memoryview(bank.data)
+        self._frame = bank.channels * bank.width
+        self._silence = bytes(blocksize * self._frame)
+        self._voice = None     # [position, end] of the sound playing
+        self._pending = None   # (position, end, perf_counter time of the call)
+        self._lock = threading.Lock()   # _pending is handed over to the thread of the callback
+        self.starts = []       # (perf_counter time of the call, of the output)
+        self._stream = sounddevice.RawOutputStream(
+            samplerate=bank.rate, blocksize=blocksize, channels=bank.channels,
+            dtype=self.DTYPES[bank.width], latency='low', device=device,
+            callback=self._callback)
+        self._stream.start()
+        # perf_counter() - stream time, to convert the times of the callback
+        self._offset = time.perf_counter() - self._stream.time
+
+    def _callback(self, outdata, frames, times, status):
+        with self._lock:
+            pending, self._pending = self._pending, None
+            if pending is not None:
+                self._voice = [pending[0], pending[1]]
+        if pending is not None:
+            self.starts.append((pending[2], times.outputBufferDacTime + self._offset))
+        n = frames * self._frame
+        voice = self._voice
+        if voice is None:
+            outdata[:n] = self._silence[:n]
+            return
+        position, end = voice
+        k = min(n, end - position)
+        outdata[:k] = self._data[position:position + k]
+        if k < n:
+            outdata[k:n] = self._silence[:n - k]
+            self._voice = None
+        else:
+            voice[0] = position + k
+
+    def play(self, key):
+        offset, length = self.bank.slices[key]
+        with self._lock:
+            self._pending = (offset, offset + length, time.perf_counter())
+
+    def playing(self):
+        with self._lock:
+            return self._voice is not None or self._pending is not None
+
+    def latencies(self):
+        """ delays (ms) between the calls of play() and the output of the sounds """
+        return [1000 * (dac - call) for call, dac in self.starts]
+
+    def report(self):
+        latencies = self.latencies()
+        if latencies:
+            print(f"audio output: {len(latencies)} sounds, latency "
+                  f"{sum(latencies) / len(latencies):.2f} ms "
+                  f"(min {min(latencies):.2f}, max {max(latencies):.2f})")
+
+    def close(self):
+        self._stream.stop()
+        self._stream.close()
+
+
+class PcmSound:
+    """ Sound of a PcmOutput, with the interface of stimuli.Audio """
+
+    def __init__(self, output, key):
+        self.output = output
+        self.key = key
+
+    def preload(self):
+        pass
+
+    def present(self):
+        start = time.perf_counter()
+        self.output.play(self.key)
+        return 1000 * (time.perf_counter() - start)
+
+    play = present
+
+
+def load_sounds(bp, ids, blocksize=128, device=None):
+    """ loads the sounds of a run into a PcmOutput; returns it and a dict id -> PcmSound """
+    paths = [op.join(bp, id) for id in ids]
+    output = PcmOutput(PcmBank.from_files(paths), blocksize, device)
+    return output, {id: PcmSound(output, path) for id, path in zip(ids, paths)}
+
+
+def measure_latency(blocksize=128, device=None, loopback=None, n=20, rate=22050, interval=0.3):
+    """ measures the latency (ms) of the pcm engine; returns (latencies, method)
+
+    loopback: input device recording the output (None to rely on the times
+    reported by the output stream)
+    """
+    bank = PcmBank(rate, 1, 2, [('click', click(rate))])
+    output = PcmOutput(bank, blocksize, device)
+    recording = []
+    stream = None
+    if loopback is not None:
+        import sounddevice
+        offset = []
+
+        def record(indata, frames, times, status):
+            recording.append((times.inputBufferAdcTime + offset[0], bytes(indata)))
+
+        stream = sounddevice.RawInputStream(samplerate=rate, channels=1, dtype='int16',
+                                            blocksize=blocksize, latency='low',
+                                            device=loopback, callback=record)
+        offset.append(time.perf_counter() - stream.time)
+        stream.start()
+    time.sleep(interval)
+    for _ in range(n):
+        output.play('click')
+        time.sleep(interval)
+    if stream is not None:
+        stream.stop()
+        stream.close()
+    output.close()
+
+    if loopback is None:
+        return output.latencies(), 'stream'
+    return detect_clicks([call for call, _ in output.starts], recording, rate), 'loopback'
+
+
+def detect_clicks(calls, recording, rate, threshold=0.25):
+    """ delays (ms) between each call and the next sample of the recording
+    exceeding `threshold` of the full scale """
+    level = threshold * 32767
+    onsets = []
+    for t0, block in recording:
+        samples = array('h', block)
+        for i, x in enumerate(samples):
+            if abs(x) > level:
+                t = t0 + i / rate
+                if not onsets or t - onsets[-1] > 0.05:   # first sample of a click
+                    onsets.append(t)
+    latencies = []
+    for call in calls:
+        following = [t for t in onsets if t >= call]
+        if following:
+            latencies.append(1000 * (following[0] - call))
+    return latencies
+
+
+def _load(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def stored_latency(engine, filename=LATENCY_FILE):
+    """ latency (ms) of `engine` measured on this machine, or None """
+    entry = _load(filename).get(socket.gethostname(), dict()).get(engine)
+    return entry['latency'] if entry else None
+
+
+def store_latency(engine, latencies, method, filename=LATENCY_FILE):
+    """ stores the median of `latencies` as the latency of `engine` on this machine """
+    latencies = sorted(latencies)
+    median = latencies[len(latencies) // 2]
+    table = _load(filename)
+    table.setdefault(socket.gethostname(), dict())[engine] = dict(
+        latency=round(median, 3), min=round(latencies[0], 3), max=round(latencies[-1], 3),
+        n=len(latencies), method=method, date=datetime.datetime.now().isoformat())
+    os.makedirs(op.dirname(filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        json.dump(table, f, indent=2)
+    return median
@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Performance benchmarks of the localizer, runnable on a machine without display.
+
+For each run file `<language>/run<N>_pinel_localizer.csv` (4 runs x 3
+languages; missing files are reported and skipped) it measures:
+
+- expand: time to expand and sort the events of the csv file (timeline.py)
+- cache: time to load the compiled schedule from the on-disk cache
+- loop: wall time per event of the presentation loop on a virtual clock
+  (simulate.py), for each scheduler, and the p95/max onset errors
+- decode: time to read and decode the sound/picture files (preload.py),
+  only if pygame is installed (SDL dummy video and audio drivers are used)
+
+Results can be saved with --save and compared to a previous run with
+--baseline: the script exits with status 1 if a duration got more than
+--tolerance (relative) slower, or an onset error larger.
+
+Example:
+
+    python benchmark.py --save bench.json
+    python benchmark.py --baseline bench.json
+"""
+
+import os
+import os.path as op
+import sys
+import argparse
+import json
+import tempfile
+import time
+
+import timeline
+import simulate
+
+
+LANGUAGES = ('french', 'english', 'spanish')
+RUNS = (1, 2, 3, 4)
+
+
+def best_of(repeat, function, *args):
+    """ shortest duration (s) of `repeat` calls """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_expand(csv_file, options, repeat):
+    def expand():
+        timeline.compile_events(timeline.expand_rows(timeline.read_rows(csv_file), **options))
+    return best_of(repeat, expand)
+
+
+def bench_cache(csv_file, options, repeat):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        timeline.load_schedule(csv_file, options, cache_dir)
+        return best_of(repeat, timeline.load_schedule, csv_file, options, cache_dir)
+
+
+def bench_loop(csv_file, options, scheduler_name):
+    result = simulate.simulate_run(csv_file, options, scheduler_name)
+    stats = result['timer'].summary()
+    return dict(us_per_event=1e6 * result['wall'] / len(result['schedule']),
+                p95_error=max(s['p95_error'] for s in stats.values()),
+                max_error=max(s['max_error'] for s in stats.values()))
+
+
+def init_pygame():
+    """ initialises pygame with dummy drivers; returns False if it is not installed """
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+    os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    try:
+        import pygame
+    except ImportError:
+        return False
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+    pygame.mixer.init()
+    return True
+
+
+def bench_decode(csv_file, options):
+    import preload
+    schedule = timeline.load_schedule(csv_file, options, cache_dir=None)
+    bp = op.dirname(csv_file)
+    start = time.perf_counter()
+    for kind, id in schedule.assets():
+        if kind in ('sound', 'picture'):
+            preload.decode(kind, op.join(bp, id))
+    return time.perf_counter() - start
+
+
+def run_benchmarks(repeat=20, options=simulate.DEFAULT_OPTIONS, decode=True):
+    """ returns {run file: {measure: value}} (durations in ms, errors in ms) """
+    results = dict()
+    for language in LANGUAGES:
+        for run in RUNS:
+            csv_file = op.join(language, f"run{run}_pinel_localizer.csv")
+            if not op.exists(csv_file):
+                print(f"{csv_file}: missing, skipped")
+                continue
+            r = dict(expand=1000 * bench_expand(csv_file, options, repeat),
+                     cache=1000 * bench_cache(csv_file, options, repeat))
+            for name in ('legacy', 'hybrid'):
+                for k, v in bench_loop(csv_file, options, name).items():
+                    r[f"loop_{name}_{k}"] = v
+            if decode:
+                r['decode'] = 1000 * bench_decode(csv_file, options)
+            results[csv_file] = r
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ returns the list of measures that regressed w.r.t. the baseline """
+    regressions = []
+    for csv_file, measures in results.items():
+        for name, value in measures.items():
+            ref = baseline.get(csv_file, {}).get(name)
+            if ref is None:
+                continue
+            if 'error' in name:
+                bad = value > ref + 0.5   # ms of slack for the onset errors
+            else:
+                bad = value > ref * (1 + tolerance)
+            if bad:
+                regressions.append(f"{csv_file} {name}: {value:.3f} (baseline {ref:.3f})")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--save', help="json file where to save the results")
+    parser.add_argument('--baseline', help="json file of previous results to compare to")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="accepted relative slowdown w.r.t. the baseline")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.repeat, decode=init_pygame())
+    names = sorted({k for r in results.values() for k in r})
+    for csv_file, r in results.items():
+        print(csv_file)
+        for n in names:
+            print(f"    {n:28s} {r.get(n, float('nan')):10.3f}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,264 @@
+#! /usr/bin/env python3
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Logging of the events and keypresses of a run, off the presentation thread.
+
+The presentation loop writes fixed-size binary records (event index or key
+code, time, onset error) into a preallocated ring buffer. A writer thread
+moves them to a `.stream` file every 50 ms and fsyncs it every second, so
+that an interrupted run (crash, Ctrl-C, power loss) keeps everything logged
+until then. The strings (condition, stype, id) are not logged: they are
+those of the schedule, which is stored once in the header of the file.
+
+At the end of a run, the rows are replayed into expyriment's data, which
+writes the usual xpd file. The rows of an interrupted run can be recovered
+from the stream file with:
+
+    python datalog.py data/<file>.stream
+
+which writes data/<file>_recovered.xpd.
+"""
+
+import os
+import os.path as op
+import sys
+import re
+import csv
+import atexit
+import json
+import struct
+import threading
+from types import SimpleNamespace
+
+
+MAGIC = b'PLSTREAM1\n'
+RECORD = struct.Struct('<bxxxiddi')   # kind, event index, time, error, key
+EVENT, KEY, FRAMES = 0, 1, 2
+VARIABLE_NAMES = ['condition', 'time', 'stype', 'id', 'target_time', 'timing_error']
+
+
+def _row(schedule, kind, index, time, error, key):
+    if kind == KEY:
+        return ["keypressed", int(time), key]
+    if kind == FRAMES:   # end of a video: dropped frames in key, late frames in error
+        return ["videoframes", int(time), schedule.ids[index], key, int(error)]
+    return [schedule.conds[index], int(time), schedule.stypes[index],
+            schedule.ids[index], schedule.onsets[index], round(error, 2)]
+
+
+class ListLog:
+    """ In-memory log, with the same interface as StreamLog """
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.records = []
+
+    def event(self, index, time, error):
+        self.records.append((EVENT, index, time, error, 0))
+
+    def key(self, time, key):
+        self.records.append((KEY, -1, time, 0.0, key))
+
+    def frames(self, index, time, dropped, late):
+        self.records.append((FRAMES, index, time, late, dropped))
+
+    def close(self):
+        pass
+
+    def rows(self):
+        return [_row(self.schedule, *r) for r in self.records]
+
+
+class StreamLog:
+    """
+    path: stream file to write
+    schedule: timeline.Schedule of the run
+    info: dict of information stored in the header (subject, csv file...)
+    capacity: number of records of the ring buffer
+    """
+
+    def __init__(self, path, schedule, info=None, capacity=4096,
+                 interval=0.05, fsync_interval=1.0):
+        self.schedule = schedule
+        self.capacity = capacity
+        self.overflows = 0
+        self._ring = bytearray(RECORD.size * capacity)
+        self._written = 0   # number of records put in the ring (by the loop)
+        self._read = 0      # number of records moved to the file (by the writer)
+        self._interval = interval
+        self._fsync_every = max(1, int(fsync_interval / interval))
+        self._stop = threading.Event()
+
+        header = dict(info or {}, variables=VARIABLE_NAMES,
+                      onsets=list(schedule.onsets), conds=schedule.conds,
+                      stypes=schedule.stypes, ids=schedule.ids)
+        header = json.dumps(header).encode('utf-8')
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC + struct.pack('<I', len(header)) + header)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        self._thread = threading.Thread(target=self._writer, name='datalog', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # called by the presentation loop: no allocation, no i/o
+    def _put(self, kind, index, time, error, key):
+        if self._written - self._read >= self.capacity:
+            self.overflows += 1
+            return
+        RECORD.pack_into(self._ring, (self._written % self.capacity) * RECORD.size,
+                         kind, index, time, error, key)
+        self._written += 1
+
+    def event(self, index, time, error):
+        self._put(EVENT, index, time, error, 0)
+
+    def key(self, time, key):
+        self._put(KEY, -1, time, 0.0, key)
+
+    def frames(self, index, time, dropped, late):
+        """ logs the numbers of dropped and late frames of the video of event `index` """
+        self._put(FRAMES, index, time, late, dropped)
+
+    def _drain(self):
+        written = self._written
+        size = RECORD.size
+        while self._read < written:
+            start = self._read % self.capacity
+            n = min(written - self._read, self.capacity - start)
+            self._file.write(self._ring[start * size:(start + n) * size])
+            self._read += n
+        self._file.flush()
+
+    def _writer(self):
+        ticks = 0
+        while not self._stop.wait(self._interval):
+            self._drain()
+            ticks += 1
+            if ticks % self._fsync_every == 0:
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file.closed:
+            return
+        atexit.unregister(self.close)   # which would keep the log alive until the exit
+        self._stop.set()
+        self._thread.join()
+        self._drain()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        if self.overflows:
+            print(f"datalog: {self.overflows} records lost (ring buffer full)")
+
+    def rows(self):
+        """ the logged rows, read back from the stream file """
+        self.close()
+        return read_stream(self._file.name)[1]
+
+
+def read_stream(path):
+    """ returns (header, rows) of a stream file, ignoring a truncated last record """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a stream file")
+        n, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(n).decode('utf-8'))
+        data = f.read()
+
+    schedule = SimpleNamespace(onsets=header['onsets'], conds=header['conds'],
+                               stypes=header['stypes'], ids=header['ids'])
+    end = len(data) - len(data) % RECORD.size
+    rows = [_row(schedule, kind, index, time, error, key)
+            for kind, index, time, error, key in RECORD.iter_unpack(data[:end])]
+    return header, rows
+
+
+def _field(v):
+    v = str(v)
+    return f'"{v}"' if ',' in v else v
+
+
+def write_xpd(filename, rows, info, comment=None):
+    """ writes rows in the format of the xpd files of expyriment """
+    with open(filename, 'w', encoding='utf-8') as f:
+        if comment:
+            f.write(f"#{comment}\n")
+        for k in ('csv_file', 'date', 'host', 'options'):
+            if k in info:
+                v = info[k]
+                f.write(f"#e {k}: {json.dumps(v) if isinstance(v, dict) else v}\n")
+        f.write(','.join(['subject_id'] + VARIABLE_NAMES) + '\n')
+        subject = info.get('subject', '')
+        for row in rows:
+            f.write(','.join(_field(v) for v in [subject] + row) + '\n')
+
+
+def _number(v):
+    try:
+        return int(v)
+    except ValueError:
+        return float(v)
+
+
+def read_xpd(filename):
+    """ returns (info, rows) of an xpd file written by expyriment or by
+    write_xpd, the rows being those of the log (see _row), without the subject;
+    in the files without timing_error, it is time - target_time
+
+    info: subject, csv_file, date, host and (timing) options, when found in the file
+    """
+    info = dict()
+    rows = []
+    lines = []
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f.read().splitlines():
+            if line.startswith('#'):
+                _header(line, info)
+            elif line:
+                lines.append(line)
+    for line in lines[1:]:   # lines[0]: names of the variables
+        # only the values with commas are quoted: split the others directly
+        row = next(csv.reader([line])) if '"' in line else line.split(',')
+        info.setdefault('subject', row[0])
+        row = row[1:]
+        if row[0] == 'keypressed':
+            rows.append(['keypressed', _number(row[1]), _number(row[2])])
+        elif row[0] == 'videoframes':
+            rows.append(['videoframes', _number(row[1]), row[2], _number(row[3]), _number(row[4])])
+        else:
+            time, target = _number(row[1]), _number(row[4])
+            # the files of the first versions have no timing_error column
+            error = _number(row[5]) if len(row) > 5 and row[5] != '' else time - target
+            rows.append([row[0], time, row[2], row[3], target, error])
+    return info, rows
+
+
+def _header(line, info):
+    """ stores the information of a comment line of an xpd file """
+    match = re.match(r'#e (?:csv_file: )?(\S+\.csv)\s*$', line)
+    if match:
+        info['csv_file'] = match.group(1)
+    match = re.match(r'#e (date|host): (\S+)', line)
+    if match:
+        info[match.group(1)] = match.group(2)
+    match = re.match(r'#e options: (\{.*\})', line)
+    if match:
+        info['options'] = json.loads(match.group(1))
+
+
+def recover(path):
+    """ writes the rows of a stream file into an xpd file; returns its name """
+    header, rows = read_stream(path)
+    xpd = op.splitext(path)[0] + '_recovered.xpd'
+    write_xpd(xpd, rows, header, comment=f"Recovered from {op.basename(path)}")
+    return xpd
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} data/<file>.stream ...")
+        sys.exit(1)
+    for path in sys.argv[1:]:
+        print(f"{path} -> {recover(path)}")
@@ -0,0 +1,140 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Presentation of the small stimuli by updating only the region that changed.
+
+present() of an expyriment stimulus clears the whole screen, blits the
+stimulus and flips the whole screen, even for a word or the fixation cross
+in the middle of a 1920x1080 display. With --dirty-rects, the stimuli of a
+run are presented through DirtyRects, which keeps track of the region of the
+screen that differs from the background. When both the previous and the new
+stimulus are small (less than `max_area` of the screen), only the union of
+their rectangles is cleared, the new stimulus is blitted, and that region
+alone is copied to the display (pygame.display.update). A blank screen only
+clears the previous rectangle. The other stimuli (large pictures, videos,
+instructions boxes) are presented as before.
+
+Partial updates are only possible without OpenGL, which pinel_localizer.py
+turns off with --dirty-rects; should the display still use OpenGL, the
+stimuli are presented as before. The cost of a full present() is
+measured on the waiting screen (full_present_cost()), to report the time saved at
+the end of the run.
+"""
+
+import time
+
+
+FULL_SCREEN_KINDS = ('video', 'box')
+
+
+class DirtyRects:
+    """ Stimuli of a run, presented by updating the changed region only
+
+    stims: list of the stimuli of the events (or assetwindow.AssetWindow)
+    schedule: timeline.Schedule of the run
+    screen: expyriment screen
+    background: colour of the background
+    max_area: largest fraction of the screen updated partially
+    full_cost: duration (ms) of a full present(), see full_present_cost()
+    """
+
+    def __init__(self, stims, schedule, screen, background, max_area=0.25, full_cost=None):
+        import pygame
+        self._pygame = pygame
+        self.stims = stims
+        self.kinds = schedule.kinds
+        self.background = background
+        width, height = screen.size
+        self._centre = (width // 2, height // 2)
+        self._max_area = max_area * width * height
+        self._screen_area = width * height
+        self._drawn = None   # pygame.Rect differing from the background, None if unknown
+        self._stim = None
+        self._kind = None
+        self.full_cost = full_cost
+        self.partial = 0
+        self.partial_time = 0.0
+        self.partial_area = 0
+        self.full = 0
+
+    def __len__(self):
+        return len(self.stims)
+
+    def __getitem__(self, i):
+        self._stim = self.stims[i]
+        self._kind = self.kinds[i]
+        return self
+
+    def _rect(self, stim):
+        width, height = stim.surface_size
+        x, y = stim.position
+        rect = self._pygame.Rect(0, 0, width, height)
+        rect.center = (self._centre[0] + x, self._centre[1] - y)
+        return rect
+
+    def present(self):
+        stim, kind = self._stim, self._kind
+        if kind == 'sound':
+            return stim.present()
+        start = time.perf_counter()
+        if kind == 'blank':
+            rect = self._pygame.Rect(0, 0, 0, 0)
+        elif kind in FULL_SCREEN_KINDS:
+            rect = None
+        else:
+            rect = self._rect(stim)
+            if rect.width * rect.height > self._max_area:
+                rect = None
+
+        if rect is None or self._drawn is None:
+            stim.present()
+            self.full += 1
+            self._drawn = rect if kind not in FULL_SCREEN_KINDS else None
+        else:
+            if not self._drawn.width:
+                region = rect
+            elif not rect.width:
+                region = self._drawn
+            else:
+                region = rect.union(self._drawn)
+            surface = self._pygame.display.get_surface()
+            surface.fill(self.background, region)
+            if kind != 'blank':
+                stim.present(clear=False, update=False)
+            self._pygame.display.update(region)
+            self._drawn = rect
+            self.partial += 1
+            self.partial_area += region.width * region.height
+            self.partial_time += 1000 * (time.perf_counter() - start)
+        return 1000 * (time.perf_counter() - start)
+
+    def report(self, merged=0):
+        """ prints the numbers of flips saved and partial updates
+
+        merged: number of redundant events removed from the schedule
+        """
+        line = f"screen updates: {self.full} full, {self.partial} partial"
+        if self.partial:
+            mean = self.partial_time / self.partial
+            line += (f" ({100 * self.partial_area / (self.partial * self._screen_area):.1f}% "
+                     f"of the screen, {mean:.2f} ms on average")
+            if self.full_cost is not None:
+                line += (f", vs {self.full_cost:.2f} ms for a full present: "
+                         f"{self.partial * (self.full_cost - mean):.0f} ms saved")
+            line += ")"
+        if merged:
+            line += f", {merged} redundant flips skipped"
+        print(line)
+
+
+def available(screen):
+    """ whether the screen can be updated partially """
+    return not getattr(screen, 'opengl', False)
+
+
+def full_present_cost(stim, n=5):
+    """ mean duration (ms) of a full present() of `stim` (e.g. the waiting screen) """
+    start = time.perf_counter()
+    for _ in range(n):
+        stim.present()
+    return 1000 * (time.perf_counter() - start) / n
@@ -0,0 +1,361 @@
+#! /usr/bin/env python3
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+First-level GLM analysis of localizer sessions, from their xpd files.
+
+For each run, the events logged by pinel_localizer.py are turned into a
+table of trials (event_table): the words of a rsvp and the pictures of a
+pictseq are collapsed into one block, a sound lasts as long as its wav file.
+The regressors of all the conditions are built at once (design_matrix):
+their boxcars are summed on a 100 ms grid, convolved with the canonical HRF
+by FFT and sampled at the scan times, next to a constant and a cosine
+high-pass basis (128 s).
+
+The BOLD data of a run is read from a NumPy (.npy) or NIfTI (.nii, needs
+nibabel) file whose last axis is time. It is memory-mapped, and fitted by
+OLS by chunks of --chunk voxels, so that the memory used does not depend
+on the size of the images. The contrasts of the localizer (rundesign.CONTRASTS)
+are computed for each run, and combined over the runs of a subject by
+fixed effects. The subjects are analysed in parallel by a process pool
+(--jobs). NumPy is required (`pip install numpy`).
+
+The data files are found from the subject number and the run number of the
+csv file logged in the xpd files:
+
+    python firstlevel.py data/*.xpd --bold 'bold/sub-{subject}_run-{run}.nii' --output results
+
+writes results/sub-<subject>/<contrast>_effect and <contrast>_t maps (.npy,
+or .nii.gz for NIfTI data) and the design matrix of each run (tsv).
+
+The whole pipeline can be checked offline on simulated sessions (xpd files
+of the run files of the language, and BOLD data with known effects):
+
+    python firstlevel.py --synthetic 4 --output /tmp/synthetic
+"""
+
+import os
+import os.path as op
+import sys
+import re
+import time
+import wave
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import datalog
+import timeline
+import stimpack
+import simulate
+import rundesign
+
+
+DT = rundesign.DT   # ms, resolution of the regressors before sampling
+
+
+def sound_durations(bp):
+    """ function returning the duration (ms) of a sound of directory `bp` (0 if it cannot be read) """
+    cache = dict()
+
+    def duration(id):
+        if id not in cache:
+            try:
+                cache[id] = stimpack.duration(op.join(bp, id))
+            except (OSError, EOFError, wave.Error):
+                cache[id] = 0
+        return cache[id]
+    return duration
+
+
+def event_table(rows, duration=None):
+    """ (onset, duration, condition) of the trials of a run, in ms, from the
+    rows of its log (datalog.read_xpd)
+
+    The text and picture events of a condition are collapsed into a block,
+    which lasts until the last blank screen before the fixation cross or the
+    next trial; a sound lasts duration(id) ms (0 if duration is None), a
+    video 0 ms.
+    """
+    events = []
+    block = None   # [onset, end, condition]
+    for row in rows:
+        cond, t, stype = row[0], row[1], row[2]
+        if cond in ('keypressed', 'videoframes'):
+            continue
+        if stype in ('text', 'picture'):
+            if block is None or block[2] != cond:
+                if block is not None:
+                    events.append((block[0], block[1] - block[0], block[2]))
+                block = [t, t, cond]
+        elif stype == 'blank':
+            if block is not None and block[2] == cond:
+                block[1] = t
+        else:   # fixation cross, sound or video
+            if block is not None:
+                events.append((block[0], block[1] - block[0], block[2]))
+                block = None
+            if stype == 'sound':
+                events.append((t, duration(row[3]) if duration else 0, cond))
+            elif stype == 'video':
+                events.append((t, 0, cond))
+    if block is not None:
+        events.append((block[0], block[1] - block[0], block[2]))
+    return sorted(events)
+
+
+def design_matrix(events, n_scans, tr, conditions):
+    """ returns the (n_scans, columns) design matrix of a run and the names
+    of its columns: the conditions, 'constant' and the drifts
+
+    events: (onset, duration, condition) in ms, those of other conditions being ignored
+    tr: repetition time in ms
+    """
+    import numpy as np
+    events = [e for e in events if e[2] in conditions]
+    onsets = np.array([e[0] for e in events], float)
+    durations = np.array([e[1] for e in events], float)
+    index = np.array([conditions.index(e[2]) for e in events], int)
+
+    # boxcars of all the conditions, as cumulated starts and ends
+    n = int(n_scans * tr // DT) + 1
+    steps = np.zeros((len(conditions), n + 1))
+    start = np.clip(onsets // DT, 0, n).astype(int)
+    stop = np.clip(np.maximum(start + 1, (onsets + durations) // DT), 0, n).astype(int)
+    np.add.at(steps, (index, start), 1)
+    np.add.at(steps, (index, stop), -1)
+    boxcars = np.cumsum(steps, axis=1)[:, :n]
+
+    h = rundesign.hrf()
+    m = n + len(h)
+    regressors = np.fft.irfft(np.fft.rfft(boxcars, m) * np.fft.rfft(h, m), m)[:, :n]
+    frames = (np.arange(n_scans) * tr) // DT
+    drifts = rundesign.cosine_drifts(n_scans, tr)
+    X = np.hstack([regressors[:, frames].T, np.ones((n_scans, 1)), drifts])
+    columns = list(conditions) + ['constant'] + [f"drift_{k + 1}" for k in range(drifts.shape[1])]
+    return X, columns
+
+
+def contrast_matrix(columns):
+    """ returns the names and the (contrasts, columns) weights of the
+    contrasts of the localizer whose conditions are all in `columns` """
+    import numpy as np
+    names = [name for name, weights in rundesign.CONTRASTS.items() if set(weights) <= set(columns)]
+    C = np.zeros((len(names), len(columns)))
+    for q, name in enumerate(names):
+        for cond, weight in rundesign.CONTRASTS[name].items():
+            C[q, columns.index(cond)] = weight
+    return names, C
+
+
+def load_bold(path):
+    """ returns the memory-mapped (voxels, scans) data of an image, and
+    (shape, order, affine) to save maps of its voxels
+
+    NIfTI data is only memory-mapped if it is not compressed nor scaled.
+    """
+    import numpy as np
+    if path.endswith('.npy'):
+        data = np.load(path, mmap_mode='r')
+        affine = None
+    else:
+        import nibabel
+        image = nibabel.load(path, mmap=True)
+        data = np.asanyarray(image.dataobj)
+        affine = image.affine
+    # keep the voxels in the order of the file, so that reshaping is a view
+    order = 'F' if data.flags.f_contiguous and not data.flags.c_contiguous else 'C'
+    return data.reshape((-1, data.shape[-1]), order=order), (data.shape[:-1], order, affine)
+
+
+def save_map(filename, values, geometry):
+    """ saves the values of the voxels of an image as filename.npy or .nii.gz """
+    import numpy as np
+    shape, order, affine = geometry
+    volume = values.reshape(shape, order=order)
+    if affine is None:
+        np.save(filename + '.npy', volume)
+    else:
+        import nibabel
+        nibabel.save(nibabel.Nifti1Image(volume, affine), filename + '.nii.gz')
+
+
+def fit(X, data, C, chunk=20000):
+    """ OLS fit of the (voxels, scans) data; returns the (contrasts, voxels)
+    effects and variances of the contrasts C """
+    import numpy as np
+    pinv = np.linalg.pinv(X)
+    cvc = np.einsum('qp,pr,qr->q', C, pinv @ pinv.T, C)
+    dof = X.shape[0] - np.linalg.matrix_rank(X)
+    effects = np.empty((len(C), data.shape[0]), np.float32)
+    variances = np.empty_like(effects)
+    for v0 in range(0, data.shape[0], chunk):
+        Y = np.asarray(data[v0:v0 + chunk], float).T
+        beta = pinv @ Y
+        sigma2 = ((Y - X @ beta) ** 2).sum(axis=0) / dof
+        effects[:, v0:v0 + chunk] = C @ beta
+        variances[:, v0:v0 + chunk] = cvc[:, None] * sigma2
+    return effects, variances
+
+
+def run_number(csv_file):
+    match = re.search(r'run(\d+)', op.basename(csv_file or ''))
+    return int(match.group(1)) if match else None
+
+
+def analyse_subject(subject, runs, tr, output, chunk=20000, stim_dir=None):
+    """ fits the runs of a subject and combines them by fixed effects
+
+    runs: (xpd file, bold file) of each run
+    returns (subject, {contrast: max t})
+    """
+    import numpy as np
+    tables = []
+    for xpd, bold in runs:
+        info, rows = datalog.read_xpd(xpd)
+        bp = stim_dir or op.dirname(info.get('csv_file', ''))
+        tables.append(event_table(rows, sound_durations(bp)))
+    conditions = sorted({e[2] for events in tables for e in events})
+
+    directory = op.join(output, f"sub-{subject}")
+    os.makedirs(directory, exist_ok=True)
+    weights = weighted = geometry = None
+    for (xpd, bold), events in zip(runs, tables):
+        data, geometry = load_bold(bold)
+        X, columns = design_matrix(events, data.shape[1], tr, conditions)
+        names, C = contrast_matrix(columns)
+        name = op.splitext(op.basename(xpd))[0]
+        np.savetxt(op.join(directory, f"{name}_design.tsv"), X, fmt='%.6g',
+                   delimiter='\t', header='\t'.join(columns), comments='')
+        effects, variances = fit(X, data, C, chunk)
+        w = 1 / np.maximum(variances, np.finfo(np.float32).tiny)
+        weights = w if weights is None else weights + w
+        weighted = w * effects if weighted is None else weighted + w * effects
+
+    variances = 1 / weights
+    effects = weighted * variances
+    t = effects / np.sqrt(variances)
+    summary = dict()
+    for q, name in enumerate(names):
+        slug = re.sub(r'\W+', '_', name).strip('_')
+        save_map(op.join(directory, f"{slug}_effect"), effects[q], geometry)
+        save_map(op.join(directory, f"{slug}_t"), t[q], geometry)
+        summary[name] = float(t[q].max())
+    return subject, summary
+
+
+def match_runs(xpd_files, bold_pattern):
+    """ returns {subject: [(xpd file, bold file)]} """
+    subjects = dict()
+    for xpd in xpd_files:
+        info, _ = datalog.read_xpd(xpd)
+        run = run_number(info.get('csv_file'))
+        if run is None:
+            print(f"{xpd}: no run file logged, skipped")
+            continue
+        subject = info.get('subject', '')
+        subject = int(subject) if subject.isdigit() else subject
+        bold = bold_pattern.format(subject=subject, run=run)
+        if not op.exists(bold):
+            print(f"{xpd}: {bold} not found, skipped")
+            continue
+        subjects.setdefault(subject, []).append((xpd, bold))
+    return subjects
+
+
+def synthetic(directory, subjects=4, runs=4, shape=(8, 8, 8), tr=2000, noise=1.0,
+              amplitude=2.0, language='french', seed=0):
+    """ writes the xpd files and BOLD data (.npy) of simulated sessions
+
+    The voxels are split into a group per contrast of the localizer, where
+    the conditions have the weights of the contrast times `amplitude`.
+    Returns the pattern of the BOLD files and the (conditions, voxels) true effects.
+    """
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    conditions = sorted({c for weights in rundesign.CONTRASTS.values() for c in weights})
+    n_voxels = int(np.prod(shape))
+    groups = np.array_split(np.arange(n_voxels), len(rundesign.CONTRASTS))
+    betas = np.zeros((len(conditions), n_voxels))
+    for voxels, weights in zip(groups, rundesign.CONTRASTS.values()):
+        for cond, weight in weights.items():
+            betas[conditions.index(cond), voxels] = amplitude * weight
+
+    bold_pattern = op.join(directory, "sub-{subject:02d}_run-{run}.npy")
+    for subject in range(1, subjects + 1):
+        for run in range(1, runs + 1):
+            csv_file = op.join(language, f"run{run}_pinel_localizer.csv")
+            schedule = timeline.load_schedule(csv_file, simulate.DEFAULT_OPTIONS, cache_dir=None)
+            errors = rng.exponential(0.5, len(schedule))
+            rows = [[schedule.conds[i], int(schedule.onsets[i] + errors[i]), schedule.stypes[i],
+                     schedule.ids[i], schedule.onsets[i], round(errors[i], 2)]
+                    for i in range(len(schedule))]
+            datalog.write_xpd(op.join(directory, f"sub-{subject:02d}_run-{run}.xpd"), rows,
+                              dict(subject=subject, csv_file=csv_file))
+
+            events = event_table(rows, sound_durations(language))
+            n_scans = int((schedule.duration() + rundesign.TAIL) // tr)
+            X, _ = design_matrix(events, n_scans, tr, conditions)
+            Y = X[:, :len(conditions)] @ betas + 100 + noise * rng.standard_normal((n_scans, n_voxels))
+            np.save(bold_pattern.format(subject=subject, run=run),
+                    Y.T.reshape(shape + (n_scans,)).astype(np.float32))
+    return bold_pattern, conditions, betas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('xpd', nargs='*', help="xpd files of the runs")
+    parser.add_argument('--bold', help="pattern of the BOLD files, with {subject} and {run} fields")
+    parser.add_argument('--tr', type=int, default=2000, help="repetition time (ms)")
+    parser.add_argument('--output', default='results', help="directory of the results")
+    parser.add_argument('--stim-dir', help="directory of the sounds (default: that of the logged run file)")
+    parser.add_argument('--chunk', type=int, default=20000, help="voxels fitted at once")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument('--synthetic', type=int, metavar='N',
+                        help="analyse N simulated subjects instead of xpd files")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    try:
+        import numpy as np
+    except ImportError:
+        print("firstlevel.py needs NumPy: pip install numpy")
+        return 1
+
+    truth = None
+    if args.synthetic:
+        directory = op.join(args.output, 'synthetic')
+        args.bold, conditions, betas = synthetic(directory, args.synthetic, tr=args.tr, seed=args.seed)
+        args.xpd = sorted(op.join(directory, f) for f in os.listdir(directory) if f.endswith('.xpd'))
+        truth = conditions, betas
+    if not args.xpd or not args.bold:
+        parser.error("give xpd files and --bold, or --synthetic")
+
+    subjects = match_runs(args.xpd, args.bold)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(analyse_subject, subject, runs, args.tr, args.output,
+                                   args.chunk, args.stim_dir)
+                   for subject, runs in sorted(subjects.items())]
+        for future in futures:
+            subject, summary = future.result()
+            print(f"sub-{subject}: {len(subjects[subject])} runs, max t: "
+                  + ", ".join(f"{name} {t:.1f}" for name, t in summary.items()))
+    print(f"{len(subjects)} subjects analysed in {time.perf_counter() - start:.1f} s")
+
+    if truth is not None:
+        # mean t of each contrast where it has an effect, and elsewhere
+        conditions, betas = truth
+        for subject in sorted(subjects):
+            names, C = contrast_matrix(conditions)
+            effect = C @ betas
+            for q, name in enumerate(names):
+                slug = re.sub(r'\W+', '_', name).strip('_')
+                t = np.load(op.join(args.output, f"sub-{subject}", f"{slug}_t.npy")).ravel()
+                print(f"sub-{subject} {name}: mean t {t[effect[q] > 0].mean():.1f} "
+                      f"where positive, {t[effect[q] == 0].mean():.2f} where null")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
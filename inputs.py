@@ -0,0 +1,151 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Capture of the button presses and scanner triggers of a run.
+
+expyriment's Keyboard.check() returns at most one key per call and drops the
+others, so keys arriving together (or scanner pulses arriving during a
+response) were lost, and a key was timestamped when the loop happened to look
+at it. InputCapture instead drains *all* the pending keys at each poll and
+logs each of them with its arrival time. Every scanner pulse ('t') is logged
+and its time kept in `triggers`, for realignment on the scanner.
+
+Two sources are available:
+
+- the pygame event queue (default): keys are timestamped when drained, i.e.
+  at most one scheduler sleep (~1 ms) late, except during present().
+- a Linux evdev device (--input-device /dev/input/by-id/...-event-kbd): a
+  thread reads the device, and the keys carry the time stamped by the kernel
+  at the interrupt, independently of what the presentation loop is doing.
+  The pygame queue is still drained, to process the escape key.
+"""
+
+import os
+import select
+import collections
+import struct
+import threading
+import time
+
+
+TRIGGER_KEY = ord('t')
+
+# struct input_event of linux/input.h (64 bit): timeval, type, code, value
+_EVENT = struct.Struct('llHHi')
+_EV_KEY = 1
+_EVIOCSCLOCKID = 0x400445a0
+_CLOCK_MONOTONIC = 1
+
+# evdev key codes -> pygame key codes (ascii) for the letters and digits
+_EVDEV_KEYS = dict(zip((16, 17, 18, 19, 20, 21, 22, 23, 24, 25,
+                        30, 31, 32, 33, 34, 35, 36, 37, 38,
+                        44, 45, 46, 47, 48, 49, 50),
+                       (ord(c) for c in 'qwertyuiopasdfghjklzxcvbnm')))
+_EVDEV_KEYS.update(zip(range(2, 12), (ord(c) for c in '1234567890')))
+_EVDEV_KEYS[57] = ord(' ')
+
+
+class EvdevReader(threading.Thread):
+    """ Reads key presses from a Linux input device, with kernel timestamps
+
+    The events are put in `queue` as (perf_counter time in s, pygame key code).
+    """
+
+    def __init__(self, path):
+        threading.Thread.__init__(self, name='evdev', daemon=True)
+        import fcntl
+        self.queue = collections.deque()
+        self._fd = os.open(path, os.O_RDONLY)
+        fcntl.ioctl(self._fd, _EVIOCSCLOCKID, struct.pack('i', _CLOCK_MONOTONIC))
+        # perf_counter and the kernel stamps must share the same clock
+        impl = time.get_clock_info('perf_counter').implementation
+        self._offset = 0.0 if 'CLOCK_MONOTONIC' in impl else time.perf_counter() - time.monotonic()
+        self._stop, self._wake = os.pipe()   # written to by close()
+
+    def run(self):
+        while True:
+            ready, _, _ = select.select([self._fd, self._stop], [], [])
+            if self._stop in ready:
+                return
+            try:
+                data = os.read(self._fd, _EVENT.size * 64)
+            except OSError:
+                return
+            for sec, usec, type, code, value in _EVENT.iter_unpack(data):
+                if type == _EV_KEY and value == 1 and code in _EVDEV_KEYS:
+                    self.queue.append((sec + usec / 1e6 + self._offset, _EVDEV_KEYS[code]))
+
+    def close(self):
+        """ stops the thread, then closes the device """
+        os.write(self._wake, b'x')
+        self.join()
+        for fd in (self._fd, self._stop, self._wake):
+            os.close(fd)
+
+
+class InputCapture:
+    """
+    keyboard: expyriment.io.Keyboard, used for the control keys (escape)
+    log: datalog.StreamLog receiving the keys
+    device: path of an evdev device, or None to use the pygame event queue
+    """
+
+    def __init__(self, keyboard, log=None, device=None, trigger_key=TRIGGER_KEY):
+        import pygame
+        self._pygame = pygame
+        self.keyboard = keyboard
+        self.log = log
+        self.trigger_key = trigger_key
+        self.clock = None
+        self.on_trigger = None   # called with the perf_counter time of each pulse
+        self.triggers = []   # run clock times (ms) of the scanner pulses
+        self._pending = collections.deque()
+        self._reader = None
+        if device is not None:
+            self._reader = EvdevReader(device)
+            self._pending = self._reader.queue
+            self._reader.start()
+
+    def _drain_pygame(self):
+        stamp = time.perf_counter()
+        for event in self._pygame.event.get(self._pygame.KEYDOWN):
+            self.keyboard.process_control_keys(event)
+            if self._reader is None:
+                self._pending.append((stamp, event.key))
+        self._pygame.event.clear(self._pygame.KEYUP)   # as Keyboard.check(), lest they fill the queue
+
+    def wait_for_trigger(self):
+        """ waits for the first scanner pulse; returns its perf_counter time (s) """
+        while True:
+            self._drain_pygame()
+            while self._pending:
+                t, key = self._pending.popleft()
+                if key == self.trigger_key:
+                    self._pending.clear()
+                    return t
+            time.sleep(0.0005)
+
+    def start_clock(self, clock, trigger=True):
+        """ from now on, keys are logged in the time of `clock` (a
+        scheduler.MonotonicClock started at the first trigger, unless
+        `trigger` is False) """
+        self.clock = clock
+        if trigger:
+            self.triggers.append(0.0)
+            self.log.key(0.0, self.trigger_key)
+
+    def poll(self):
+        """ logs all the keys received since the last call """
+        self._drain_pygame()
+        pending, clock = self._pending, self.clock
+        while pending:
+            t, key = pending.popleft()
+            if key == self.trigger_key:
+                if self.on_trigger is not None:
+                    self.on_trigger(t)
+                self.triggers.append(clock.at(t))
+            self.log.key(clock.at(t), key)
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
@@ -0,0 +1,161 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Per-event timing measurements of the presentation loop.
+
+For every event of the schedule, the loop records (in ms, on the run clock):
+
+- wake: when the scheduler returned, i.e. the loop stopped waiting (its
+  mean delay w.r.t. the onset is reported as `wake`)
+- start, end: just before and just after stim.present()
+- flip: the moment the flip returned (or the sound was started), i.e. end,
+  the time logged in the data file, so that the report and the data agree
+
+The values are stored in preallocated arrays, so recording costs four
+stores. At the end of the run, `report()` prints a summary per stype and
+`save()` writes them as a csv file plus a raw binary file (float64, one row of
+6 values per event: onset, wake, start, end, flip, shown).
+
+StartupProfile measures the wall time and the memory of the phases of the
+startup of pinel_localizer.py (imports, configuration, display, schedule,
+stimuli...), from the launch of the script to the moment it is ready for the
+scanner trigger (--profile-startup).
+"""
+
+import os
+import time
+import math
+import contextlib
+from array import array
+
+
+FIELDS = ('onset', 'wake', 'start', 'end', 'flip', 'shown')
+
+
+def _percentile(values, q):
+    if not values:
+        return math.nan
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)]
+
+
+class EventTimer:
+    def __init__(self, schedule):
+        n = len(schedule)
+        self.schedule = schedule
+        self.wake = array('d', [math.nan]) * n
+        self.start = array('d', [math.nan]) * n
+        self.end = array('d', [math.nan]) * n
+        self.flip = array('d', [math.nan]) * n
+
+    def record(self, i, wake, start, end, returned):
+        self.wake[i] = wake
+        self.start[i] = start
+        self.end[i] = end
+        self.flip[i] = end   # the integer ms returned by present() are coarser
+
+    def shown(self):
+        """ measured display duration of each event (time until the next flip) """
+        flip = self.flip
+        return [flip[i + 1] - flip[i] for i in range(len(flip) - 1)] + [math.nan]
+
+    def summary(self):
+        """ returns {stype: dict of statistics} """
+        onsets, stypes = self.schedule.onsets, self.schedule.stypes
+        shown = self.shown()
+        groups = dict()
+        for i, stype in enumerate(stypes):
+            if math.isnan(self.flip[i]):
+                continue   # never presented (run interrupted)
+            g = groups.setdefault(stype, ([], [], [], []))
+            g[0].append(self.flip[i] - onsets[i])
+            g[1].append(self.end[i] - self.start[i])
+            if i + 1 < len(onsets) and not math.isnan(shown[i]):
+                g[2].append(shown[i] - (onsets[i + 1] - onsets[i]))
+            g[3].append(self.wake[i] - onsets[i])
+        stats = dict()
+        for stype, (errors, durations, stretch, wakes) in groups.items():
+            abserr = [abs(e) for e in errors]
+            stats[stype] = dict(n=len(errors),
+                                mean_error=sum(errors) / len(errors),
+                                p95_error=_percentile(abserr, 0.95),
+                                max_error=max(abserr),
+                                mean_present=sum(durations) / len(durations),
+                                max_present=max(durations),
+                                mean_wake=sum(wakes) / len(wakes),
+                                max_stretch=max((abs(s) for s in stretch), default=math.nan))
+        return stats
+
+    def report(self):
+        print(f"{'stype':>8s} {'n':>5s} {'mean err':>9s} {'p95 |err|':>9s} {'max |err|':>9s} "
+              f"{'wake':>6s} {'present':>8s} {'max pres':>8s} {'max stretch':>11s}   (ms)")
+        for stype, s in sorted(self.summary().items()):
+            print(f"{stype:>8s} {s['n']:5d} {s['mean_error']:9.2f} {s['p95_error']:9.2f} "
+                  f"{s['max_error']:9.2f} {s['mean_wake']:6.2f} {s['mean_present']:8.2f} "
+                  f"{s['max_present']:8.2f} {s['max_stretch']:11.2f}")
+
+    def save(self, basename):
+        """ writes basename + '.csv' and basename + '.bin' """
+        schedule, shown = self.schedule, self.shown()
+        rows = [(schedule.onsets[i], self.wake[i], self.start[i], self.end[i],
+                 self.flip[i], shown[i]) for i in range(len(schedule))]
+        with open(basename + '.csv', 'w', encoding='utf-8') as f:
+            f.write('\t'.join(('condition', 'stype', 'id') + FIELDS) + '\n')
+            for i, row in enumerate(rows):
+                f.write('\t'.join([schedule.conds[i], schedule.stypes[i], schedule.ids[i]] +
+                                  [f"{v:.3f}" for v in row]) + '\n')
+        with open(basename + '.bin', 'wb') as f:
+            array('d', [v for row in rows for v in row]).tofile(f)
+
+
+def memory():
+    """ resident memory of the process in bytes (its peak where the current
+    value is unknown, None if neither is) """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import assetwindow
+        return assetwindow.peak_rss()
+
+
+class StartupProfile:
+    """ wall time and memory of the phases of the startup
+
+    origin: time.perf_counter() at the launch of the script
+    """
+
+    def __init__(self, origin=None):
+        self.origin = time.perf_counter() if origin is None else origin
+        self.phases = []   # (name, start, end, memory at the end), in s and bytes
+        self.memory = memory() if origin is None else None   # unknown at the launch
+
+    def add(self, name, start):
+        """ records a phase which started at `start` (time.perf_counter()) and ends now """
+        self.phases.append((name, start, time.perf_counter(), memory()))
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start)
+
+    def elapsed(self):
+        """ ms since the launch """
+        return 1000 * (time.perf_counter() - self.origin)
+
+    def report(self, label='ready'):
+        """ prints the phases recorded since the previous report """
+        print(f"{'phase':>16s} {'ms':>8s} {'at':>8s} {'memory':>8s} {'delta':>8s}   (ms after launch, MB)")
+        previous = self.memory
+        for name, start, end, rss in self.phases:
+            size = f"{rss / 2 ** 20:8.1f}" if rss is not None else f"{'?':>8s}"
+            delta = f"{(rss - previous) / 2 ** 20:+8.1f}" if None not in (rss, previous) else f"{'?':>8s}"
+            print(f"{name:>16s} {1000 * (end - start):8.1f} {1000 * (end - self.origin):8.1f} "
+                  f"{size} {delta}")
+            previous = rss
+        print(f"{label}: {self.elapsed():.0f} ms after launch (without the startup of the interpreter)")
+        self.phases = []
+        self.memory = previous
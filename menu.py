@@ -6,6 +6,10 @@ import os
 import sys
 import datetime
 import subprocess
+import shlex
+import time
+
+import runner
 
 # --- Persistence Configuration ---
 SUBJECT_FILE = ".last_subject.txt"
@@ -34,6 +38,10 @@ CMD_LOCALIZER_BASE = (
     "--stim-dir french --total-duration 305000"
 )
 
+# with --runner, the commands are executed by a persistent runner.py process
+USE_RUNNER = '--runner' in sys.argv[1:]
+RUNNER_START_TIMEOUT = 30  # seconds
+
 class PinelLocalizerApp(npyscreen.NPSAppManaged):
     def onStart(self):
         self.addForm("MAIN", MainMenu, name="Pinel Localizer (French)")
@@ -145,7 +153,8 @@ class MainMenuOptionList(npyscreen.MultiLineAction):
             npyscreen.blank_terminal()
             print(full_command)
             try:
-                subprocess.call(full_command, shell=True)
+                if not (USE_RUNNER and self.send_to_runner(cmd_suffix, selection_index)):
+                    subprocess.call(full_command, shell=True)
             except KeyboardInterrupt:
                 pass
             #input("\nPress Enter to return to menu...")
@@ -163,9 +172,50 @@ class MainMenuOptionList(npyscreen.MultiLineAction):
             
             self.parent.display()
 
+    def send_to_runner(self, cmd_suffix, selection_index):
+        """ executes the command in the runner (started if needed)
+
+        returns False if the runner is not available, so that the command is
+        launched directly instead """
+        conn = runner.connect()
+        if conn is None:
+            runner_command = CMD_LOCALIZER_BASE.replace("pinel_localizer.py", "runner.py")
+            subprocess.Popen(shlex.split(runner_command))
+            deadline = time.time() + RUNNER_START_TIMEOUT
+            while conn is None and time.time() < deadline:
+                time.sleep(0.5)
+                conn = runner.connect()
+            if conn is None:
+                print("Could not start the runner: launching the command directly")
+                return False
+
+        next_run = None
+        if selection_index in ("3", "4", "5"):   # runs 1 to 3: prefetch the next one
+            next_run = f"french/run{int(selection_index) - 1}_pinel_localizer.csv"
+        with conn:
+            conn.send(dict(action='run', argv=shlex.split(cmd_suffix),
+                           subject=os.environ['SUBJECT'], next=next_run))
+            try:
+                print(conn.recv())
+            except EOFError:
+                print("The runner has stopped (escape key?)")
+        return True
+
+
+def stop_runner():
+    conn = runner.connect()
+    if conn is not None:
+        with conn:
+            conn.send(dict(action='quit'))
+            conn.recv()
+
+
 if __name__ == "__main__":
     try:
         app = PinelLocalizerApp()
         app.run()
     except KeyboardInterrupt:
         sys.exit(0)
+    finally:
+        if USE_RUNNER:
+            stop_runner()
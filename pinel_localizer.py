@@ -2,23 +2,36 @@
 # sam. 06 déc. 2025 17:26:29 CET
 # LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
 
+import time
+LAUNCH = time.perf_counter()   # for --profile-startup
+
 import os
-import io
 import sys
 import os.path as op
 import argparse
-import csv
 import datetime
+import json
+import socket
 import warnings
 warnings.filterwarnings("ignore")
 
-import expyriment.control
-from expyriment import stimuli
-from expyriment.misc import Clock
-from expyriment.misc import geometry
-
-from queue import PriorityQueue
+import timeline
+import render_cache
+import preload
+import scheduler
+import instrumentation
+import runloop
+import datalog
+import inputs
+import scannerclock
+import assetwindow
+import videostream
+import audio
+import dirtyrects
+import stimpack
 
+startup = instrumentation.StartupProfile(LAUNCH)
+startup.add('imports', LAUNCH)
 
 """
 This script implements the "Pinel localizer", a 5-minute functional magnetic resonance imaging (fMRI) acquisition procedure which reliably captures the cerebral bases of key cognitive functions at an individual level, including auditory and visual perception, motor actions, reading, language comprehension, and mental calculation. 
@@ -34,22 +47,6 @@ python pinel_localizer.py --background-color 0 0 0 --text-color 250 250 250
 --splash ./instructions_localizer_time.csv --total-duration=301000 
 """
 
-if os.getenv('EXPYRIMENT_DISPLAY') is None or os.getenv('EXPYRIMENT_DISPLAY_RESOLUTION') is None:
-    print("Before calling this script, you must set the two environment variables 'EXPERIMENT_DISPLAY' and 'EXPERIMENT_DISPLAY_RESOLUTION, for example:")
-    print("    export EXPYRIMENT_DISPLAY=1")
-    print("    export EXPYRIMENT_DISPLAY_RESOLUTION=1920x1080")
-    sys.exit(1)
-
-if os.getenv("SUBJECT") is None:
-    print('Before calling this script, you must set the SUBJECT environment variable, e.g.\n    export SUBJECT=1')
-    sys.exit(1)
-
-SUBJECT = int(os.getenv("SUBJECT"))
-
-print(f"EXPYRIMENT_DISPLAY={os.getenv('EXPYRIMENT_DISPLAY')}")
-print(f"EXPYRIMENT_DISPLAY_RESOLUTION={os.getenv('EXPYRIMENT_DISPLAY_RESOLUTION')}")
-print(f"SUBJECT={SUBJECT}")
-
 ######################################################################
 # constants (which can be modified by optional command line arguments)
 WORD_DURATION = 450
@@ -64,6 +61,7 @@ BACKGROUND_COLOR=(240, 240, 240)
 TEXT_FONT = 'ARIALN.TTF'
 TEXT_SIZE = 48
 TEXT_COLOR = (0, 0, 0)
+SETTLE_TIME = 800 # time in millisec between the opening of the display and the first screen
 WINDOW_SIZE = (1220, 700)
 #WINDOW_SIZE = (1280, 1028)
 
@@ -80,6 +78,11 @@ parser.add_argument("--cali",
 parser.add_argument('--csv_file',
                     type=str,
                     help="file for stimulation")
+parser.add_argument('--session',
+                    type=str,
+                    nargs='+',
+                    help="run files to present in order, in this process (after --cali and \
+                          --splash if given), each run being loaded while the previous one plays")
 parser.add_argument('--total-duration',
                     type=int,
                     default=-1,
@@ -137,59 +140,244 @@ parser.add_argument("--stim-dir",
                     type=str,
                     default='STIM_DIR',
                     help="directory in which stim are available")
+parser.add_argument("--render-cache-size",
+                    type=int,
+                    default=render_cache.MAX_BYTES // (1024 * 1024),
+                    help="size (in MB) of the on-disk cache of rendered words (0 disables it)")
+parser.add_argument("--preload-workers",
+                    type=int,
+                    default=None,
+                    help="number of threads decoding the stimuli files (0 to load them sequentially)")
+parser.add_argument("--scheduler",
+                    choices=sorted(scheduler.SCHEDULERS),
+                    default='legacy',
+                    help="how to wait for the onsets: 'legacy' (1 ms sleeps until 10 ms before) \
+                          or 'hybrid' (sleep, then spin, aiming the flips at the onsets)")
+parser.add_argument("--input-device",
+                    type=str,
+                    default=None,
+                    help="Linux input device (e.g. /dev/input/by-id/...-event-kbd) from which \
+                          the buttons and triggers are read, with kernel timestamps")
+parser.add_argument("--scanner-clock",
+                    type=float,
+                    default=None,
+                    metavar='TR',
+                    help="follow the clock of the scanner, whose triggers arrive every TR ms")
+parser.add_argument("--stream-assets",
+                    action='store_true',
+                    help="only keep the stimuli of the next seconds in memory (see --asset-budget \
+                          and --lookahead) instead of loading the whole run")
+parser.add_argument("--asset-budget",
+                    type=int,
+                    default=256,
+                    help="with --stream-assets, memory (in MB) allowed for the loaded stimuli")
+parser.add_argument("--lookahead",
+                    type=int,
+                    default=10000,
+                    help="with --stream-assets, how long (in ms) before their onset the stimuli are loaded")
+parser.add_argument("--video-buffers",
+                    type=int,
+                    default=videostream.CAPACITY,
+                    help="number of video frames decoded ahead, with OpenCV (0 to present the \
+                          videos with expyriment's Video stimulus)")
+parser.add_argument("--audio-engine",
+                    choices=audio.ENGINES,
+                    default='expyriment',
+                    help="'pcm' plays the sounds from a PCM buffer through a low-latency stream \
+                          (requires sounddevice), started ahead of their onsets by the latency \
+                          measured by --cali")
+parser.add_argument("--audio-buffer",
+                    type=int,
+                    default=None,
+                    help="size (in frames) of the audio blocks of the pcm engine, or of the \
+                          buffer of expyriment's audio system")
+parser.add_argument("--audio-device",
+                    type=str,
+                    default=None,
+                    help="output device of the pcm engine (number or name, see \
+                          'python -m sounddevice')")
+parser.add_argument("--skip-redundant-flips",
+                    action='store_true',
+                    help="remove from the schedules the blank and fixation cross events which \
+                          would redraw the screen already displayed")
+parser.add_argument("--dirty-rects",
+                    action='store_true',
+                    help="present the words and the fixation cross by updating only the region \
+                          of the screen that changed (turns OpenGL off); implies --skip-redundant-flips")
+parser.add_argument("--profile-startup",
+                    action='store_true',
+                    help="print the wall time and memory of each phase of the startup, until \
+                          the script is ready for the scanner trigger")
+parser.add_argument("--validate",
+                    action='store_true',
+                    help="check the run (or instructions) file and its stimuli files, without \
+                          opening the display; the exit status is 1 if a problem is found")
+parser.add_argument("--dry-run",
+                    action='store_true',
+                    help="--validate, then present the run on the stand-ins of simulate.py, \
+                          without opening the display")
+parser.add_argument("--loopback-device",
+                    type=str,
+                    default=None,
+                    help="with --cali and the pcm engine, input device connected to the audio \
+                          output, to measure the audio latency")
+
 
+def check_environment():
+    """ checks the environment variables; returns the subject number """
+    if os.getenv('EXPYRIMENT_DISPLAY') is None or os.getenv('EXPYRIMENT_DISPLAY_RESOLUTION') is None:
+        print("Before calling this script, you must set the two environment variables 'EXPERIMENT_DISPLAY' and 'EXPERIMENT_DISPLAY_RESOLUTION, for example:")
+        print("    export EXPYRIMENT_DISPLAY=1")
+        print("    export EXPYRIMENT_DISPLAY_RESOLUTION=1920x1080")
+        sys.exit(1)
+
+    if os.getenv("SUBJECT") is None:
+        print('Before calling this script, you must set the SUBJECT environment variable, e.g.\n    export SUBJECT=1')
+        sys.exit(1)
+
+    print(f"EXPYRIMENT_DISPLAY={os.getenv('EXPYRIMENT_DISPLAY')}")
+    print(f"EXPYRIMENT_DISPLAY_RESOLUTION={os.getenv('EXPYRIMENT_DISPLAY_RESOLUTION')}")
+    print(f"SUBJECT={os.getenv('SUBJECT')}")
+    return int(os.getenv("SUBJECT"))
 
 
 ##############################
 # parse command line options
-args = parser.parse_args()
-splash_screen = args.splash
-calibration = args.cali
-csv_file = args.csv_file
-FS_DELAY = args.fs_delay_time
-WORD_DURATION = args.rsvp_display_time
-PICTURE_DURATION = args.picture_display_time
-PICTURE_ISI = args.picture_isi
-TEXT_DURATION = args.text_duration
-TEXT_SIZE = args.text_size
-TEXT_COLOR = tuple(args.text_color)
-TEXT_FONT = args.text_font
-BACKGROUND_COLOR = tuple(args.background_color)
-WINDOW_SIZE = tuple(args.window_size)
-TOTAL_EXPE_DURATION = args.total_duration
-WORD_ISI = args.rsvp_display_isi
-STIM_DIR = args.stim_dir
+def configure(args):
+    """ sets the constants from the command line options """
+    global splash_screen, calibration, csv_file, FS_DELAY, WORD_DURATION, \
+        PICTURE_DURATION, PICTURE_ISI, TEXT_DURATION, TEXT_SIZE, TEXT_COLOR, \
+        TEXT_FONT, BACKGROUND_COLOR, WINDOW_SIZE, TOTAL_EXPE_DURATION, WORD_ISI, \
+        STIM_DIR, RENDER_CACHE_SIZE, PRELOAD_WORKERS, SCHEDULER, INPUT_DEVICE, SCANNER_TR, \
+        STREAM_ASSETS, ASSET_BUDGET, LOOKAHEAD, AUDIO_ENGINE, AUDIO_BUFFER, \
+        AUDIO_DEVICE, LOOPBACK_DEVICE, AUDIO_LATENCY, MERGE_SCREENS, DIRTY_RECTS, \
+        PROFILE_STARTUP
+    splash_screen = args.splash
+    calibration = args.cali
+    csv_file = args.csv_file
+    FS_DELAY = args.fs_delay_time
+    WORD_DURATION = args.rsvp_display_time
+    PICTURE_DURATION = args.picture_display_time
+    PICTURE_ISI = args.picture_isi
+    TEXT_DURATION = args.text_duration
+    TEXT_SIZE = args.text_size
+    TEXT_COLOR = tuple(args.text_color)
+    TEXT_FONT = args.text_font
+    BACKGROUND_COLOR = tuple(args.background_color)
+    WINDOW_SIZE = tuple(args.window_size)
+    TOTAL_EXPE_DURATION = args.total_duration
+    WORD_ISI = args.rsvp_display_isi
+    STIM_DIR = args.stim_dir
+    RENDER_CACHE_SIZE = args.render_cache_size
+    PRELOAD_WORKERS = args.preload_workers
+    SCHEDULER = args.scheduler
+    INPUT_DEVICE = args.input_device
+    SCANNER_TR = args.scanner_clock
+    STREAM_ASSETS = args.stream_assets
+    ASSET_BUDGET = args.asset_budget
+    LOOKAHEAD = args.lookahead
+    videostream.CAPACITY = args.video_buffers
+    AUDIO_ENGINE = args.audio_engine
+    if AUDIO_ENGINE == 'pcm' and not audio.available():
+        print("sounddevice is not available: the sounds are played by expyriment")
+        AUDIO_ENGINE = 'expyriment'
+    AUDIO_BUFFER = args.audio_buffer
+    AUDIO_DEVICE = device(args.audio_device)
+    LOOPBACK_DEVICE = device(args.loopback_device)
+    AUDIO_LATENCY = audio.stored_latency(AUDIO_ENGINE)
+    MERGE_SCREENS = args.skip_redundant_flips or args.dirty_rects
+    DIRTY_RECTS = args.dirty_rects
+    PROFILE_STARTUP = args.profile_startup
+
+
+def device(name):
+    """ sounddevice device: a number or (part of) a name """
+    return int(name) if name is not None and name.isdigit() else name
+
+
+def timing_options():
+    return dict(word_duration=WORD_DURATION,
+                word_isi=WORD_ISI,
+                picture_duration=PICTURE_DURATION,
+                picture_isi=PICTURE_ISI,
+                fs_delay=FS_DELAY,
+                text_duration=TEXT_DURATION,
+                merge_screens=MERGE_SCREENS)
 
 
 ##############################
 # Epyriment initialization
-expyriment.control.defaults.window_mode=False
-expyriment.design.defaults.experiment_background_colour = BACKGROUND_COLOR
+def import_backend():
+    """ imports expyriment (and pygame), which only the modes opening the display need """
+    global expyriment, stimuli
+    import expyriment.control
+    import expyriment.design
+    import expyriment.io
+    import expyriment.misc
+    from expyriment import stimuli
 
-expyriment.control.defaults.display = int(os.getenv('EXPYRIMENT_DISPLAY'))
-expyriment.control.defaults.display_resolution = [int(s) for s in os.getenv('EXPYRIMENT_DISPLAY_RESOLUTION').split('x')] 
 
-exp = expyriment.design.Experiment(name="Localizer",
-                                   background_colour=BACKGROUND_COLOR,
-                                   foreground_colour=TEXT_COLOR,
-                                   text_size=20,
-                                   text_font=TEXT_FONT)
-expyriment.misc.add_fonts('fonts')
-expyriment.control.initialize(exp)
-exp._screen_colour = BACKGROUND_COLOR
+def initialize():
+    """ opens the display """
+    global exp, kb, bs, fs, audio_output, display_opened
+    import_backend()
+    expyriment.control.defaults.window_mode=False
+    if DIRTY_RECTS:
+        expyriment.control.defaults.opengl = 0   # partial updates need a plain pygame display
+    expyriment.design.defaults.experiment_background_colour = BACKGROUND_COLOR
 
-kb = expyriment.io.Keyboard()
-bs = stimuli.BlankScreen(colour=BACKGROUND_COLOR)
-fs = stimuli.FixCross(size=(25, 25), line_width=3, colour=TEXT_COLOR)
+    if AUDIO_BUFFER:
+        expyriment.control.defaults.audiosystem_buffer_size = AUDIO_BUFFER
+    expyriment.control.defaults.display = int(os.getenv('EXPYRIMENT_DISPLAY'))
+    expyriment.control.defaults.display_resolution = [int(s) for s in os.getenv('EXPYRIMENT_DISPLAY_RESOLUTION').split('x')] 
 
-##############################
-# START PROTOCOL
+    exp = expyriment.design.Experiment(name="Localizer",
+                                       background_colour=BACKGROUND_COLOR,
+                                       foreground_colour=TEXT_COLOR,
+                                       text_size=20,
+                                       text_font=TEXT_FONT)
+    expyriment.misc.add_fonts('fonts')
+    expyriment.control.initialize(exp)
+    exp._screen_colour = BACKGROUND_COLOR
+
+    kb = expyriment.io.Keyboard()
+    audio_output = None   # audio.PcmOutput of the run, with the pcm engine
+    bs = stimuli.BlankScreen(colour=BACKGROUND_COLOR)
+    fs = stimuli.FixCross(size=(25, 25), line_width=3, colour=TEXT_COLOR)
+    display_opened = exp.clock.time
+    return exp
+
+
+def settle():
+    """ waits until the display has been open for SETTLE_TIME ms
 
-exp.clock.wait(800)
+    The stimuli are loaded meanwhile, so that the wait only lasts what
+    remains of it when they are ready.
+    """
+    with startup.phase('settle'):
+        remaining = SETTLE_TIME - (exp.clock.time - display_opened)
+        if remaining > 0:
+            exp.clock.wait(remaining)
+
+
+def ready():
+    """ the first screen is displayed: reports the startup with --profile-startup """
+    if PROFILE_STARTUP:
+        startup.report('ready')
+
+
+def text_line(text):
+    stim = stimuli.TextLine(text,
+                            text_font=TEXT_FONT,
+                            text_size=TEXT_SIZE,
+                            text_colour=TEXT_COLOR,
+                            background_colour=BACKGROUND_COLOR)
+    stim.preload()
+    return stim
 
 
 #CALIBRATION
-if not (calibration is None) :
+def calibrate():
     calibrage = "Calibration: we are going to play a sound"
     calibration = stimuli.TextLine(calibrage, text_font=TEXT_FONT,
                                           text_size=TEXT_SIZE,
@@ -205,182 +393,400 @@ if not (calibration is None) :
     instruction.present()
     fs.present()  
     exp.clock.wait(2100)
+
+    if AUDIO_ENGINE == 'pcm':
+        text_line("Calibration: measuring the audio latency").present()
+        latencies, method = audio.measure_latency(AUDIO_BUFFER or 128, AUDIO_DEVICE,
+                                                  LOOPBACK_DEVICE)
+        if latencies:
+            latency = audio.store_latency('pcm', latencies, method)
+            print(f"audio latency ({method}): median {latency:.2f} ms, min "
+                  f"{min(latencies):.2f}, max {max(latencies):.2f}, stored in {audio.LATENCY_FILE}")
+            text_line(f"Audio latency: {latency:.1f} ms").present()
+        else:
+            print("audio latency: no click detected in the recording of the loopback device")
+            text_line("Audio latency: no click detected").present()
+        exp.clock.wait(2000)
      
 #INSTRUCTIONS  
-elif not (splash_screen is None):
-    if op.splitext(splash_screen)[1] == '.csv':
-        instructions = csv.reader(io.open(splash_screen, 'r', encoding='utf-8'), delimiter='\t')
-        for instruction_line in instructions:
-            instruction_duration, stype, instruction_line = instruction_line[0], instruction_line[1], instruction_line[2]
-            if stype == 'box':
-                instruction_line = instruction_line.replace('\\n', '\n')                       
-                width_screen, height_screen =  exp.screen.size   
-                y = (-1*exp.screen.center_y)/2
-                instruction = stimuli.TextBox(instruction_line, 
-                                              position=(0, -230), 
-                                              size=(int(width_screen), int(height_screen)),
-                                              text_font=TEXT_FONT,
-                                              text_size=TEXT_SIZE,
-                                              text_colour=TEXT_COLOR,
-                                              background_colour=BACKGROUND_COLOR)
-                instruction.preload()
-                instruction.present()
-                #exp.clock.wait(WORD_DURATION*10)
-                exp.clock.wait(int(instruction_duration))
-                #fs.present()
-                #exp.clock.wait(WORD_ISI*6)
-            elif stype == 'text':
-                #instruction_line = instruction_line.replace('\BL', '\n')
-                instruction = stimuli.TextLine(instruction_line,
-                                              text_font=TEXT_FONT,
-                                              text_size=TEXT_SIZE,
-                                              text_colour=TEXT_COLOR,
-                                              background_colour=BACKGROUND_COLOR)
-                instruction.preload()
-                instruction.present()
-                #exp.clock.wait(WORD_DURATION*10)
-                exp.clock.wait(int(instruction_duration))
-                #fs.present()
-                #exp.clock.wait(WORD_ISI*6)
-            elif stype == 'sound':
-                bp = op.dirname(splash_screen)
-                if not(STIM_DIR==''):
-                    bp = op.join(bp, STIM_DIR)
-                instruction = stimuli.Audio(op.join(bp, instruction_line))
-                instruction.preload()
-                instruction.present()
-                fs.present()  
-                exp.clock.wait(int(instruction_duration))
-            elif stype == 'pict':
-                bp = op.dirname(splash_screen)
-                if not(STIM_DIR==''):
-                    bp = op.join(bp, STIM_DIR)
-                instruction = stimuli.Picture(op.join(bp, instruction_line))
-                instruction.preload()
-                instruction.present()
-                exp.clock.wait(int(instruction_duration))                      
+def text_box(text):
+    width_screen, height_screen = exp.screen.size
+    stim = stimuli.TextBox(text.replace('\\n', '\n'),
+                           position=(0, -230),
+                           size=(int(width_screen), int(height_screen)),
+                           text_font=TEXT_FONT,
+                           text_size=TEXT_SIZE,
+                           text_colour=TEXT_COLOR,
+                           background_colour=BACKGROUND_COLOR)
+    stim.preload()
+    return stim
+
+
+def load_instructions(splash_screen, pool=None):
+    """ compiles the schedule of an instructions file and loads all its stimuli
+
+    returns the schedule and the list of the stimuli of its events
+    """
+    with startup.phase('schedule'):
+        schedule = timeline.load_instructions(splash_screen, merge=MERGE_SCREENS)
+    with startup.phase('stimuli'):
+        bp = instructions_dir(splash_screen)
+        assets = schedule.assets()
+        stimtables = preload.load_assets([asset for asset in assets if asset[0] != 'box'], bp,
+                                         text_line, workers=PRELOAD_WORKERS, pool=pool)
+        stimtables['box'] = {id: text_box(id) for kind, id in assets if kind == 'box'}
+        stimtables['fs'] = {'fs': fs}
+        stims = [stimtables[kind][id] for kind, id in zip(schedule.kinds, schedule.ids)]
+    return schedule, stims
+
+
+def instructions_dir(splash_screen):
+    """ directory of the stimuli files of an instructions file """
+    bp = op.dirname(splash_screen)
+    if not(STIM_DIR==''):
+        bp = op.join(bp, STIM_DIR)
+    return bp
+
+
+def show_instructions(splash_screen, subject=None, datafile=None, pool=None):
+    """ presents the instructions file (or a picture, until space is pressed)
+
+    The items of the csv file are all loaded beforehand, then presented at
+    their absolute onsets and logged like the events of a run (see
+    run_session for `datafile`).
+    returns the name of the xpd file (None for a picture)
+    """
+    if op.splitext(splash_screen)[1] != '.csv':
+        splashs = stimuli.Picture(splash_screen)
+        settle()
+        splashs.present()
+        ready()
+        kb.wait_char(' ')
+        return None
+
+    schedule, stims = load_instructions(splash_screen, pool)
+    refresh_period = measure_refresh_period()
+    datafile, standalone, log, info = start_data(schedule, subject, datafile, splash_screen)
+    capture = inputs.InputCapture(kb, log, device=INPUT_DEVICE)
+
+    settle()
+    ready()
+    a = scheduler.MonotonicClock()
+    capture.start_clock(a, trigger=False)
+    timer = present(schedule, stims, a, capture, log, refresh_period)
+    while a.time < schedule.end:
+        capture.poll()
+        a.wait(5)
+    capture.close()
+
+    end_data(datafile, standalone, log, info, timer)
+    if standalone:
+        expyriment.control.end('', 0)
+    return datafile
+
+
+def measure_refresh_period():
+    """ refresh period of the display for the hybrid scheduler (None otherwise) """
+    if SCHEDULER != 'hybrid':
+        return None
+    refresh_period = scheduler.measure_refresh_period(exp.screen.update, scheduler.MonotonicClock())
+    print(f"display refresh period: {refresh_period} ms")
+    return refresh_period
+
+
+def start_data(schedule, subject, datafile, source):
+    """ opens the data of a session, `source` being the csv file presented
+
+    returns (datafile, standalone, log, info), the events and keys being
+    streamed to log
+    """
+    info = dict(subject=subject, csv_file=source, date=datetime.datetime.now().isoformat(),
+                host=socket.gethostname(), options=timing_options())
+    if datafile is None:
+        exp.add_experiment_info(source)
+        exp.add_experiment_info(f"host: {info['host']}")
+        exp.add_experiment_info(f"options: {json.dumps(info['options'])}")
+        exp.add_data_variable_names(datalog.VARIABLE_NAMES)
+        expyriment.control.start(skip_ready_screen=True, subject_id=subject)
+        datafile = exp.data.fullpath
+        standalone = True
+    else:
+        standalone = False
+    log = datalog.StreamLog(op.splitext(datafile)[0] + '.stream', schedule, info=info)
+    return datafile, standalone, log, info
+
+
+def present(schedule, stims, clock, capture, log, refresh_period, full_cost=None):
+    """ presents the events of a schedule; returns their instrumentation.EventTimer
+
+    full_cost: duration (ms) of a full screen update, reported with --dirty-rects
+    """
+    window = stims if isinstance(stims, assetwindow.AssetWindow) else None
+    services = [capture.poll]
+    if window is not None:
+        window.clock = clock
+        services.append(window.service)
+    dirty = None
+    if DIRTY_RECTS:
+        if dirtyrects.available(exp.screen):
+            dirty = stims = dirtyrects.DirtyRects(stims, schedule, exp.screen, BACKGROUND_COLOR,
+                                                  full_cost=full_cost)
         else:
-            splashs = stimuli.Picture(splash_screen)
-            splashs.present()
-            kb.wait_char(' ')
-            
+            print("--dirty-rects: the display uses OpenGL, the screen is updated as a whole")
+    videos = 'video' in schedule.kinds and videostream.available()
+    if videos:
+        videostream.PLAYER.setup(clock, log, schedule)
+        services.append(videostream.PLAYER.service)
+
+    if len(services) > 1:
+        def poll():
+            for service in services:
+                service()
+    else:
+        poll = capture.poll
+
+    offsets = None
+    if AUDIO_LATENCY:
+        print(f"audio latency of this machine: {AUDIO_LATENCY:.2f} ms")
+        offsets = dict(sound=AUDIO_LATENCY)
+    if SCHEDULER == 'hybrid':
+        sched = scheduler.HybridScheduler(clock, poll, refresh_period=refresh_period,
+                                          offsets=offsets)
+    else:
+        sched = scheduler.LegacyScheduler(clock, poll, offsets=offsets)
+    timer = instrumentation.EventTimer(schedule)
+    runloop.present_schedule(schedule, stims, clock, sched, timer, log, poll)
+    close_audio()
+    if videos:
+        videostream.PLAYER.finish()
+        videostream.PLAYER.report()
+    if window is not None:
+        window.close()
+        window.report()
+    if dirty is not None:
+        dirty.report(schedule.merged)
+    elif schedule.merged:
+        print(f"{schedule.merged} redundant flips skipped")
+    return timer
+
+
+def close_audio():
+    """ closes the output stream of the sounds of the run (pcm engine) """
+    global audio_output
+    if audio_output is not None:
+        while audio_output.playing():   # let the last sound finish
+            exp.clock.wait(10)
+        audio_output.report()
+        audio_output.close()
+        audio_output = None
+
+
+def end_data(datafile, standalone, log, info, timer):
+    """ reports the timing and writes the data of a session (see start_data) """
+    timer.report()
+    timer.save(op.splitext(datafile)[0] + '_timing')
+    if standalone:
+        for row in log.rows():
+            exp.data.add(row)
+    else:
+        datalog.write_xpd(datafile, log.rows(), info)
+
+
 #LAUNCH ONE SESSION            
-else:    
+def load_run(csv_file, pool=None):
+    """ compiles the schedule of a run and loads its stimuli
+
+    pool: preload.AssetPool keeping the stimuli across runs (None for a single run)
+    returns the schedule and the list of the stimuli of its events (an
+    assetwindow.AssetWindow with --stream-assets)
+    """
+    schedule = timeline.Schedule()
+    if csv_file:
+        with startup.phase('schedule'):
+            schedule = timeline.load_schedule(csv_file, timing_options())
+    with startup.phase('stimuli'):
+        stims = load_stimuli(csv_file, schedule, pool)
+    return schedule, stims
+
+
+def load_stimuli(csv_file, schedule, pool=None):
+    """ loads the stimuli of the events of a run (see load_run) """
+    global audio_output
+    stimtables = {'sound': dict(), 'picture': dict(), 'video': dict(), 'text': dict()}
+    if csv_file:
+        assets = schedule.assets()
+        loaded = dict(blank={'blank': bs}, fs={'fs': fs})
+        if AUDIO_ENGINE == 'pcm':
+            audio_output, loaded['sound'] = audio.load_sounds(
+                op.dirname(csv_file), [id for kind, id in assets if kind == 'sound'],
+                AUDIO_BUFFER or 128, AUDIO_DEVICE)
+            assets = [(kind, id) for kind, id in assets if kind != 'sound']
+        textcache = None
+        make_text = text_line
+        if RENDER_CACHE_SIZE > 0:
+            textcache = render_cache.RenderCache(TEXT_FONT, TEXT_SIZE, TEXT_COLOR,
+                                                 BACKGROUND_COLOR, exp.screen.size,
+                                                 max_bytes=RENDER_CACHE_SIZE * 1024 * 1024)
+            make_text = textcache.text_line
+        if STREAM_ASSETS:
+            if textcache is not None:
+                textcache.prune()
+            window = assetwindow.AssetWindow(schedule, op.dirname(csv_file), make_text,
+                                             loaded,
+                                             budget=ASSET_BUDGET * assetwindow.MB,
+                                             lookahead=LOOKAHEAD)
+            window.prime()
+            return window
+        stimtables = preload.load_assets(assets, op.dirname(csv_file),
+                                         make_text, workers=PRELOAD_WORKERS, pool=pool)
+        stimtables.update(loaded)
+        if textcache is not None:
+            print(f"text render cache: {textcache.hits} hits, {textcache.misses} misses")
+            textcache.prune()
+
+    # resolve the stimulus of every event once, so that the loop only indexes lists
+    stimtables.update(blank={'blank': bs}, fs={'fs': fs})
+    return [stimtables[kind][id] for kind, id in zip(schedule.kinds, schedule.ids)]
+
+
+def run_session(schedule, stims, subject, datafile=None):
+    """ presents a run, from the scanner trigger to the end of --total-duration
+
+    datafile: None in a standalone run, where expyriment writes the xpd file
+    and ends the experiment; otherwise the xpd file is written by the
+    function and the display is kept open (see runner.py).
+    returns the name of the xpd file
+    """
     wm = stimuli.TextLine('Waiting for scanner sync (or press \'t\')',
                           text_font=TEXT_FONT,
                           text_size=TEXT_SIZE,
                           text_colour=TEXT_COLOR,
                           background_colour=BACKGROUND_COLOR)
-    fs = stimuli.FixCross(size=(25, 25), line_width=3, colour=TEXT_COLOR)
-    
-    events = PriorityQueue()  # all stimuli will be queued here
-    
-    # load stimuli
-    mapsounds = dict()
-    mapspeech = dict()
-    maptext = dict()
-    mappictures = dict()
-    mapvideos = dict()
-    if csv_file:
-        exp.add_experiment_info(csv_file)
-        stimlist = csv.reader(io.open(csv_file, 'r', encoding='utf-8-sig'),\
-                                delimiter='\t')
-        bp = op.dirname(csv_file)
-        for row in stimlist:
-            cond, onset, stype, f = row[0], int(row[1]), row[2], row[3]
-            if stype == 'sound':
-                if not f in mapsounds:
-                    mapsounds[f] = stimuli.Audio(op.join(bp, f))
-                    mapsounds[f].preload()
-                events.put((onset, cond, 'sound', f, mapsounds[f]))
-            elif stype == 'picture':
-                if not f in mappictures:
-                    mappictures[f] = stimuli.Picture(op.join(bp, f))
-                    mappictures[f].preload()
-                events.put((onset, cond, 'picture', f, mappictures[f]))
-                events.put((onset + PICTURE_DURATION, cond, 'blank', 'blank', bs))
-            elif stype == 'video':
-                if not f in mapvideos:
-                    mapvideos[f] = stimuli.Video(op.join(bp, f))
-                    mapvideos[f].preload()
-                events.put((onset, cond, 'video', f, mapvideos[f]))
-            elif stype == 'text':
-                if not f in maptext:
-                    maptext[f] = stimuli.TextLine(f,
-                                                  text_font=TEXT_FONT,
-                                                  text_size=TEXT_SIZE,
-                                                  text_colour=TEXT_COLOR,
-                                                  background_colour=BACKGROUND_COLOR)
-                    maptext[f].preload()
-                events.put((onset, cond, 'text', f, maptext[f]))
-                events.put((onset + TEXT_DURATION, cond, 'blank', 'blank', fs))
-            elif stype == 'rsvp':
-                for i, w in enumerate(f.split(','), start=0):
-                    if not w in maptext:
-                        maptext[w] = stimuli.TextLine(w,
-                                                      text_font=TEXT_FONT,
-                                                      text_size=TEXT_SIZE,
-                                                      text_colour=TEXT_COLOR,
-                                                      background_colour=BACKGROUND_COLOR)
-                        maptext[w].preload()
-                    compute_onset = onset + i * (WORD_DURATION + WORD_ISI)
-                    events.put((compute_onset, cond, 'text', w, maptext[w]))
-                    if not (WORD_ISI == 0):
-                        compute_onset = onset + i * (WORD_DURATION + WORD_ISI) + WORD_DURATION
-                        events.put((compute_onset, cond, 'blank', 'blank', bs))
-                if WORD_ISI == 0:
-                    compute_onset = onset + i * (WORD_DURATION + WORD_ISI) + WORD_DURATION
-                    events.put((compute_onset, cond, 'blank', 'blank', bs))
-                compute_onset = onset + i * (WORD_DURATION + WORD_ISI) + WORD_DURATION + FS_DELAY
-                events.put((compute_onset, cond, 'fs', 'fs', fs))
-            elif stype == 'pictseq':
-                for i, p in enumerate(f.split(',')):
-                    if not p in mappictures:
-                        mappictures[p] = stimuli.Picture(op.join(bp, p))
-                        mappictures[p].preload()
-                    compute_onset = onset + i * (PICTURE_DURATION + PICTURE_ISI)
-                    events.put((compute_onset, cond, 'picture', p, mappictures[p]))
-                    if not (PICTURE_ISI == 0):
-                        compute_onset = onset + i * (PICTURE_DURATION + PICTURE_ISI) + PICTURE_DURATION
-                        events.put((compute_onset, cond, 'blank', 'blank', bs))
-                if PICTURE_ISI == 0:  # then erase the last picture
-                    compute_onset = onset + i * (PICTURE_DURATION + PICTURE_ISI) + PICTURE_DURATION
-                    events.put((compute_onset, cond, 'blank', 'blank', bs))
-                compute_onset = onset + i * (PICTURE_DURATION + PICTURE_ISI) + PICTURE_DURATION + FS_DELAY
-                events.put((compute_onset, cond, 'fs', 'fs', fs))
     
-    exp.add_data_variable_names([ 'condition', 'time', 'stype', \
-                                 'id', 'target_time'])
+    refresh_period = measure_refresh_period()
 
     #######################################################################
 
-    expyriment.control.start(skip_ready_screen=True, subject_id=SUBJECT)
-    
+    datafile, standalone, log, info = start_data(schedule, subject, datafile, csv_file)
+    basename = op.splitext(datafile)[0]
+    capture = inputs.InputCapture(kb, log, device=INPUT_DEVICE)
+
+    full_cost = dirtyrects.full_present_cost(wm) if DIRTY_RECTS else None
+    settle()
     wm.present()
-    kb.wait_char('t')  # wait for scanner TTL
+    ready()
+    trigger = capture.wait_for_trigger()  # wait for scanner TTL
+    a = scheduler.MonotonicClock(origin=trigger)
+    if SCANNER_TR is not None:
+        # follow the scanner: all the times of the run are in scanner time
+        a = scannerclock.ScannerClock(a, SCANNER_TR)
+        capture.on_trigger = a.add_pulse
+    capture.start_clock(a)
     fs.present()  # clear screen, presenting fixation cross
-    
-    a = Clock()
-    
-    while not(events.empty()):
-        onset, cond, stype, id, stim = events.get()
-        while a.time < (onset - 10):
-            a.wait(1)
-            k = kb.check()
-            if k is not None:
-                exp.data.add(["keypressed", a.time, k])
-        stim.present()
-        
-        exp.data.add([cond, a.time, stype, id, onset])
-
-        k = kb.check()
-        if k is not None:
-            exp.data.add(["keypressed", a.time, k])
+
+    timer = present(schedule, stims, a, capture, log, refresh_period, full_cost)
     
     fs.present()
     if TOTAL_EXPE_DURATION != -1:
         while a.time < TOTAL_EXPE_DURATION:
-            kb.process_control_keys()
-            a.wait(100)
-       
-    expyriment.control.end('Merci !', 2000)
+            capture.poll()
+            a.wait(5)
+    capture.close()
+    print(f"{len(capture.triggers)} scanner triggers received")
+    if SCANNER_TR is not None:
+        a.report()
+        a.save(basename + '_scanner.tsv')
+
+    end_data(datafile, standalone, log, info, timer)
+    if standalone:
+        expyriment.control.end('Merci !', 2000)
+    else:
+        text_line('Merci !').present()
+    return datafile
+
+
+def validate(dry_run=False):
+    """ checks the run or instructions file without opening the display
+
+    With dry_run, the run is then presented on the stand-ins of simulate.py.
+    returns the exit status
+    """
+    source = csv_file or splash_screen
+    if source is None or op.splitext(source)[1] != '.csv':
+        print("--validate and --dry-run need a csv file (--csv_file or --splash)")
+        return 1
+    with startup.phase('schedule'):
+        try:
+            if csv_file:
+                schedule = timeline.load_schedule(csv_file, timing_options())
+                bp = op.dirname(csv_file)
+            else:
+                schedule = timeline.load_instructions(splash_screen, merge=MERGE_SCREENS)
+                bp = instructions_dir(splash_screen)
+        except (OSError, ValueError, IndexError) as e:
+            print(f"{source}: {e}")
+            return 1
+    problems = []
+    with startup.phase('stimuli files'):
+        assets = schedule.assets()
+        for kind, id in assets:
+            path = op.join(bp, id)
+            if kind in ('sound', 'picture', 'video') and not op.exists(path) \
+                    and stimpack.find(path) is None:
+                problems.append(f"{kind} {path} not found")
+    if TOTAL_EXPE_DURATION != -1 and schedule.onsets and schedule.onsets[-1] >= TOTAL_EXPE_DURATION:
+        problems.append(f"events after --total-duration ({schedule.onsets[-1]} ms)")
+    if not op.exists(op.join('fonts', TEXT_FONT)):
+        print(f"warning: font {TEXT_FONT} is not in fonts/, it must be installed on the system")
+    print(f"{source}: {len(schedule)} events, {len(assets)} distinct stimuli, "
+          f"last onset at {schedule.onsets[-1] if schedule.onsets else 0} ms"
+          + (f", {schedule.merged} redundant flips skipped" if schedule.merged else ""))
+    for problem in problems:
+        print(f"  {problem}")
+
+    if dry_run and not problems:
+        import simulate
+        with startup.phase('dry run'):
+            result = simulate.simulate_run(source, timing_options(), SCHEDULER, schedule=schedule)
+        print(f"dry run: {result['flips']} flips, "
+              f"{1000 * result['wall']:.0f} ms of presentation loop")
+        result['timer'].report()
+    if PROFILE_STARTUP:
+        startup.report('done')
+    return 1 if problems else 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv)
+    if args.validate or args.dry_run:
+        configure(args)
+        return validate(args.dry_run)
+    if args.session:
+        import runner
+        return runner.session(argv, args, check_environment())
+
+    with startup.phase('configuration'):
+        subject = check_environment()
+        configure(args)
+    with startup.phase('expyriment'):
+        import_backend()
+    with startup.phase('display'):
+        initialize()
+
+    ##############################
+    # START PROTOCOL
+
+    if not (calibration is None) :
+        settle()
+        ready()
+        calibrate()
+    elif not (splash_screen is None):
+        show_instructions(splash_screen, subject)
+    else:
+        schedule, stims = load_run(csv_file)
+        run_session(schedule, stims, subject)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
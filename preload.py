@@ -0,0 +1,152 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Concurrent loading of the stimuli of a run.
+
+The unique sound, picture and video files referenced by a schedule are read
+and decoded by a pool of worker threads (file reading, wav and bmp decoding
+release the GIL). The decoded buffers are then handed over to the expyriment
+stimuli on the main thread, which is the only one allowed to touch the
+display. Text stimuli are rendered on the main thread while the workers run.
+"""
+
+import io
+import os
+import os.path as op
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import videostream
+import stimpack
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def decode(kind, path):
+    """ reads and decodes one file (or takes it from the stimuli archive of its
+    directory); returns (payload, duration in s) """
+    import pygame
+    start = time.perf_counter()
+    packed = stimpack.find(path) if kind in ('sound', 'picture') else None
+    if packed is not None:
+        pack, name = packed
+        payload = pack.sound(name) if kind == 'sound' else pack.surface(name)
+    elif kind == 'sound':
+        payload = pygame.mixer.Sound(file=io.BytesIO(_read(path)))
+    elif kind == 'picture':
+        payload = pygame.image.load(io.BytesIO(_read(path)), op.basename(path))
+    else:
+        _read(path)   # videos are decoded during playback: only warm the file cache
+        payload = None
+    return payload, time.perf_counter() - start
+
+
+def attach(kind, path, payload):
+    """ creates the expyriment stimulus of a decoded file (main thread only) """
+    from expyriment import stimuli
+    if kind in ('sound', 'picture') and stimpack.find(path) is not None:
+        stim = stimpack.stimulus(kind, payload)
+    elif kind == 'sound':
+        import pygame
+        stim = stimuli.Audio(path)
+        # the whole state set by Audio.preload(), from the decoded sound
+        stim._file = payload
+        stim._length = payload.get_length()
+        stim._sound_array = pygame.sndarray.array(payload)
+        stim._is_preloaded = True
+    elif kind == 'picture':
+        stim = stimuli.Picture(path)
+        stim._set_surface(payload)
+        stim.preload()
+    elif videostream.available():
+        stim = videostream.VideoStimulus(path)
+        stim.preload()
+    else:
+        stim = stimuli.Video(path)
+        stim.preload()
+    return stim
+
+
+class AssetPool:
+    """ Stimuli kept loaded across runs.
+
+    Files can be decoded ahead, in background threads, with prefetch(); get()
+    then only has to create the stimulus on the main thread. Used by a single
+    run (load_assets) or kept alive by the runner between runs.
+    """
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = min(8, os.cpu_count() or 1)
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self._decoding = dict()   # (kind, path) -> future of (payload, duration)
+        self.stims = dict()       # (kind, path or text) -> stimulus
+        self.timings = []         # (kind, path, decoding duration in s)
+
+    def prefetch(self, assets, bp):
+        """ starts decoding the files of `assets` not loaded yet """
+        if self._executor is None:
+            return
+        for kind, id in assets:
+            key = (kind, op.join(bp, id))
+            if kind != 'text' and key not in self.stims and key not in self._decoding:
+                self._decoding[key] = self._executor.submit(decode, *key)
+
+    def get(self, kind, path):
+        """ returns the stimulus of a file (main thread only) """
+        key = (kind, path)
+        if key not in self.stims:
+            future = self._decoding.pop(key, None)
+            payload, duration = future.result() if future is not None else decode(kind, path)
+            self.stims[key] = attach(kind, path, payload)
+            self.timings.append((kind, path, duration))
+        return self.stims[key]
+
+    def text(self, text, make_text):
+        key = ('text', text)
+        if key not in self.stims:
+            self.stims[key] = make_text(text)
+        return self.stims[key]
+
+
+def load_assets(assets, bp, make_text, workers=None, verbose=True, pool=None):
+    """ loads the stimuli of a run
+
+    assets: (kind, id) pairs, as returned by Schedule.assets()
+    bp: directory of the stimuli files
+    make_text: function returning the preloaded stimulus of a text
+    workers: number of decoding threads (0 to decode on the main thread)
+    pool: AssetPool to take the stimuli from (a new one by default)
+
+    returns a dict kind -> {id: stimulus}
+    """
+    if pool is None:
+        pool = AssetPool(workers)
+    tables = {'sound': dict(), 'picture': dict(), 'video': dict(), 'text': dict()}
+    files = [(kind, id) for kind, id in assets if kind != 'text']
+    texts = [id for kind, id in assets if kind == 'text']
+
+    start = time.perf_counter()
+    ntimings = len(pool.timings)
+    pool.prefetch(files, bp)
+    t0 = time.perf_counter()
+    for text in texts:
+        tables['text'][text] = pool.text(text, make_text)
+    text_time = time.perf_counter() - t0
+    for kind, id in files:
+        tables[kind][id] = pool.get(kind, op.join(bp, id))
+    total = time.perf_counter() - start
+    timings = pool.timings[ntimings:]
+
+    if verbose:
+        for kind, path, duration in timings:
+            print(f"  loaded {kind:8s} {op.basename(path):30s} {1000 * duration:7.1f} ms")
+        print(f"  rendered {len(texts)} texts in {1000 * text_time:.1f} ms")
+        print(f"loaded {len(files)} files ({len(timings)} decoded) and {len(texts)} texts "
+              f"in {1000 * total:.1f} ms ({pool.workers} workers, "
+              f"{1000 * sum(t[2] for t in timings):.1f} ms of decoding)")
+    return tables
@@ -0,0 +1,128 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Persistent cache of pre-rendered text surfaces.
+
+Rasterising the words of the rsvp/text stimuli with the ttf fonts is the
+same work at every launch. The surfaces are therefore saved, uncompressed, in
+`cache/text/`, one file per stimulus, keyed by a hash of the text, the font
+file (its content, not only its name), the size, the colours and the display
+resolution. Any change of one of these simply yields a new key.
+
+The cache is bounded in size: after each run the least recently used entries
+are removed until it fits in `max_bytes`.
+"""
+
+import os
+import os.path as op
+import hashlib
+import struct
+
+
+CACHE_VERSION = 1
+CACHE_DIR = op.join('cache', 'text')
+MAX_BYTES = 64 * 1024 * 1024
+
+_HEADER = struct.Struct('<4sHHII')   # magic, version, (unused), width, height
+_MAGIC = b'PLRC'
+
+
+def _font_digest(font):
+    """ hash of the font file, so that editing a font invalidates its entries """
+    try:
+        with open(font, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except (OSError, TypeError):
+        return str(font)   # system font: rely on its name
+
+
+class RenderCache:
+    def __init__(self, font, size, colour, background, resolution,
+                 cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+        import pygame
+        from expyriment.misc import find_font
+        self._pygame = pygame
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.font, self.size = font, size
+        self.colour, self.background = tuple(colour), tuple(background)
+        self._salt = repr((CACHE_VERSION, pygame.version.ver,
+                           _font_digest(find_font(font)), size, self.colour,
+                           self.background, tuple(resolution)))
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, text):
+        key = hashlib.sha256((self._salt + '\0' + text).encode('utf-8')).hexdigest()
+        return op.join(self.cache_dir, key[:2], key + '.surf')
+
+    def load(self, text):
+        """ returns the cached surface of `text`, or None """
+        path = self._path(text)
+        try:
+            with open(path, 'rb') as f:
+                magic, version, _, w, h = _HEADER.unpack(f.read(_HEADER.size))
+                data = f.read()
+        except (OSError, struct.error):
+            return None
+        if magic != _MAGIC or version != CACHE_VERSION or len(data) != w * h * 4:
+            return None
+        try:
+            os.utime(path)   # mark as recently used
+        except OSError:
+            pass
+        return self._pygame.image.frombuffer(data, (w, h), 'RGBA')
+
+    def store(self, text, surface):
+        path = self._path(text)
+        w, h = surface.get_size()
+        tobytes = getattr(self._pygame.image, 'tobytes', None) or self._pygame.image.tostring
+        try:
+            os.makedirs(op.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(_HEADER.pack(_MAGIC, CACHE_VERSION, 0, w, h))
+                f.write(tobytes(surface, 'RGBA'))
+            os.replace(path + '.tmp', path)
+        except OSError:
+            pass   # a read-only install just runs without cache
+
+    def text_line(self, text):
+        """ returns a preloaded stimuli.TextLine, rendered from the cache if possible """
+        from expyriment import stimuli
+        stim = stimuli.TextLine(text,
+                                text_font=self.font,
+                                text_size=self.size,
+                                text_colour=self.colour,
+                                background_colour=self.background)
+        surface = self.load(text)
+        if surface is not None:
+            self.hits += 1
+        else:
+            surface = stim._get_surface()   # renders the text
+            self.store(text, surface)
+            self.misses += 1
+        stim._set_surface(surface)   # preload() then only makes the texture, without rendering again
+        stim.preload()
+        return stim
+
+    def prune(self):
+        """ removes the least recently used entries until the cache fits in max_bytes """
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = op.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        return total
@@ -0,0 +1,342 @@
+#! /usr/bin/env python3
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Generation of new run files optimised for the efficiency of the design.
+
+An existing run file is taken as a template: its trials (condition, stype
+and stimuli of each row) are kept, but their order and the intervals between
+their onsets are drawn again, and the candidates are scored by the
+efficiency of the design matrix of a GLM for the contrasts of the localizer
+(CONTRASTS), the best ones being written as new run files:
+
+    python rundesign.py --template french/run1_pinel_localizer.csv --n 4
+
+Candidates:
+
+- the trials are permuted, with at most --max-repeat consecutive trials of
+  the same condition (by default, as many as in the template);
+- each interval between two onsets is the minimum SOA of the first trial
+  (the largest of --min-soa and the duration of its stimuli) plus a random
+  number of --grid ms steps; the run keeps the duration of the template.
+
+Score: the events of each condition are boxcars of the duration of their
+stimuli, convolved with the canonical (SPM) HRF and sampled every --tr ms;
+together with a constant and a cosine high-pass basis (128 s), they form the
+design matrix X, and the efficiency is 1 / mean(c (X'X)^-1 c') over the
+contrasts c. The regressors of a whole batch of candidates are computed at
+once with NumPy (`pip install numpy`): the HRF responses of the trials are
+tabulated beforehand, so that a regressor is only a gather and a sum.
+
+The search is split into tasks run by a process pool (--jobs): each task
+draws random candidates, then mutates (swaps two trials, moves a step of
+jitter) the best ones for --rounds rounds.
+"""
+
+import os
+import os.path as op
+import sys
+import re
+import csv
+import math
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import timeline
+import stimpack
+import simulate
+
+
+# contrasts of the localizer: name -> {condition: weight}
+CONTRASTS = {
+    'auditory - visual': dict(calculaudio=.25, clicGaudio=.25, clicDaudio=.25, phraseAudio=.25,
+                              calculvideo=-.25, clicGvideo=-.25, clicDvideo=-.25, phraseVideo=-.25),
+    'left - right click': dict(clicGaudio=.5, clicGvideo=.5, clicDaudio=-.5, clicDvideo=-.5),
+    'computation - sentences': dict(calculaudio=.5, calculvideo=.5, phraseAudio=-.5, phraseVideo=-.5),
+    'reading - checkerboards': dict(phraseVideo=1, CboardH=-.5, CboardV=-.5),
+    'horizontal - vertical checkerboards': dict(CboardH=1, CboardV=-1),
+    'clicks - computation and sentences': dict(clicGaudio=.25, clicGvideo=.25, clicDaudio=.25,
+                                               clicDvideo=.25, calculaudio=-.25, calculvideo=-.25,
+                                               phraseAudio=-.25, phraseVideo=-.25),
+}
+
+DT = 100              # resolution (ms) of the HRF responses
+HRF_LENGTH = 32000    # ms
+HIGH_PASS = 128000    # period (ms) of the slowest drift kept in the data
+TAIL = 12000          # ms scanned after the end of the last trial
+
+
+def hrf(dt=DT, length=HRF_LENGTH):
+    """ canonical SPM HRF (peak at 6 s, undershoot at 16 s) sampled every `dt` ms """
+    import numpy as np
+    t = np.arange(0, length, dt) / 1000.0
+    h = (t ** 5 * np.exp(-t) / math.gamma(6)
+         - t ** 15 * np.exp(-t) / (6 * math.gamma(16)))
+    return h / h.sum()
+
+
+def cosine_drifts(n, tr, high_pass=HIGH_PASS):
+    """ (n, k) cosine basis of the drifts slower than `high_pass` ms, for n scans """
+    import numpy as np
+    k = np.arange(1, int(2 * n * tr / high_pass) + 1)
+    return np.cos(np.pi * np.outer(np.arange(n) + 0.5, k) / n)
+
+
+def trial_duration(row, bp, options):
+    """ duration (ms) of the stimuli of a row of a run file: that of the sound,
+    or until the last blank screen of its events """
+    onset, stype = int(row[1]), row[2]
+    if stype == 'sound':
+        return stimpack.duration(op.join(bp, row[3]))
+    blanks = [e[0] for e in timeline.expand_rows([row], **options) if e[2] == 'blank']
+    return max(blanks) - onset if blanks else 0
+
+
+def max_repeat(conds):
+    """ length of the longest series of consecutive identical conditions """
+    longest = current = 0
+    for i, cond in enumerate(conds):
+        current = current + 1 if i > 0 and cond == conds[i - 1] else 1
+        longest = max(longest, current)
+    return longest
+
+
+class Design:
+    """ Trials of a template run and scoring of their reorderings
+
+    A candidate is (order, slack): order[t] is the trial presented at
+    position t, slack[t] the number of grid steps added to its minimum SOA.
+    Batches of candidates are 2-D arrays, one candidate per row.
+    """
+
+    def __init__(self, rows, bp, options, tr=2000, grid=300, min_soa=None, repeat=None):
+        import numpy as np
+        self.rows = rows
+        self.tr = tr
+        self.grid = grid
+        onsets = [int(row[1]) for row in rows]
+        names = [row[0] for row in rows]
+        self.names = sorted(set(names))
+        self.conds = np.array([self.names.index(name) for name in names])
+        self.durations = np.array([trial_duration(row, bp, options) for row in rows])
+        if min_soa is None:
+            min_soa = min(b - a for a, b in zip(onsets, onsets[1:]))
+        # minimum SOA of each trial, rounded up to the grid
+        soa = np.maximum(min_soa, self.durations + grid)
+        self.min_soa = -(-soa // grid) * grid
+        self.end = onsets[-1] + int(self.min_soa[-1])
+        self.steps = (self.end - int(self.min_soa.sum())) // grid
+        if self.steps < 0:
+            raise ValueError(f"the trials do not fit in the {self.end} ms of the template")
+        self.repeat = repeat or max_repeat(names)
+
+        # responses of the trials, with a last column of zeros for the samples
+        # outside of them
+        h = hrf()
+        length = len(h) + int(self.durations.max()) // DT
+        self.responses = np.zeros((len(rows), length + 1))
+        for i, duration in enumerate(self.durations):
+            boxcar = np.ones(max(1, int(duration) // DT))
+            response = np.convolve(boxcar, h)
+            self.responses[i, :len(response)] = response
+
+        # scan times, confounds (constant and cosine drifts) and contrasts
+        self.scans = np.arange(0, self.end + TAIL, tr)
+        n = len(self.scans)
+        self.confounds = np.hstack([np.ones((n, 1)), cosine_drifts(n, tr)])
+        self.contrast_names = [name for name, weights in CONTRASTS.items()
+                               if set(weights) <= set(self.names)]
+        self.contrasts = np.zeros((len(self.contrast_names), len(self.names) + self.confounds.shape[1]))
+        for q, name in enumerate(self.contrast_names):
+            for cond, weight in CONTRASTS[name].items():
+                self.contrasts[q, self.names.index(cond)] = weight
+
+    def template(self):
+        """ the template as a candidate (its jitter rounded down to the grid) """
+        import numpy as np
+        onsets = np.array([int(row[1]) for row in self.rows] + [self.end])
+        slack = (np.diff(onsets) - self.min_soa) // self.grid
+        slack[-1] += self.steps - slack.sum()
+        return np.arange(len(self.rows))[None, :], slack[None, :]
+
+    def random(self, rng, n):
+        """ n random candidates """
+        import numpy as np
+        orders = np.argsort(rng.random((n, len(self.rows))), axis=1)
+        slack = rng.multinomial(self.steps, rng.dirichlet(np.ones(len(self.rows)), n))
+        return orders, slack
+
+    def mutate(self, rng, orders, slack, n):
+        """ n candidates, each made from one of `orders, slack` by swapping two
+        trials and moving one step of jitter """
+        import numpy as np
+        parents = rng.integers(len(orders), size=n)
+        orders, slack = orders[parents].copy(), slack[parents].copy()
+        rows = np.arange(n)
+        i, j = rng.integers(orders.shape[1], size=(2, n))
+        orders[rows, i], orders[rows, j] = orders[rows, j], orders[rows, i]
+        a, b = rng.integers(orders.shape[1], size=(2, n))
+        move = slack[rows, a] > 0
+        slack[rows[move], a[move]] -= 1
+        slack[rows[move], b[move]] += 1
+        return orders, slack
+
+    def onsets(self, orders, slack):
+        """ onsets (ms) of the trials at each position """
+        import numpy as np
+        soa = self.min_soa[orders] + self.grid * slack
+        return np.concatenate([np.zeros((len(orders), 1), soa.dtype),
+                               np.cumsum(soa[:, :-1], axis=1)], axis=1)
+
+    def feasible(self, orders):
+        """ whether the candidates have at most `repeat` consecutive trials of a condition """
+        seq = self.conds[orders]
+        same = seq[:, 1:] == seq[:, :-1]
+        run = same
+        for k in range(1, self.repeat):
+            run = run[:, :-1] & same[:, k:]
+        return ~run.any(axis=1)
+
+    def variances(self, orders, slack):
+        """ (candidates, contrasts) variances c (X'X)^-1 c' """
+        import numpy as np
+        onsets = self.onsets(orders, slack)
+        lag = (self.scans[None, None, :] - onsets[:, :, None]) // DT
+        outside = self.responses.shape[1] - 1
+        lag[(lag < 0) | (lag >= outside)] = outside
+        # (candidates, trials, scans) responses, summed per condition
+        responses = self.responses[orders[:, :, None], lag]
+        onehot = (self.conds[orders][:, None, :] == np.arange(len(self.names))[None, :, None])
+        task = onehot.astype(float) @ responses
+        X = np.concatenate([task.transpose(0, 2, 1),
+                            np.broadcast_to(self.confounds, (len(orders),) + self.confounds.shape)],
+                           axis=2)
+        M = X.transpose(0, 2, 1) @ X + 1e-9 * np.eye(X.shape[2])
+        C = self.contrasts
+        return np.einsum('qp,npq->nq', C, np.linalg.inv(M) @ C.T)
+
+    def efficiency(self, orders, slack):
+        """ efficiencies of the candidates (-inf for those which are not feasible) """
+        import numpy as np
+        scores = 1 / self.variances(orders, slack).mean(axis=1)
+        scores[~self.feasible(orders)] = -np.inf
+        return scores
+
+    def write(self, filename, order, slack):
+        """ writes a candidate as a run file """
+        onsets = self.onsets(order[None, :], slack[None, :])[0]
+        with open(filename, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            for trial, onset in zip(order, onsets):
+                row = list(self.rows[trial])
+                row[1] = str(int(onset))
+                writer.writerow(row)
+
+
+def best(scores, keep):
+    """ indices of the `keep` best scores, best first """
+    import numpy as np
+    top = np.argsort(scores)[::-1][:keep]
+    return top[np.isfinite(scores[top])]
+
+
+def search(design, seed, batch, rounds, keep):
+    """ a task of the search: returns the `keep` best (orders, slack, scores) """
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    orders, slack = design.random(rng, batch)
+    scores = design.efficiency(orders, slack)
+    top = best(scores, keep)
+    orders, slack, scores = orders[top], slack[top], scores[top]
+    for _ in range(rounds):
+        if len(orders):
+            children = design.mutate(rng, orders, slack, batch // 2)
+            fresh = design.random(rng, batch - batch // 2)
+            new = (np.concatenate([children[0], fresh[0]]), np.concatenate([children[1], fresh[1]]))
+        else:
+            new = design.random(rng, batch)
+        orders = np.concatenate([orders, new[0]])
+        slack = np.concatenate([slack, new[1]])
+        scores = np.concatenate([scores, design.efficiency(*new)])
+        top = best(scores, keep)
+        orders, slack, scores = orders[top], slack[top], scores[top]
+    return orders, slack, scores
+
+
+def next_runs(directory, n):
+    """ names of n run files following the existing ones of `directory` """
+    numbers = [int(m.group(1)) for m in (re.match(r'run(\d+)_pinel_localizer\.csv$', name)
+                                         for name in os.listdir(directory)) if m]
+    first = max(numbers, default=0) + 1
+    return [op.join(directory, f"run{i}_pinel_localizer.csv") for i in range(first, first + n)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--template', required=True, help="run file whose trials are reordered")
+    parser.add_argument('--n', type=int, default=4, help="number of run files to write")
+    parser.add_argument('--output-dir', help="directory of the new run files (default: that of the template)")
+    parser.add_argument('--candidates', type=int, default=200000, help="number of candidates to score")
+    parser.add_argument('--batch', type=int, default=500, help="candidates scored at once")
+    parser.add_argument('--rounds', type=int, default=20, help="rounds of mutation of each task")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument('--tr', type=int, default=2000, help="repetition time (ms)")
+    parser.add_argument('--grid', type=int, default=300, help="step (ms) of the onsets")
+    parser.add_argument('--min-soa', type=int, help="minimum SOA (ms), default: that of the template")
+    parser.add_argument('--max-repeat', type=int,
+                        help="maximum number of consecutive trials of a condition (default: as in the template)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    try:
+        import numpy as np
+    except ImportError:
+        print("rundesign.py needs NumPy: pip install numpy")
+        return 1
+
+    bp = op.dirname(args.template)
+    design = Design(timeline.read_rows(args.template), bp, simulate.DEFAULT_OPTIONS,
+                    args.tr, args.grid, args.min_soa, args.max_repeat)
+    print(f"{args.template}: {len(design.rows)} trials of {len(design.names)} conditions, "
+          f"{design.end} ms, {design.steps} steps of {design.grid} ms of jitter, "
+          f"contrasts: {', '.join(design.contrast_names)}")
+    reference = design.efficiency(*design.template())[0]
+
+    per_task = args.batch * (args.rounds + 1)
+    tasks = max(1, -(-args.candidates // per_task))
+    seeds = np.random.SeedSequence(args.seed).spawn(tasks)
+    keep = max(args.n, 8)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = list(executor.map(search, [design] * tasks, seeds, [args.batch] * tasks,
+                                    [args.rounds] * tasks, [keep] * tasks))
+    elapsed = time.perf_counter() - start
+    orders = np.concatenate([r[0] for r in results])
+    slack = np.concatenate([r[1] for r in results])
+    scores = np.concatenate([r[2] for r in results])
+    print(f"{tasks * per_task} candidates scored in {elapsed:.1f} s "
+          f"({tasks * per_task / elapsed:.0f}/s, {args.jobs} processes)")
+
+    # best distinct orders
+    chosen = []
+    for i in np.argsort(scores)[::-1]:
+        if len(chosen) == args.n:
+            break
+        if all((orders[i] != orders[j]).any() for j in chosen):
+            chosen.append(i)
+
+    names = next_runs(args.output_dir or bp, len(chosen))
+    per_contrast = 1 / design.variances(*design.template())[0]
+    print(f"template: efficiency {reference:.4g} ("
+          + ", ".join(f"{c} {e:.3g}" for c, e in zip(design.contrast_names, per_contrast)) + ")")
+    for name, i in zip(names, chosen):
+        design.write(name, orders[i], slack[i])
+        per_contrast = 1 / design.variances(orders[i:i + 1], slack[i:i + 1])[0]
+        print(f"{name}: efficiency {scores[i]:.4g}, {scores[i] / reference:.2f} x the template ("
+              + ", ".join(f"{c} {e:.3g}" for c, e in zip(design.contrast_names, per_contrast)) + ")")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
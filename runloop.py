@@ -0,0 +1,37 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+The presentation loop of a run.
+
+It only relies on the interfaces of its arguments (a clock with now() and
+time, stimuli with present(), a scheduler, a logging function), so that the
+same code drives the display in pinel_localizer.py and the stand-ins of
+simulate.py.
+"""
+
+
+def present_schedule(schedule, stims, clock, sched, timer, log, poll):
+    """ presents stims[i] at schedule.onsets[i], for every event of the schedule
+
+    clock: run clock, started at the scanner trigger
+    sched: scheduler (see scheduler.py)
+    timer: instrumentation.EventTimer
+    log: datalog.StreamLog (or ListLog) receiving the time and error of each event
+    poll: function called after each event (e.g. to read the keyboard)
+    """
+    onsets, stypes = schedule.onsets, schedule.stypes
+    now = clock.now
+    for i in range(len(stims)):
+        onset, stype = onsets[i], stypes[i]
+        sched.wait_until(onset, stype)
+        wake = now()
+        stim = stims[i]
+        start = now()
+        returned = stim.present()
+        end = now()
+        timer.record(i, wake, start, end, returned)
+        error = sched.presented(onset, stype, start, end)
+
+        log.event(i, end, error)
+
+        poll()
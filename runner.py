@@ -0,0 +1,270 @@
+#! /usr/bin/env python3
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Persistent runner of the localizer.
+
+Launching `python pinel_localizer.py ...` for the calibration, the
+instructions and each run means importing expyriment, opening the display,
+loading the fonts and loading the stimuli each time. The runner does this
+once, keeps the display open and the loaded stimuli in memory, and executes
+the commands sent by menu.py (started with `python menu.py --runner`) over a
+local socket:
+
+    python runner.py <options of pinel_localizer.py>
+
+The runner listens on a unix socket (on Windows, a free port of localhost)
+and only accepts the clients which know the random key it generates at
+launch. The address and the key are written to RUNTIME_FILE, in a directory
+only readable by the user, where connect() reads them.
+
+Each command carries the remaining options (e.g. `--csv_file
+french/run2_pinel_localizer.csv`) and the subject number. It may also name
+the run file that comes next: its stimuli are then decoded in the background
+while the end screen of the current run is displayed.
+
+Each run gets its own data/*.xpd file, as with pinel_localizer.py.
+
+`python pinel_localizer.py --session <run files> [--cali 1] [--splash
+<instructions file>] <options>` executes the calibration, the instructions
+and the runs in order, in its own process, with a Runner (session()). The
+stimuli of the next run are decoded in the background as soon as those of
+the current step are loaded, i.e. while the current step waits for the
+scanner trigger and plays, so that the next run is ready for the trigger as
+soon as the operator is.
+"""
+
+import os
+import os.path as op
+import sys
+import json
+import socket
+import datetime
+from multiprocessing.connection import Listener, Client, AuthenticationError
+
+
+RUNTIME_DIR = op.join(op.expanduser('~'), '.pinel_localizer')
+RUNTIME_FILE = op.join(RUNTIME_DIR, 'runner.json')   # address and key of the running runner
+
+# options of pinel_localizer.py naming the steps of a session
+SESSION_OPTIONS = ('--session', '--cali', '--splash', '--csv_file')
+
+
+def connect():
+    """ returns a connection to a running runner, or None """
+    try:
+        with open(RUNTIME_FILE) as f:
+            runtime = json.load(f)
+        address = runtime['address']
+        return Client(address if isinstance(address, str) else tuple(address),
+                      authkey=bytes.fromhex(runtime['authkey']))
+    except (OSError, ValueError, KeyError, AuthenticationError):
+        return None
+
+
+def listen():
+    """ opens the listener of the runner, with a random key; writes its
+    address and key to RUNTIME_FILE, readable by the user only """
+    os.makedirs(RUNTIME_DIR, mode=0o700, exist_ok=True)
+    os.chmod(RUNTIME_DIR, 0o700)
+    authkey = os.urandom(32)
+    if hasattr(socket, 'AF_UNIX'):
+        address = op.join(RUNTIME_DIR, 'runner.sock')
+        if op.exists(address):
+            os.remove(address)   # left by a runner which did not stop cleanly
+        listener = Listener(address, 'AF_UNIX', authkey=authkey)
+    else:
+        listener = Listener(('localhost', 0), authkey=authkey)
+    if op.exists(RUNTIME_FILE):
+        os.remove(RUNTIME_FILE)
+    fd = os.open(RUNTIME_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(dict(address=listener.address, authkey=authkey.hex()), f)
+    return listener
+
+
+def forget(listener):
+    """ removes the files of the listener """
+    address = listener.address
+    listener.close()
+    for path in (RUNTIME_FILE, address if isinstance(address, str) else None):
+        if path is not None and op.exists(path):
+            os.remove(path)
+
+
+def datafile_name(subject):
+    """ name of a new xpd file, created empty so that no later step takes it """
+    os.makedirs('data', exist_ok=True)
+    stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    for k in range(1, 1000):
+        name = op.join('data', f"Localizer_{subject:02d}_{stamp}" + (f"_{k}" if k > 1 else "") + ".xpd")
+        try:
+            open(name, 'x').close()
+            return name
+        except FileExistsError:
+            pass
+    raise FileExistsError(name)
+
+
+class Runner:
+    def __init__(self, base_argv):
+        import pinel_localizer
+        import preload
+        self.localizer = pinel_localizer
+        self.base_argv = list(base_argv)
+        pinel_localizer.configure(pinel_localizer.parser.parse_args(self.base_argv))
+        self.exp = pinel_localizer.initialize()
+        self.pool = preload.AssetPool(pinel_localizer.PRELOAD_WORKERS)
+        self.idle()
+
+    def idle(self):
+        self.localizer.bs.present()
+
+    def prefetch(self, csv_file):
+        """ starts decoding the stimuli files of a run in the background """
+        import timeline
+        if self.localizer.STREAM_ASSETS:
+            return   # the stimuli are loaded during the run, within a memory budget
+        if csv_file and op.exists(csv_file):
+            schedule = timeline.load_schedule(csv_file, self.localizer.timing_options())
+            assets = schedule.assets()
+            if self.localizer.AUDIO_ENGINE == 'pcm':
+                assets = [(kind, id) for kind, id in assets if kind != 'sound']   # see audio.load_sounds
+            self.pool.prefetch(assets, op.dirname(csv_file))
+
+    def handle(self, command):
+        """ executes a 'run' command; returns the reply to send
+
+        command['next']: run file that comes next, decoded after the run, or,
+        with command['early'], as soon as the stimuli of this step are loaded
+        """
+        localizer = self.localizer
+        localizer.configure(localizer.parser.parse_args(self.base_argv + command['argv']))
+        subject = int(command['subject'])
+        os.environ['SUBJECT'] = str(subject)
+        following, early = command.get('next'), command.get('early', False)
+        reply = dict(status='done')
+        if localizer.calibration is not None:
+            if early:
+                self.prefetch(following)
+            localizer.settle()
+            localizer.calibrate()
+        elif localizer.splash_screen is not None:
+            if early:
+                self.prefetch(following)
+            reply['datafile'] = localizer.show_instructions(localizer.splash_screen, subject,
+                                                            datafile_name(subject), self.pool)
+        else:
+            schedule, stims = localizer.load_run(localizer.csv_file, pool=self.pool)
+            if early:
+                self.prefetch(following)
+            reply['datafile'] = localizer.run_session(schedule, stims, subject,
+                                                      datafile_name(subject))
+            if not early:
+                # decode the next run while the end screen is displayed
+                self.prefetch(following)
+            self.exp.clock.wait(2000)
+        self.idle()
+        return reply
+
+    def session(self, steps, subject):
+        """ executes the steps of a session in order (see session())
+
+        steps: command line options of each step, e.g. ['--csv_file', 'french/run1_pinel_localizer.csv']
+        returns the list of the xpd files written
+        """
+        datafiles = []
+        for k, argv in enumerate(steps):
+            following = next((step[1] for step in steps[k + 1:] if step[0] == '--csv_file'), None)
+            print(f"session step {k + 1}/{len(steps)}: {' '.join(argv)}")
+            try:
+                reply = self.handle(dict(argv=argv, subject=subject, next=following, early=True))
+            except BaseException:
+                print("session interrupted; remaining steps: "
+                      + ('; '.join(' '.join(step) for step in steps[k:])))
+                raise
+            if reply.get('datafile'):
+                datafiles.append(reply['datafile'])
+        return datafiles
+
+    def serve(self):
+        conn = connect()
+        if conn is not None:
+            conn.close()
+            print(f"a runner is already running (see {RUNTIME_FILE})")
+            return
+        listener = listen()
+        print(f"runner listening on {listener.address}")
+        try:
+            self._serve(listener)
+        finally:
+            forget(listener)
+
+    def _serve(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError:
+                print("runner: connection with a wrong key refused")
+                continue
+            with conn:
+                while True:
+                    try:
+                        command = conn.recv()
+                    except EOFError:
+                        break
+                    action = command.get('action')
+                    if action == 'quit':
+                        conn.send(dict(status='bye'))
+                        return
+                    elif action == 'prefetch':
+                        self.prefetch(command.get('csv_file'))
+                        conn.send(dict(status='done'))
+                    elif action == 'run':
+                        try:
+                            conn.send(self.handle(command))
+                        except Exception as e:
+                            conn.send(dict(status='error', error=repr(e)))
+                            self.idle()
+                    else:
+                        conn.send(dict(status='error', error=f"unknown action {action}"))
+
+
+def base_options(argv):
+    """ the command line options of pinel_localizer.py, without those naming
+    the steps of a session (SESSION_OPTIONS) """
+    base, skip = [], 0
+    for arg in argv:
+        if arg.startswith('--'):
+            skip = 0
+            name, _, value = arg.partition('=')
+            if name in SESSION_OPTIONS:
+                skip = 0 if value else (-1 if name == '--session' else 1)
+                continue
+        elif skip:
+            skip -= 1   # stays non-zero for --session, which takes all the values up to the next option
+            continue
+        base.append(arg)
+    return base
+
+
+def session(argv, args, subject):
+    """ executes the session described by the options of pinel_localizer.py
+    (--cali, --splash, then the runs of --session) in this process """
+    steps = []
+    if args.cali is not None:
+        steps.append(['--cali', str(args.cali)])
+    if args.splash is not None:
+        steps.append(['--splash', args.splash])
+    steps += [['--csv_file', csv_file] for csv_file in args.session]
+    datafiles = Runner(base_options(argv)).session(steps, subject)
+    print(f"session done: {len(datafiles)} data files")
+    for datafile in datafiles:
+        print(f"  {datafile}")
+    return 0
+
+
+if __name__ == '__main__':
+    import pinel_localizer
+    pinel_localizer.check_environment()
+    Runner(sys.argv[1:]).serve()
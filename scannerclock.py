@@ -0,0 +1,87 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Clock anchored on the scanner triggers.
+
+The onsets of the run files are defined relative to the acquisition, i.e. to
+the scanner clock, whose pulses arrive every TR. ScannerClock fits online
+(least squares over all the pulses received so far)
+
+    local time = offset + slope * scanner time
+
+where the scanner time of pulse k is k * TR, and it returns the scanner time
+from now(). The scheduler, which compares now() to the onsets, thus follows
+the scanner: a late first trigger or a drift of the stimulation PC clock are
+corrected as the pulses arrive. The residual of each pulse w.r.t. the fit
+before it is kept in `pulses` and saved at the end of the run.
+
+Missing pulses are tolerated (the pulse number is deduced from the fit);
+pulses implying a drift larger than `max_drift` are rejected as spurious.
+"""
+
+
+class ScannerClock:
+    """
+    local: scheduler.MonotonicClock started at the first trigger
+    tr: repetition time of the acquisition, in ms
+    """
+
+    def __init__(self, local, tr, max_drift=1e-3):
+        self.local = local
+        self.tr = float(tr)
+        self.max_drift = max_drift
+        self.offset = 0.0
+        self.slope = 1.0
+        self.pulses = [(0, 0.0, 0.0)]   # pulse number, local time, residual
+        self._n, self._sx, self._sy, self._sxx, self._sxy = 1, 0.0, 0.0, 0.0, 0.0
+
+    @property
+    def origin(self):
+        return self.local.origin
+
+    def at(self, t):
+        """ scanner time of a perf_counter() time """
+        return (self.local.at(t) - self.offset) / self.slope
+
+    def now(self):
+        return (self.local.now() - self.offset) / self.slope
+
+    @property
+    def time(self):
+        return int(self.now())
+
+    def wait(self, ms):
+        self.local.wait(ms * self.slope)
+
+    def add_pulse(self, t):
+        """ updates the fit with a pulse received at perf_counter() time t """
+        y = self.local.at(t)
+        k = round((y - self.offset) / (self.slope * self.tr))
+        if k <= self.pulses[-1][0]:
+            return False   # bounce or duplicate
+        x = k * self.tr
+        residual = y - (self.offset + self.slope * x)
+        n, sx, sy = self._n + 1, self._sx + x, self._sy + y
+        sxx, sxy = self._sxx + x * x, self._sxy + x * y
+        slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+        if abs(slope - 1.0) > self.max_drift:
+            return False
+        self._n, self._sx, self._sy, self._sxx, self._sxy = n, sx, sy, sxx, sxy
+        self.slope = slope
+        self.offset = (sy - slope * sx) / n
+        self.pulses.append((k, y, residual))
+        return True
+
+    def report(self):
+        residuals = [abs(r) for _, _, r in self.pulses[1:]]
+        missing = self.pulses[-1][0] + 1 - len(self.pulses)
+        print(f"scanner clock: {len(self.pulses)} pulses ({missing} missing), "
+              f"offset {self.offset:.2f} ms, drift {1e6 * (self.slope - 1):.1f} ppm, "
+              f"max |residual| {max(residuals, default=0):.2f} ms")
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            f.write('pulse\tlocal_time\tresidual\n')
+            for k, y, r in self.pulses:
+                f.write(f"{k}\t{y:.3f}\t{r:.3f}\n")
+            f.write(f"# offset={self.offset:.4f} slope={self.slope:.9f} tr={self.tr}\n")
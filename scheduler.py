@@ -0,0 +1,154 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Strategies to wait for the onset of the next event of the presentation loop.
+
+A scheduler is used as:
+
+    scheduler.wait_until(onset, stype)     # returns when present() must be called
+    start = clock.now(); stim.present(); end = clock.now()
+    error = scheduler.presented(onset, stype, start, end)
+
+`error` is the difference (in ms) between the end of present(), i.e. the
+moment the flip returned or the sound was started, and the target onset.
+
+`offsets` (stype -> ms) gives the output latency of a kind of stimulus, such
+as the audio latency measured by `--cali` (see audio.py): those stimuli are
+started that much ahead of their onsets, and the latency is added to their
+errors.
+
+- LegacyScheduler reproduces the original loop: 1 ms sleeps until 10 ms
+  before the onset.
+- HybridScheduler sleeps while the deadline is far, then spin-waits the last
+  milliseconds. It calls present() ahead of the onset by the latency it
+  measured on the previous events of the same stype (initially half a refresh
+  period for visual stimuli) so that the flips are centred on the onsets.
+"""
+
+import time
+
+
+class MonotonicClock:
+    """ Clock of the run, started at the scanner trigger.
+
+    Same interface as expyriment.misc.Clock (`time` in integer ms, `wait`),
+    plus `now()` which returns float ms for the schedulers. `origin` (e.g. the
+    time of the scanner trigger) is a time.perf_counter() value.
+    """
+
+    def __init__(self, origin=None):
+        self._start = time.perf_counter() if origin is None else origin
+
+    @property
+    def origin(self):
+        """ perf_counter() time (s) of the time 0 of the clock """
+        return self._start
+
+    def at(self, t):
+        """ converts a perf_counter() time (s) into the time of the clock """
+        return (t - self._start) * 1000.0
+
+    def now(self):
+        return (time.perf_counter() - self._start) * 1000.0
+
+    @property
+    def time(self):
+        return int(self.now())
+
+    def wait(self, ms):
+        if ms > 0:
+            time.sleep(ms / 1000.0)
+
+    def reset(self):
+        self._start = time.perf_counter()
+
+
+def measure_refresh_period(flip, clock, n=30):
+    """ median duration (ms) of `n` consecutive calls of `flip`, or None
+
+    With vsync, a flip blocks until the next vertical retrace, so successive
+    flips are one refresh period apart. Without vsync the flips return
+    immediately and the period cannot be measured.
+    """
+    flip()
+    times = [clock.now()]
+    for _ in range(n):
+        flip()
+        times.append(clock.now())
+    deltas = sorted(b - a for a, b in zip(times, times[1:]))
+    period = deltas[len(deltas) // 2]
+    return period if period > 2.0 else None
+
+
+def _no_poll():
+    pass
+
+
+class LegacyScheduler:
+    def __init__(self, clock, poll=_no_poll, offsets=None):
+        self.clock = clock
+        self.poll = poll
+        self.offsets = offsets or dict()
+
+    def wait_until(self, onset, stype=None):
+        onset -= self.offsets.get(stype, 0.0)
+        while self.clock.time < (onset - 10):
+            self.clock.wait(1)
+            self.poll()
+
+    def presented(self, onset, stype, start, end):
+        return end + self.offsets.get(stype, 0.0) - onset
+
+
+class HybridScheduler:
+    """
+    clock: MonotonicClock (or any object with now() and wait())
+    poll: function called between the sleeps (e.g. to read the keyboard)
+    refresh_period: duration of a frame in ms (None if unknown)
+    spin: the last `spin` ms before the deadline are busy-waited
+    gain: weight of the last measured latency in the running estimate
+    offsets: output latency (ms) of some stypes
+    """
+
+    AUDIO_STYPES = ('sound',)
+
+    def __init__(self, clock, poll=_no_poll, refresh_period=None, spin=2.0,
+                 gain=0.2, offsets=None):
+        self.clock = clock
+        self.offsets = offsets or dict()
+        self.poll = poll
+        self.refresh_period = refresh_period
+        self.spin = spin
+        self.gain = gain
+        self.max_lead = refresh_period if refresh_period else 20.0
+        self.lead = dict()   # stype -> estimated latency of present()
+
+    def _initial_lead(self, stype):
+        if stype in self.AUDIO_STYPES or not self.refresh_period:
+            return 0.0
+        return self.refresh_period / 2.0
+
+    def wait_until(self, onset, stype=None):
+        lead = self.lead.get(stype)
+        if lead is None:
+            lead = self.lead[stype] = self._initial_lead(stype)
+        deadline = onset - self.offsets.get(stype, 0.0) - lead
+        now = self.clock.now
+        remaining = deadline - now()
+        while remaining > self.spin:
+            # coarse sleep, leaving the spin margin and ~1 ms of sleep overshoot
+            self.clock.wait(min(remaining - self.spin, 1.0))
+            self.poll()
+            remaining = deadline - now()
+        while now() < deadline:
+            pass
+
+    def presented(self, onset, stype, start, end):
+        """ updates the latency estimate of `stype` and returns the onset error """
+        error = end + self.offsets.get(stype, 0.0) - onset
+        lead = self.lead.get(stype, 0.0) + self.gain * error
+        self.lead[stype] = min(max(lead, 0.0), self.max_lead)
+        return error
+
+
+SCHEDULERS = {'legacy': LegacyScheduler, 'hybrid': HybridScheduler}
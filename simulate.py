@@ -0,0 +1,235 @@
+#! /usr/bin/env python3
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Headless simulation of a run of the localizer.
+
+The schedule of a run csv file is presented by the same loop as in
+pinel_localizer.py (runloop.present_schedule), but with stand-ins for the
+display, the sound card and the keyboard, driven by either:
+
+- a virtual clock (--speed 0, the default): time only advances when the
+  stand-ins say so (sleep overshoot, blit cost, wait for the vertical
+  retrace), so a 5 minute run is simulated in a fraction of a second and the
+  results are reproducible (--seed);
+- an accelerated real clock (--speed N): the run lasts 1/N of its duration
+  and the measured jitter includes the real behaviour of the OS scheduler.
+
+Neither expyriment nor a display is needed.
+
+Example:
+
+    python simulate.py --csv_file french/run1_pinel_localizer.csv --scheduler hybrid
+"""
+
+import argparse
+import random
+import time
+
+import timeline
+import scheduler
+import instrumentation
+import runloop
+import datalog
+
+
+# timing options of menu.py
+DEFAULT_OPTIONS = dict(word_duration=250, word_isi=100, picture_duration=200,
+                       picture_isi=0, fs_delay=100, text_duration=3000)
+
+VISUAL_KINDS = ('text', 'picture', 'video', 'blank', 'fs')
+
+
+class VirtualClock:
+    """ Clock whose time only advances through the calls made to it
+
+    call_cost: ms elapsed at each reading of the clock (so that spin loops end)
+    sleep_overshoot: mean (ms) of the exponential delay added to each wait()
+    """
+
+    def __init__(self, call_cost=0.001, sleep_overshoot=0.1, seed=0):
+        self.call_cost = call_cost
+        self.sleep_overshoot = sleep_overshoot
+        self._random = random.Random(seed)
+        self._t = 0.0
+
+    def now(self):
+        self._t += self.call_cost
+        return self._t
+
+    @property
+    def time(self):
+        return int(self.now())
+
+    def wait(self, ms):
+        if ms > 0:
+            self._t += ms
+            if self.sleep_overshoot:
+                self._t += self._random.expovariate(1.0 / self.sleep_overshoot)
+
+    def advance_to(self, t):
+        self._t = max(self._t, t)
+
+    def reset(self):
+        self._t = 0.0
+
+
+class AcceleratedClock(scheduler.MonotonicClock):
+    """ Real clock running `speed` times faster than the wall clock """
+
+    def __init__(self, speed):
+        self.speed = speed
+        scheduler.MonotonicClock.__init__(self)
+
+    def now(self):
+        return (time.perf_counter() - self._start) * 1000.0 * self.speed
+
+    def wait(self, ms):
+        if ms > 0:
+            time.sleep(ms / 1000.0 / self.speed)
+
+    def advance_to(self, t):
+        while self.now() < t:
+            pass
+
+
+class StandInDisplay:
+    """ Display with a fixed refresh rate: a flip returns at the next retrace """
+
+    def __init__(self, clock, refresh_period=1000.0 / 60, blit_cost=None):
+        self.clock = clock
+        self.refresh_period = refresh_period
+        self.blit_cost = blit_cost or {'text': 0.8, 'picture': 1.5, 'video': 3.0,
+                                       'blank': 0.6, 'fs': 0.6}
+        self.flips = 0
+
+    def flip(self, kind):
+        start = self.clock.now()
+        self.clock.advance_to(start + self.blit_cost.get(kind, 1.0))
+        if self.refresh_period:
+            p = self.refresh_period
+            self.clock.advance_to((int(self.clock.now() / p) + 1) * p)
+        self.flips += 1
+        return self.clock.now() - start
+
+
+class StandInStimulus:
+    """ Replaces an expyriment stimulus: present() costs what the hardware would """
+
+    def __init__(self, kind, id, display, audio_cost=0.3):
+        self.kind, self.id = kind, id
+        self.display = display
+        self.audio_cost = audio_cost
+
+    def present(self):
+        if self.kind in VISUAL_KINDS:
+            return self.display.flip(self.kind)
+        start = self.display.clock.now()
+        self.display.clock.advance_to(start + self.audio_cost)
+        return self.display.clock.now() - start
+
+
+class StandInKeyboard:
+    """ Replays a list of (time, key) events; check() returns at most one key,
+    like expyriment.io.Keyboard.check() """
+
+    def __init__(self, clock, presses):
+        self.clock = clock
+        self.presses = sorted(presses)
+        self._next = 0
+
+    def check(self):
+        if self._next < len(self.presses) and self.presses[self._next][0] <= self.clock.now():
+            self._next += 1
+            return self.presses[self._next - 1][1]
+        return None
+
+    def pending(self):
+        return len(self.presses) - self._next
+
+
+def scripted_presses(schedule, tr=2400, response_time=600, seed=0):
+    """ scanner pulses every `tr` ms, and 3 presses of the right button after
+    the onset of each clic condition (button 'y' for clicD*, 'b' for clicG*)
+
+    Keys are given as key codes, as returned by expyriment.io.Keyboard.check()
+    """
+    rnd = random.Random(seed)
+    end = schedule.duration() + 1000
+    presses = [(t, ord('t')) for t in range(tr, end, tr)]
+    first = dict()
+    for onset, cond in zip(schedule.onsets, schedule.conds):
+        if cond.startswith('clic') and (cond not in first or onset - first[cond] > 2000):
+            first[cond] = onset
+            key = ord('y') if cond.startswith('clicD') else ord('b')
+            t = onset + response_time + rnd.uniform(0, 300)
+            for k in range(3):
+                presses.append((t + k * rnd.uniform(150, 250), key))
+    return presses
+
+
+def simulate_run(csv_file, options=DEFAULT_OPTIONS, scheduler_name='legacy',
+                 speed=0, refresh_period=1000.0 / 60, seed=0, schedule=None):
+    """ presents the schedule of `csv_file` on stand-ins
+
+    returns a dict with the schedule, the EventTimer, the logged rows and
+    the wall time of the loop
+    """
+    if schedule is None:
+        schedule = timeline.load_schedule(csv_file, options, cache_dir=None)
+    clock = VirtualClock(seed=seed) if speed == 0 else AcceleratedClock(speed)
+    display = StandInDisplay(clock, refresh_period)
+    stims = [StandInStimulus(kind, id, display) for kind, id in zip(schedule.kinds, schedule.ids)]
+    kb = StandInKeyboard(clock, scripted_presses(schedule, seed=seed))
+    log = datalog.ListLog(schedule)
+
+    def check_keyboard():
+        k = kb.check()
+        if k is not None:
+            log.key(clock.now(), k)
+
+    if scheduler_name == 'hybrid':
+        sched = scheduler.HybridScheduler(clock, check_keyboard, refresh_period=refresh_period)
+    else:
+        sched = scheduler.LegacyScheduler(clock, check_keyboard)
+    timer = instrumentation.EventTimer(schedule)
+
+    clock.reset()
+    start = time.perf_counter()
+    runloop.present_schedule(schedule, stims, clock, sched, timer, log, check_keyboard)
+    wall = time.perf_counter() - start
+    return dict(schedule=schedule, timer=timer, rows=log.rows(), wall=wall,
+                flips=display.flips, unread_keys=kb.pending())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--csv_file', required=True, help="run file to simulate")
+    parser.add_argument('--scheduler', choices=sorted(scheduler.SCHEDULERS), default='legacy')
+    parser.add_argument('--speed', type=float, default=0,
+                        help="0 for a virtual clock, otherwise acceleration of the real clock")
+    parser.add_argument('--refresh-rate', type=float, default=60,
+                        help="refresh rate (Hz) of the simulated display (0: no vsync)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument("--rsvp-display-time", type=int, default=DEFAULT_OPTIONS['word_duration'])
+    parser.add_argument("--rsvp-display-isi", type=int, default=DEFAULT_OPTIONS['word_isi'])
+    parser.add_argument("--picture-display-time", type=int, default=DEFAULT_OPTIONS['picture_duration'])
+    parser.add_argument("--picture-isi", type=int, default=DEFAULT_OPTIONS['picture_isi'])
+    parser.add_argument("--fs_delay_time", type=int, default=DEFAULT_OPTIONS['fs_delay'])
+    parser.add_argument("--text-duration", type=int, default=DEFAULT_OPTIONS['text_duration'])
+    parser.add_argument("--skip-redundant-flips", action='store_true')
+    args = parser.parse_args()
+
+    options = dict(word_duration=args.rsvp_display_time, word_isi=args.rsvp_display_isi,
+                   picture_duration=args.picture_display_time, picture_isi=args.picture_isi,
+                   fs_delay=args.fs_delay_time, text_duration=args.text_duration,
+                   merge_screens=args.skip_redundant_flips)
+    result = simulate_run(args.csv_file, options, args.scheduler, args.speed,
+                          1000.0 / args.refresh_rate if args.refresh_rate else None, args.seed)
+    n = len(result['schedule'])
+    print(f"{args.csv_file}: {n} events, {result['flips']} flips, "
+          f"{sum(1 for r in result['rows'] if r[0] == 'keypressed')} keypresses logged, "
+          f"{result['unread_keys']} never read")
+    print(f"loop: {1000 * result['wall']:.1f} ms wall time, "
+          f"{n / result['wall']:.0f} events/s, {1e6 * result['wall'] / n:.1f} us/event")
+    result['timer'].report()
@@ -0,0 +1,291 @@
+#! /usr/bin/env python3
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Packed, memory-mapped archive of the stimuli of a language.
+
+Opening the hundred wav and bmp files of a language one by one is slow from
+a network share or a USB stick. This tool packs the decoded PCM of the
+sounds and the pixels of the pictures of a stimuli directory into a single
+indexed file, `<directory>/stimuli.pack`:
+
+    python stimpack.py french [english spanish ...]
+
+The localizer looks for the archive in the directory of the stimuli (that
+of `--csv_file`, or `--stim-dir`) and memory-maps it: the stimuli are then
+created from views on the mapping, without reading nor decoding the files.
+The files missing from the archive, or all of them when there is no
+archive, are read from the directory as before. The archive must be rebuilt
+when the stimuli change: the index keeps the modification time and the size
+of each file, and a file of the directory that differs from its entry is
+read from the directory, with a warning.
+
+Layout: MAGIC, the length of the index (uint32), the index (JSON: file name
+-> kind, offset, length, format, and mtime and size of the file), then the
+data of each file, aligned on ALIGN bytes.
+"""
+
+import io
+import os
+import os.path as op
+import sys
+import json
+import mmap
+import wave
+import struct
+import threading
+import time
+
+
+MAGIC = b'PLSTIMPACK2\n'
+PACK_NAME = 'stimuli.pack'
+ALIGN = 64
+SOUND_EXTENSIONS = ('.wav',)
+PICTURE_EXTENSIONS = ('.bmp', '.png', '.jpg', '.jpeg', '.gif', '.tga')
+
+
+def read_wav(path):
+    """ returns (format, pcm) of a wav file """
+    with wave.open(path, 'rb') as w:
+        fmt = dict(rate=w.getframerate(), channels=w.getnchannels(), width=w.getsampwidth())
+        return fmt, w.readframes(w.getnframes())
+
+
+def read_bmp(path):
+    """ returns (format, top-down RGB pixels) of an uncompressed 24-bit bmp
+    file, or None for the other bmp formats """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:2] != b'BM':
+        return None
+    offset, = struct.unpack_from('<I', data, 10)
+    width, height, _, bpp, compression = struct.unpack_from('<iiHHI', data, 18)
+    if bpp != 24 or compression != 0:
+        return None
+    pitch = (3 * width + 3) & ~3
+    rows = range(abs(height) - 1, -1, -1) if height > 0 else range(abs(height))
+    pixels = bytearray(3 * width * abs(height))
+    for i, row in enumerate(rows):
+        bgr = data[offset + row * pitch:offset + row * pitch + 3 * width]
+        rgb = pixels[3 * width * i:3 * width * (i + 1)]
+        rgb[0::3], rgb[1::3], rgb[2::3] = bgr[2::3], bgr[1::3], bgr[0::3]
+        pixels[3 * width * i:3 * width * (i + 1)] = rgb
+    return dict(width=width, height=abs(height), format='RGB'), pixels
+
+
+def read_picture(path):
+    """ returns (format, pixels) of a picture, decoded by pygame if needed """
+    decoded = read_bmp(path) if path.lower().endswith('.bmp') else None
+    if decoded is not None:
+        return decoded
+    import pygame
+    surface = pygame.image.load(path)
+    fmt = 'RGBA' if surface.get_alpha() is not None or surface.get_colorkey() else 'RGB'
+    tobytes = getattr(pygame.image, 'tobytes', None) or pygame.image.tostring
+    return (dict(width=surface.get_width(), height=surface.get_height(), format=fmt),
+            tobytes(surface, fmt))
+
+
+def build(directory, filename=None):
+    """ packs the sounds and pictures of `directory`; returns the archive name """
+    filename = filename or op.join(directory, PACK_NAME)
+    entries = []
+    for name in sorted(os.listdir(directory)):
+        ext = op.splitext(name)[1].lower()
+        path = op.join(directory, name)
+        if ext in SOUND_EXTENSIONS:
+            fmt, data = read_wav(path)
+            entries.append((name, dict(fmt, kind='sound'), data))
+        elif ext in PICTURE_EXTENSIONS:
+            try:
+                fmt, data = read_picture(path)
+            except ImportError:
+                print(f"  {name}: needs pygame to be decoded, left out")
+                continue
+            entries.append((name, dict(fmt, kind='picture'), data))
+
+    # offsets relative to the end of the index, whose length depends on them
+    index = dict()
+    position = 0
+    for name, fmt, data in entries:
+        position = -(-position // ALIGN) * ALIGN
+        stat = os.stat(op.join(directory, name))
+        index[name] = dict(fmt, offset=position, length=len(data),
+                           mtime=stat.st_mtime_ns, size=stat.st_size)
+        position += len(data)
+    header = json.dumps(index, sort_keys=True).encode('utf-8')
+    start = -(-(len(MAGIC) + 4 + len(header)) // ALIGN) * ALIGN
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        for name, fmt, data in entries:
+            f.seek(start + index[name]['offset'])
+            f.write(data)
+        f.truncate(start + position)
+    os.replace(tmp, filename)
+    return filename
+
+
+class Pack:
+    """ Memory-mapped archive; entries are accessed with view(name) """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filename} is not a stimuli archive")
+            n, = struct.unpack('<I', f.read(4))
+            self.index = json.loads(f.read(n).decode('utf-8'))
+            start = -(-(len(MAGIC) + 4 + n) // ALIGN) * ALIGN
+            # copy-on-write: pages are shared with the file, but pygame may
+            # want writable buffers
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self._view = memoryview(self._map)[start:]
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def data(self):
+        """ zero-copy view on the data of all the entries """
+        return self._view
+
+    def offset(self, name):
+        """ offset of an entry in data() """
+        return self.index[name]['offset']
+
+    def view(self, name):
+        """ zero-copy view on the data of an entry """
+        entry = self.index[name]
+        return self._view[entry['offset']:entry['offset'] + entry['length']]
+
+    def surface(self, name):
+        """ pygame surface sharing the pixels of a picture """
+        import pygame
+        entry = self.index[name]
+        return pygame.image.frombuffer(self.view(name), (entry['width'], entry['height']),
+                                       entry['format'])
+
+    def sound(self, name):
+        """ pygame sound of an entry, made from the mapped pcm if it has the format of the mixer """
+        import pygame
+        entry = self.index[name]
+        frequency, size, channels = pygame.mixer.get_init()
+        if (entry['rate'], 8 * entry['width'], entry['channels']) == (frequency, abs(size), channels):
+            return pygame.mixer.Sound(buffer=self.view(name))
+        # other format: let pygame convert it from a wav image
+        wav = io.BytesIO()
+        with wave.open(wav, 'wb') as w:
+            w.setnchannels(entry['channels'])
+            w.setsampwidth(entry['width'])
+            w.setframerate(entry['rate'])
+            w.writeframes(self.view(name))
+        wav.seek(0)
+        return pygame.mixer.Sound(file=wav)
+
+
+class PackedAudio:
+    """ Sound of an archive, with the interface of stimuli.Audio """
+
+    def __init__(self, sound):
+        self.sound = sound
+
+    def preload(self):
+        pass
+
+    def present(self):
+        start = time.perf_counter()
+        self.sound.play()
+        return 1000 * (time.perf_counter() - start)
+
+    play = present
+
+
+def stimulus(kind, payload):
+    """ expyriment stimulus of a decoded entry (main thread only): the files
+    may be absent, so stimuli.Audio and stimuli.Picture cannot be used """
+    if kind == 'sound':
+        return PackedAudio(payload)
+    from expyriment import stimuli
+    stim = stimuli.Canvas(payload.get_size())
+    stim._set_surface(payload)
+    stim.preload()
+    return stim
+
+
+_packs = dict()   # directory -> Pack, or None if it has no archive
+_found = dict()   # path -> (pack, name), or None if it is read from the directory
+_lock = threading.Lock()   # find() is called from the loading threads too
+
+
+def _open(directory):
+    filename = op.join(directory, PACK_NAME)
+    if not op.exists(filename):
+        return None
+    try:
+        pack = Pack(filename)
+    except ValueError:
+        print(f"warning: {filename} was made by another version, "
+              f"rebuild it with stimpack.py; the stimuli are read from {directory}")
+        return None
+    print(f"stimuli read from {filename}")
+    return pack
+
+
+def _current(pack, name, path):
+    """ whether the entry `name` is that of the file `path`, if it exists """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return True   # the file is only in the archive
+    entry = pack.index[name]
+    if (stat.st_mtime_ns, stat.st_size) == (entry['mtime'], entry['size']):
+        return True
+    print(f"warning: {path} changed since {pack.filename} was built, read from the file")
+    return False
+
+
+def find(path):
+    """ returns (pack, name) if the file `path` is in the archive of its
+    directory and has not changed since, else None """
+    with _lock:
+        if path not in _found:
+            directory, name = op.split(path)
+            if directory not in _packs:
+                _packs[directory] = _open(directory)
+            pack = _packs[directory]
+            found = None
+            if pack is not None and name in pack and _current(pack, name, path):
+                found = pack, name
+            _found[path] = found
+        return _found[path]
+
+
+def size(path):
+    """ size of the data of a file, packed or not """
+    found = find(path)
+    if found is not None:
+        pack, name = found
+        return pack.index[name]['length']
+    return op.getsize(path)
+
+
+def duration(path):
+    """ duration (ms) of a sound file, packed or not """
+    found = find(path)
+    if found is not None:
+        pack, name = found
+        entry = pack.index[name]
+        return 1000 * entry['length'] // (entry['rate'] * entry['channels'] * entry['width'])
+    with wave.open(path, 'rb') as w:
+        return 1000 * w.getnframes() // w.getframerate()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <stimuli directory> ...")
+        sys.exit(1)
+    for directory in sys.argv[1:]:
+        filename = build(directory)
+        index = Pack(filename).index
+        print(f"{filename}: {len(index)} files, {op.getsize(filename) / 1e6:.1f} MB")
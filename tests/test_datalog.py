@@ -0,0 +1,68 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+""" Reading of the xpd files, including those of the first versions """
+
+import os
+import os.path as op
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+
+import datalog
+
+
+# as written by expyriment with the variables of the first versions (no timing_error)
+LEGACY_XPD = """\
+#Expyriment 0.10.0, .xpd-file, coding: UTF-8
+#date: Thu Nov 14 2024 10:12:55
+#--EXPERIMENT INFO
+#e mainfile: pinel_localizer.py
+#e french/run1_pinel_localizer.csv
+#--SUBJECT INFO
+#s id: 7
+subject_id,condition,time,stype,id,target_time
+7,calculvideo,0,text,calculez,0
+7,calculvideo,352,blank,blank,350
+7,keypressed,512,116
+7,calculvideo,703,text,seize,700
+7,"clicGaudio",2401,sound,"clic, gauche.wav",2400
+"""
+
+
+def write(text):
+    fd, path = tempfile.mkstemp(suffix='.xpd')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return path
+
+
+class ReadXpdTest(unittest.TestCase):
+    def test_legacy_file(self):
+        path = write(LEGACY_XPD)
+        try:
+            info, rows = datalog.read_xpd(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(info['subject'], '7')
+        self.assertEqual(info['csv_file'], 'french/run1_pinel_localizer.csv')
+        self.assertEqual(rows[0], ['calculvideo', 0, 'text', 'calculez', 0, 0])
+        self.assertEqual(rows[1], ['calculvideo', 352, 'blank', 'blank', 350, 2])
+        self.assertEqual(rows[2], ['keypressed', 512, 116])
+        self.assertEqual(rows[4], ['clicGaudio', 2401, 'sound', 'clic, gauche.wav', 2400, 1])
+
+    def test_current_file(self):
+        path = write(LEGACY_XPD)
+        info, rows = datalog.read_xpd(path)
+        datalog.write_xpd(path, [r[:5] + [0.25] if len(r) == 6 else r for r in rows], info)
+        try:
+            _, again = datalog.read_xpd(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(again[1], ['calculvideo', 352, 'blank', 'blank', 350, 0.25])
+        self.assertEqual(again[2], ['keypressed', 512, 116])
+
+
+if __name__ == '__main__':
+    unittest.main()
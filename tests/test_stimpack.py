@@ -0,0 +1,55 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+""" Archive of the stimuli, and the files that changed since it was built """
+
+import os
+import os.path as op
+import sys
+import tempfile
+import unittest
+import wave
+
+sys.path.insert(0, op.dirname(op.dirname(op.abspath(__file__))))
+
+import stimpack
+
+
+def write_wav(path, frames):
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(1000)
+        w.writeframes(b'\0\0' * frames)
+
+
+class FindTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ('a.wav', 'b.wav'):
+            write_wav(op.join(self.directory, name), 500)
+        stimpack.build(self.directory)
+        stimpack._packs.clear()
+        stimpack._found.clear()
+
+    def path(self, name):
+        return op.join(self.directory, name)
+
+    def test_packed(self):
+        pack, name = stimpack.find(self.path('a.wav'))
+        self.assertEqual(name, 'a.wav')
+        self.assertEqual(stimpack.duration(self.path('a.wav')), 500)
+
+    def test_changed_file(self):
+        write_wav(self.path('b.wav'), 800)
+        self.assertIsNone(stimpack.find(self.path('b.wav')))
+        self.assertEqual(stimpack.duration(self.path('b.wav')), 800)
+        self.assertIsNotNone(stimpack.find(self.path('a.wav')))
+
+    def test_file_only_in_archive(self):
+        os.remove(self.path('b.wav'))
+        self.assertIsNotNone(stimpack.find(self.path('b.wav')))
+
+
+if __name__ == '__main__':
+    unittest.main()
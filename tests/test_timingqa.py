@@ -0,0 +1,39 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+""" Timing QA of the sessions recorded by the first versions """
+
+import os
+import os.path as op
+import sys
+import unittest
+
+ROOT = op.dirname(op.dirname(op.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from test_datalog import LEGACY_XPD, write
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, "timingqa.py needs NumPy")
+class LegacySessionTest(unittest.TestCase):
+    def test_session(self):
+        import timingqa
+        path = write(LEGACY_XPD)
+        try:
+            result = timingqa.session(path, root=ROOT)
+        finally:
+            os.remove(path)
+        self.assertEqual(list(result['errors']), [0, 2, 3, 1])
+        self.assertEqual(result['run'], 1)
+        self.assertEqual(result['host'], 'unknown')
+        self.assertEqual(list(result['word_durations']), [352])
+        summary = timingqa.summarise([result])
+        self.assertEqual(summary['max_error'], 3.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
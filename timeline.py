@@ -0,0 +1,225 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Compilation of a run csv file into a sorted schedule of events.
+
+Each row of a run file (condition, onset, stype, stimulus) is expanded into
+the individual screen/sound events (words, pictures, blanks and fixation
+crosses) that the presentation loop has to display. The result is stored
+column-wise (onsets in an `array`, the other fields in lists) so that the
+loop only has to walk it by index.
+
+The instructions file of the --splash mode (duration, stype, item) is
+compiled the same way into a schedule with absolute onsets.
+
+Compiled schedules are cached on disk, keyed by a hash of the csv file and of
+the timing options, so that subsequent launches skip the expansion.
+"""
+
+import os
+import io
+import os.path as op
+import csv
+import hashlib
+import pickle
+from array import array
+
+
+SCHEDULE_VERSION = 4   # bump when the expansion rules change
+CACHE_DIR = op.join('cache', 'schedules')
+
+# timing options (in ms) that influence the expansion of the events
+TIMING_OPTIONS = ('word_duration', 'word_isi', 'picture_duration',
+                  'picture_isi', 'fs_delay', 'text_duration')
+
+# kinds of stimuli that must be loaded from the csv (the others, 'blank' and
+# 'fs', are the shared blank screen and fixation cross)
+ASSET_KINDS = ('sound', 'picture', 'video', 'text', 'box')
+
+# stype of the instructions file -> kind of stimulus
+INSTRUCTION_KINDS = {'box': 'box', 'text': 'text', 'sound': 'sound', 'pict': 'picture'}
+
+
+class Schedule:
+    """ Sorted list of events, stored column-wise.
+
+    Event i is (onsets[i], conds[i], stypes[i], ids[i]); kinds[i] tells which
+    stimulus must be presented ('sound', 'picture', 'video', 'text', 'box',
+    'blank' or 'fs') and ids[i] which one for the first five kinds.
+    `end` is the time at which the last event ends, when it is known;
+    `merged` the number of redundant events removed by merge_screens().
+    """
+
+    def __init__(self, onsets=(), conds=(), stypes=(), ids=(), kinds=(), end=None):
+        self.onsets = array('l', onsets)
+        self.conds = list(conds)
+        self.stypes = list(stypes)
+        self.ids = list(ids)
+        self.kinds = list(kinds)
+        self.end = end
+        self.merged = 0
+
+    def __len__(self):
+        return len(self.onsets)
+
+    def __getitem__(self, i):
+        return (self.onsets[i], self.conds[i], self.stypes[i], self.ids[i],
+                self.kinds[i])
+
+    def assets(self):
+        """ returns the unique (kind, id) stimuli to load, in order of first use """
+        seen = dict()
+        for kind, id in zip(self.kinds, self.ids):
+            if kind in ASSET_KINDS:
+                seen.setdefault((kind, id), None)
+        return list(seen)
+
+    def duration(self):
+        return self.onsets[-1] if len(self) else 0
+
+
+def expand_rows(rows, word_duration, word_isi, picture_duration, picture_isi,
+                fs_delay, text_duration):
+    """ expands the rows of a run file into (onset, cond, stype, id, kind) events """
+    events = []
+    for row in rows:
+        cond, onset, stype, f = row[0], int(row[1]), row[2], row[3]
+        if stype == 'sound':
+            events.append((onset, cond, 'sound', f, 'sound'))
+        elif stype == 'picture':
+            events.append((onset, cond, 'picture', f, 'picture'))
+            events.append((onset + picture_duration, cond, 'blank', 'blank', 'blank'))
+        elif stype == 'video':
+            events.append((onset, cond, 'video', f, 'video'))
+        elif stype == 'text':
+            events.append((onset, cond, 'text', f, 'text'))
+            events.append((onset + text_duration, cond, 'blank', 'blank', 'fs'))
+        elif stype == 'rsvp':
+            for i, w in enumerate(f.split(',')):
+                compute_onset = onset + i * (word_duration + word_isi)
+                events.append((compute_onset, cond, 'text', w, 'text'))
+                if not (word_isi == 0):
+                    events.append((compute_onset + word_duration, cond, 'blank', 'blank', 'blank'))
+            compute_onset = onset + i * (word_duration + word_isi) + word_duration
+            if word_isi == 0:
+                events.append((compute_onset, cond, 'blank', 'blank', 'blank'))
+            events.append((compute_onset + fs_delay, cond, 'fs', 'fs', 'fs'))
+        elif stype == 'pictseq':
+            for i, p in enumerate(f.split(',')):
+                compute_onset = onset + i * (picture_duration + picture_isi)
+                events.append((compute_onset, cond, 'picture', p, 'picture'))
+                if not (picture_isi == 0):
+                    events.append((compute_onset + picture_duration, cond, 'blank', 'blank', 'blank'))
+            compute_onset = onset + i * (picture_duration + picture_isi) + picture_duration
+            if picture_isi == 0:  # then erase the last picture
+                events.append((compute_onset, cond, 'blank', 'blank', 'blank'))
+            events.append((compute_onset + fs_delay, cond, 'fs', 'fs', 'fs'))
+    return events
+
+
+def compile_events(events):
+    """ sorts events the way the former PriorityQueue did and packs them """
+    events = sorted(events, key=lambda e: e[:4])
+    return Schedule(*zip(*events)) if events else Schedule()
+
+
+def merge_screens(schedule):
+    """ removes the blank and fixation cross events which would not change
+    what is seen: those redrawing the screen already displayed (sounds do not
+    change the screen), and those replaced by another screen at the same onset """
+    screens = [i for i, kind in enumerate(schedule.kinds) if kind != 'sound']
+    replaced = {i for i, j in zip(screens, screens[1:])
+                if schedule.onsets[i] == schedule.onsets[j]}
+    keep = []
+    screen = None   # (kind, id) displayed
+    for i, (kind, id) in enumerate(zip(schedule.kinds, schedule.ids)):
+        if kind == 'sound':
+            keep.append(i)
+            continue
+        if kind in ('blank', 'fs') and (screen == (kind, id) or i in replaced):
+            continue
+        screen = (kind, id)
+        keep.append(i)
+    merged = Schedule(*zip(*[schedule[i] for i in keep]), end=schedule.end) if keep else Schedule(end=schedule.end)
+    merged.merged = len(schedule) - len(keep)
+    return merged
+
+
+def compile_instructions(rows):
+    """ schedule of an instructions file, whose rows are (duration, stype, item)
+
+    The items are shown one after the other, each for its duration, at
+    absolute onsets; a sound is accompanied by the fixation cross.
+    """
+    events = []
+    onset = 0
+    for row in rows:
+        duration, stype, item = int(row[0]), row[1], row[2]
+        kind = INSTRUCTION_KINDS[stype]
+        events.append((onset, 'instructions', stype, item, kind))
+        if kind == 'sound':
+            events.append((onset, 'instructions', 'fs', 'fs', 'fs'))
+        onset += duration
+    return Schedule(*zip(*events), end=onset) if events else Schedule(end=0)
+
+
+def read_rows(csv_file, encoding='utf-8-sig'):
+    with io.open(csv_file, 'r', encoding=encoding) as f:
+        return [row for row in csv.reader(f, delimiter='\t') if row]
+
+
+def cache_key(csv_file, options):
+    h = hashlib.sha256()
+    with open(csv_file, 'rb') as f:
+        h.update(f.read())
+    h.update(repr((SCHEDULE_VERSION, sorted(options.items()))).encode())
+    return h.hexdigest()
+
+
+def _cached(csv_file, options, compile, cache_dir):
+    if cache_dir is None:
+        return compile()
+
+    cache_file = op.join(cache_dir, cache_key(csv_file, options) + '.pkl')
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+
+    schedule = compile()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = cache_file + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(schedule, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    except OSError:
+        pass  # a read-only install just runs without cache
+    return schedule
+
+
+def load_schedule(csv_file, options, cache_dir=CACHE_DIR):
+    """ returns the compiled schedule of `csv_file`, from the cache if possible
+
+    options: dict providing the TIMING_OPTIONS values, and optionally
+             merge_screens (see merge_screens())
+    cache_dir: directory of the cache, None to disable caching
+    """
+    merge = options.get('merge_screens', False)
+    options = {k: options[k] for k in TIMING_OPTIONS}
+
+    def compile():
+        schedule = compile_events(expand_rows(read_rows(csv_file), **options))
+        return merge_screens(schedule) if merge else schedule
+    return _cached(csv_file, dict(options, merge_screens=True) if merge else options,
+                   compile, cache_dir)
+
+
+def load_instructions(csv_file, cache_dir=CACHE_DIR, merge=False):
+    """ returns the compiled schedule of an instructions file (see
+    compile_instructions), without its redundant events if `merge` """
+    def compile():
+        schedule = compile_instructions(read_rows(csv_file, 'utf-8'))
+        return merge_screens(schedule) if merge else schedule
+    return _cached(csv_file, dict(instructions=True, merge_screens=merge), compile, cache_dir)
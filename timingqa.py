@@ -0,0 +1,225 @@
+#! /usr/bin/env python3
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Timing quality assurance of recorded sessions.
+
+Each xpd file is replayed against the schedule compiled from its run file
+and its timing options (both logged in the file; menu.py's options are
+assumed for older files), and the following are computed with NumPy:
+
+- onset errors: time - target_time of each event, per stype (the
+  timing_error column is missing from the older files);
+- missing, duplicated and unexpected events, w.r.t. the schedule;
+- word durations of the rsvp: time from each word to the next screen,
+  compared to the scheduled one;
+- responses of the clic conditions: proportion of trials with a keypress,
+  reaction time of the first one, number of presses.
+
+The measures are summarised per machine (host logged in the xpd files),
+language and run. A group fails the QA when it exceeds THRESHOLDS (see the
+--max-* options), or, with --baseline, when its onset or word duration
+errors got more than --slack ms larger than in a previous --save. The script
+then exits with status 1, so that a stimulation PC whose timing degraded is
+caught before its data is used:
+
+    python timingqa.py data/*.xpd --save qa.json
+    python timingqa.py data/*.xpd --baseline qa.json
+"""
+
+import os.path as op
+import sys
+import json
+import argparse
+
+import datalog
+import timeline
+import simulate
+import firstlevel
+
+
+THRESHOLDS = dict(p95_error=5.0,           # ms, 95th percentile of |onset error|
+                  max_error=20.0,          # ms, largest |onset error|
+                  missing=0,               # events of the schedule never logged
+                  duplicated=0,            # events logged more than once
+                  p95_word_error=10.0)     # ms, 95th percentile of |word duration error|
+
+GROUPS = ('host', 'language', 'run')
+CLIC_CONDITIONS = ('clicDaudio', 'clicDvideo', 'clicGaudio', 'clicGvideo')
+
+
+def find_schedule(csv_file, options, root='.'):
+    """ schedule of a logged run or instructions file, None if not found """
+    for path in (op.join(root, csv_file), op.join(root, op.basename(op.dirname(csv_file)),
+                                                  op.basename(csv_file))):
+        if op.exists(path):
+            if firstlevel.run_number(path) is None:
+                return timeline.load_instructions(path, merge=options.get('merge_screens', False))
+            return timeline.load_schedule(path, options)
+    return None
+
+
+def replay(rows, schedule):
+    """ compares the logged events to the schedule; returns a dict of arrays and counts """
+    import numpy as np
+    events = [r for r in rows if r[0] not in ('keypressed', 'videoframes')]
+    logged = np.array([f"{r[4]}\t{r[0]}\t{r[2]}\t{r[3]}" for r in events], str)
+    times = np.array([r[1] for r in events], float)
+    targets = np.array([r[4] for r in events], float)
+    stypes = np.array([r[2] for r in events], str)
+    # onset errors from the logged times, which all the versions of the xpd files have
+    result = dict(errors=times - targets, stypes=stypes)
+
+    if schedule is not None:
+        expected = np.array([f"{schedule.onsets[i]}\t{schedule.conds[i]}\t{schedule.stypes[i]}\t"
+                             f"{schedule.ids[i]}" for i in range(len(schedule))], str)
+        keys, expected_counts = np.unique(expected, return_counts=True)
+        found, logged_counts = np.unique(logged, return_counts=True)
+        position = np.clip(np.searchsorted(keys, found), 0, max(0, len(keys) - 1))
+        known = (keys[position] == found) if len(keys) else np.zeros(len(found), bool)
+        counts = np.zeros(len(keys), int)
+        counts[position[known]] = logged_counts[known]
+        result.update(missing=int(np.maximum(expected_counts - counts, 0).sum()),
+                      duplicated=int(np.maximum(counts - expected_counts, 0).sum()),
+                      unexpected=int(logged_counts[~known].sum()))
+
+    # word durations: from each word to the next screen
+    visual = stypes != 'sound'
+    t, target, kind = times[visual], targets[visual], stypes[visual]
+    words = np.flatnonzero(kind[:-1] == 'text')
+    result['word_durations'] = t[words + 1] - t[words]
+    result['word_errors'] = result['word_durations'] - (target[words + 1] - target[words])
+
+    # responses of the clic trials
+    keys = np.array(sorted(r[1] for r in rows if r[0] == 'keypressed'), float)
+    trials = firstlevel.event_table(rows)
+    onsets = np.array([e[0] for e in trials] + [np.inf], float)
+    clic = np.array([e[2] in CLIC_CONDITIONS for e in trials], bool)
+    first = np.searchsorted(keys, onsets[:-1][clic])
+    last = np.searchsorted(keys, onsets[1:][clic])
+    presses = last - first
+    rts = np.full(len(first), np.nan)
+    answered = presses > 0
+    rts[answered] = keys[first[answered]] - onsets[:-1][clic][answered]
+    result.update(clic_conds=np.array([e[2] for e in trials], str)[clic],
+                  presses=presses, rts=rts)
+    return result
+
+
+def session(path, root='.'):
+    """ QA measures of an xpd file """
+    info, rows = datalog.read_xpd(path)
+    csv_file = info.get('csv_file', '')
+    options = info.get('options', simulate.DEFAULT_OPTIONS)
+    schedule = find_schedule(csv_file, options, root) if csv_file else None
+    if schedule is None:
+        print(f"{path}: run file {csv_file or '(not logged)'} not found, "
+              "missing and duplicated events not checked")
+    result = replay(rows, schedule)
+    result.update(path=path, host=info.get('host', 'unknown'),
+                  language=op.basename(op.dirname(csv_file)) or 'unknown',
+                  run=firstlevel.run_number(csv_file) or 'instructions')
+    return result
+
+
+def summarise(sessions):
+    """ summary of a group of sessions: dict measure -> value """
+    import numpy as np
+    errors = np.abs(np.concatenate([s['errors'] for s in sessions]))
+    words = np.abs(np.concatenate([s['word_errors'] for s in sessions]))
+    durations = np.concatenate([s['word_durations'] for s in sessions])
+    summary = dict(sessions=len(sessions), events=len(errors),
+                   mean_error=float(errors.mean()) if len(errors) else 0.0,
+                   p95_error=float(np.percentile(errors, 95)) if len(errors) else 0.0,
+                   max_error=float(errors.max()) if len(errors) else 0.0,
+                   missing=sum(s.get('missing', 0) for s in sessions),
+                   duplicated=sum(s.get('duplicated', 0) for s in sessions),
+                   unexpected=sum(s.get('unexpected', 0) for s in sessions),
+                   mean_word_duration=float(durations.mean()) if len(durations) else 0.0,
+                   p95_word_error=float(np.percentile(words, 95)) if len(words) else 0.0)
+    stypes = np.concatenate([s['stypes'] for s in sessions])
+    for stype in np.unique(stypes):
+        summary[f"p95_error_{stype}"] = float(np.percentile(errors[stypes == stype], 95))
+    conds = np.concatenate([s['clic_conds'] for s in sessions])
+    presses = np.concatenate([s['presses'] for s in sessions])
+    rts = np.concatenate([s['rts'] for s in sessions])
+    for cond in np.unique(conds):
+        selected = conds == cond
+        answered = selected & (presses > 0)
+        summary[f"{cond}_answered"] = float(answered.sum() / selected.sum())
+        summary[f"{cond}_median_rt"] = float(np.median(rts[answered])) if answered.any() else None
+        summary[f"{cond}_presses"] = float(presses[selected].mean())
+    return summary
+
+
+def check(summaries, thresholds, baseline=None, slack=1.0):
+    """ returns the list of the failures of the groups """
+    failures = []
+    for group, summary in summaries.items():
+        for name, limit in thresholds.items():
+            if summary[name] > limit:
+                failures.append(f"{group} {name}: {summary[name]:.2f} (threshold {limit})")
+        reference = (baseline or {}).get(group, {})
+        for name in ('p95_error', 'max_error', 'p95_word_error'):
+            if name in reference and summary[name] > reference[name] + slack:
+                failures.append(f"{group} {name}: {summary[name]:.2f} (baseline {reference[name]:.2f})")
+    return failures
+
+
+def report(summaries):
+    print(f"{'group':>24} {'sessions':>8} {'events':>7} {'mean |err|':>10} {'p95 |err|':>9} "
+          f"{'max |err|':>9} {'missing':>7} {'dupl.':>6} {'word':>6} {'p95 word err':>12}   (ms)")
+    for group, s in summaries.items():
+        print(f"{group:>24} {s['sessions']:8d} {s['events']:7d} {s['mean_error']:10.2f} "
+              f"{s['p95_error']:9.2f} {s['max_error']:9.2f} {s['missing']:7d} {s['duplicated']:6d} "
+              f"{s['mean_word_duration']:6.0f} {s['p95_word_error']:12.2f}")
+        responses = [f"{cond} {s[cond + '_answered']:.0%} answered, "
+                     + (f"median RT {s[cond + '_median_rt']:.0f} ms, " if s[cond + '_median_rt'] else "")
+                     + f"{s[cond + '_presses']:.1f} presses"
+                     for cond in CLIC_CONDITIONS if cond + '_answered' in s]
+        if responses:
+            print(f"{'':>24} " + "; ".join(responses))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('xpd', nargs='+', help="xpd files of the sessions")
+    parser.add_argument('--root', default='.', help="directory of the language directories")
+    parser.add_argument('--save', help="json file where to save the summaries")
+    parser.add_argument('--baseline', help="json file of previous summaries to compare to")
+    parser.add_argument('--slack', type=float, default=1.0,
+                        help="ms by which an error may exceed its baseline")
+    for name, value in THRESHOLDS.items():
+        parser.add_argument(f"--max-{name.replace('_', '-')}", type=type(value), default=value,
+                            dest=name, help=f"threshold of {name} (default {value})")
+    args = parser.parse_args(argv)
+
+    try:
+        import numpy
+    except ImportError:
+        print("timingqa.py needs NumPy: pip install numpy")
+        return 1
+
+    sessions = [session(path, args.root) for path in args.xpd]
+    summaries = dict()
+    for group in GROUPS:
+        for value in sorted({str(s[group]) for s in sessions}):
+            summaries[f"{group} {value}"] = summarise([s for s in sessions if str(s[group]) == value])
+    report(summaries)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(summaries, f, indent=2)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    failures = check(summaries, {name: getattr(args, name) for name in THRESHOLDS},
+                     baseline, args.slack)
+    for failure in failures:
+        print(f"FAILED {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
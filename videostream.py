@@ -0,0 +1,268 @@
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Frame-streamed playback of the video stimuli.
+
+stimuli.Video prepares and decodes its clip on the presentation thread. Here,
+a worker thread decodes the frames of each clip with OpenCV (an optional
+dependency: `pip install opencv-python`) into a bounded queue of buffers
+allocated once per clip; the worker starts when the clip is loaded, so that
+the first frames are ready before its onset.
+
+The first frame is displayed by present(), at the onset of the event, by the
+presentation loop. The following ones are displayed by PLAYER.service(),
+called between the events by the poll function of the scheduler, each as
+soon as it is due. A frame is dropped when the next one is already due, and
+counted as late when displayed more than half a frame after its due time;
+both counts are logged (datalog.FRAMES rows) at the end of the clip. A clip
+stops `margin` ms before the onset of the next event, so that it never
+delays the other events. The decoder of a clip which is presented again in
+the run is restarted between the events too, when no onset is due.
+
+Without OpenCV, the videos are presented by stimuli.Video as before.
+"""
+
+import queue
+import bisect
+import threading
+
+
+CAPACITY = 8   # frames decoded ahead (--video-buffers), 0 to use stimuli.Video
+
+
+def available():
+    """ whether the videos can be frame-streamed """
+    if CAPACITY <= 0:
+        return False
+    try:
+        import cv2
+        import numpy
+    except ImportError:
+        return False
+    return True
+
+
+class FrameDecoder(threading.Thread):
+    """ Decodes the frames of a clip into the buffers of `free`, and puts
+    them into `full` (None at the end of the clip) """
+
+    def __init__(self, path, free, full):
+        super().__init__(daemon=True)
+        self.path = path
+        self.free = free
+        self.full = full
+        self._stop = threading.Event()
+
+    def run(self):
+        import cv2
+        capture = cv2.VideoCapture(self.path)
+        while not self._stop.is_set():
+            buffer = self.free.get()   # blocks while the queue is full
+            if buffer is None:
+                break
+            ok, frame = capture.read(buffer)
+            if not ok:
+                self.free.put(buffer)
+                break
+            self.full.put(frame)
+        capture.release()
+        self.full.put(None)
+
+    def stop(self):
+        self._stop.set()
+        self.free.put(None)
+
+
+class VideoStimulus:
+    """ A video clip, presented frame by frame by PLAYER
+
+    capacity: number of frames decoded ahead
+    """
+
+    def __init__(self, path, capacity=None):
+        import cv2
+        import numpy
+        capture = cv2.VideoCapture(path)
+        if not capture.isOpened():
+            raise OSError(f"cannot open the video {path}")
+        self.path = path
+        self.fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        self.size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                     int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        capture.release()
+        self.capacity = capacity = capacity or CAPACITY
+        self._buffers = [numpy.empty((self.size[1], self.size[0], 3), numpy.uint8)
+                         for _ in range(capacity)]
+        self._free = None
+        self._full = None
+        self._decoder = None
+        self._canvas = None
+
+    def preload(self):
+        """ starts decoding the first frames """
+        if self._decoder is not None:
+            return
+        from expyriment import stimuli
+        if self._canvas is None:
+            self._canvas = stimuli.Canvas(self.size)
+        self._free, self._full = queue.Queue(), queue.Queue()
+        for buffer in self._buffers:
+            self._free.put(buffer)
+        self._decoder = FrameDecoder(self.path, self._free, self._full)
+        self._decoder.start()
+
+    def unload(self):
+        if self._decoder is not None:
+            self._decoder.stop()
+            self._decoder.join()
+            self._decoder = None
+
+    def next_frame(self, block=False):
+        """ returns the next decoded frame, None at the end of the clip, or
+        False if it is not decoded yet """
+        try:
+            return self._full.get(block)
+        except queue.Empty:
+            return False
+
+    def show(self, frame):
+        """ displays a frame and gives its buffer back to the decoder """
+        import pygame
+        self._canvas._set_surface(pygame.image.frombuffer(frame, self.size, 'BGR'))
+        returned = self._canvas.present()
+        self._free.put(frame)
+        return returned
+
+    def present(self):
+        self.preload()
+        return PLAYER.start(self)
+
+
+class Player:
+    """ Presents the frames of the current clip between the events """
+
+    def __init__(self):
+        self.clock = None
+        self.log = None
+        self.schedule = None
+        self.margin = 20
+        self.stats = []   # (event index, path, frames shown, dropped, late)
+        self._current = None
+        self._events = iter(())
+        self._again = set()      # video events whose clip is presented again later
+        self._finished = []      # (clip, presented again) to unload between the events
+
+    def setup(self, clock, log, schedule, margin=20):
+        """ prepares the presentation of the videos of `schedule` """
+        self.clock = clock
+        self.log = log
+        self.schedule = schedule
+        self.margin = margin
+        self.stats = []
+        self._current = None
+        videos = [i for i, kind in enumerate(schedule.kinds) if kind == 'video']
+        self._events = iter(videos)
+        self._again = {i for k, i in enumerate(videos)
+                       if any(schedule.ids[j] == schedule.ids[i] for j in videos[k + 1:])}
+
+    def start(self, video):
+        """ displays the first frame of a clip (at the onset of its event) """
+        if self._current is not None:
+            self.stop()
+        for k, (finished, again) in enumerate(self._finished):
+            if finished is video:   # presented again before its decoder could be restarted
+                del self._finished[k]
+                video.unload()
+                video.preload()
+                break
+        index = next(self._events, None)
+        onsets = self.schedule.onsets
+        frame = video.next_frame(block=True)
+        if frame is None:
+            return 0
+        start = self.clock.now()
+        returned = video.show(frame)
+        self._current = dict(video=video, index=index, t0=self.clock.now(),
+                             period=1000.0 / video.fps, k=1, shown=1, dropped=0, late=0,
+                             end=onsets[index + 1] - self.margin
+                             if index is not None and index + 1 < len(onsets) else None)
+        return returned if returned is not None else self.clock.now() - start
+
+    def service(self):
+        """ displays the frame which is due, if any """
+        c = self._current
+        if c is None:
+            if self._finished:
+                self._restart()
+            return
+        now = self.clock.now()
+        if c['end'] is not None and now + c['period'] > c['end']:
+            self.stop()
+            return
+        due = c['t0'] + c['k'] * c['period']
+        if now < due:
+            return
+        video = c['video']
+        frame = video.next_frame()
+        if frame is False:
+            return   # the decoder lags: the frame will be late
+        # drop the frames whose successor is already due
+        while frame is not None and now >= due + c['period']:
+            following = video.next_frame()
+            if following is False:
+                break
+            video._free.put(frame)
+            frame = following
+            c['k'] += 1
+            c['dropped'] += 1
+            due += c['period']
+        if frame is None:
+            self.stop()
+            return
+        video.show(frame)
+        if self.clock.now() - due > c['period'] / 2:
+            c['late'] += 1
+        c['k'] += 1
+        c['shown'] += 1
+
+    def stop(self):
+        """ ends the current clip and logs its frame counts """
+        c, self._current = self._current, None
+        if c is None:
+            return
+        video = c['video']
+        self._finished.append((video, c['index'] in self._again))
+        if c['index'] is not None:
+            if self.log is not None:
+                self.log.frames(c['index'], self.clock.now(), c['dropped'], c['late'])
+            self.stats.append((c['index'], video.path, c['shown'], c['dropped'], c['late']))
+
+    def _restart(self):
+        """ stops the decoder of a finished clip, and restarts it if the clip
+        is presented again, unless an onset is due within `margin` ms """
+        now = self.clock.now()
+        onsets = self.schedule.onsets
+        following = bisect.bisect_right(onsets, now)
+        if following < len(onsets) and now > onsets[following] - self.margin:
+            return
+        video, again = self._finished.pop(0)
+        video.unload()
+        if again:
+            video.preload()
+
+    def finish(self):
+        """ ends the current clip at the end of the run, and prepares the
+        finished ones for a later run """
+        self.stop()
+        for video, again in self._finished:
+            video.unload()
+            video.preload()
+        self._finished = []
+
+    def report(self):
+        for index, path, shown, dropped, late in self.stats:
+            print(f"video {path} (event {index}): {shown} frames shown, "
+                  f"{dropped} dropped, {late} late")
+
+
+PLAYER = Player()
@@ -0,0 +1,279 @@
+#! /usr/bin/env python3
+# LICENSE: CC-BY-NC-SA (https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.en)
+
+"""
+Bulk conversion of xpd files to columnar and BIDS event files, with an index.
+
+The rows of an xpd file mix stimulus events (condition, time, stype, id,
+target_time, timing_error), keypresses (keypressed, time, key) and, for the
+videos, frame counts. Each file is converted, by a pool of processes
+(--jobs), into:
+
+- `<output>/sub-<subject>/<name>_events.npz`: typed columns of the stimulus
+  events (event_*), of the keypresses (response_*) and of the videos
+  (video_*), loadable with numpy.load; with --parquet, the stimulus events
+  also go to `<name>_events.parquet` (needs pyarrow);
+- a BIDS events file, `<output>/sub-<subject>/ses-<date>/func/
+  sub-<subject>_ses-<date>_task-localizer_run-<run>_events.tsv`: the trials
+  (firstlevel.event_table) and the keypresses, with onsets and durations in
+  seconds.
+
+The sessions (subject, run, date, csv file, output files) and the onset
+errors of each condition are stored in the SQLite index
+`<output>/index.sqlite`. The files already indexed and unchanged since are
+skipped, so that the conversion of a growing study stays incremental:
+
+    python xpdconvert.py data/*.xpd --output derivatives/events
+
+The index answers the cross-session queries without reading the files, e.g.
+the onset errors per condition (or per stype, subject, run...) of a study:
+
+    python xpdconvert.py --output derivatives/events --query condition
+    python xpdconvert.py --output derivatives/events --query run --subject 3
+"""
+
+import os
+import os.path as op
+import sys
+import re
+import time
+import sqlite3
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import datalog
+import firstlevel
+
+
+INDEX_NAME = 'index.sqlite'
+TASK = 'localizer'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+    subject TEXT, run INTEGER, date TEXT, csv_file TEXT,
+    events INTEGER, responses INTEGER, npz TEXT, tsv TEXT);
+CREATE TABLE IF NOT EXISTS errors (
+    path TEXT, condition TEXT, stype TEXT,
+    n INTEGER, total REAL, squares REAL, max REAL,
+    PRIMARY KEY (path, condition, stype));
+CREATE INDEX IF NOT EXISTS sessions_subject ON sessions (subject, run, date);
+"""
+
+GROUPS = ('condition', 'stype', 'subject', 'run', 'date')
+
+
+def label(value):
+    """ BIDS label of a value (alphanumeric characters only) """
+    return re.sub(r'[^A-Za-z0-9]', '', str(value)) or 'unknown'
+
+
+def columns(rows):
+    """ typed numpy columns of the rows of an xpd file """
+    import numpy as np
+    events = [r for r in rows if r[0] not in ('keypressed', 'videoframes')]
+    responses = [r for r in rows if r[0] == 'keypressed']
+    videos = [r for r in rows if r[0] == 'videoframes']
+    return dict(
+        event_condition=np.array([r[0] for r in events], str),
+        event_time=np.array([r[1] for r in events], np.int32),
+        event_stype=np.array([r[2] for r in events], str),
+        event_id=np.array([r[3] for r in events], str),
+        event_target_time=np.array([r[4] for r in events], np.int32),
+        event_timing_error=np.array([r[5] for r in events], np.float32),
+        response_time=np.array([r[1] for r in responses], np.int32),
+        response_key=np.array([r[2] for r in responses], np.int32),
+        video_time=np.array([r[1] for r in videos], np.int32),
+        video_id=np.array([r[2] for r in videos], str),
+        video_dropped=np.array([r[3] for r in videos], np.int32),
+        video_late=np.array([r[4] for r in videos], np.int32))
+
+
+def error_stats(data):
+    """ (condition, stype, n, total, squares, max |error|) of the stimulus events """
+    import numpy as np
+    stats = []
+    keys = np.char.add(np.char.add(data['event_condition'], '\t'), data['event_stype'])
+    unique, inverse = np.unique(keys, return_inverse=True)
+    errors = data['event_timing_error'].astype(float)
+    n = np.bincount(inverse, minlength=len(unique))
+    total = np.bincount(inverse, errors, minlength=len(unique))
+    squares = np.bincount(inverse, errors ** 2, minlength=len(unique))
+    largest = np.zeros(len(unique))
+    np.maximum.at(largest, inverse, np.abs(errors))
+    for k, key in enumerate(unique):
+        condition, stype = str(key).split('\t')
+        stats.append((condition, stype, int(n[k]), float(total[k]), float(squares[k]), float(largest[k])))
+    return stats
+
+
+def write_events_tsv(filename, rows, duration):
+    """ writes the trials and keypresses of a run as a BIDS events file """
+    lines = [(onset / 1000, length / 1000, cond, 'n/a')
+             for onset, length, cond in firstlevel.event_table(rows, duration)]
+    lines += [(r[1] / 1000, 0, 'response', r[2]) for r in rows if r[0] == 'keypressed']
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write('onset\tduration\ttrial_type\tresponse_key\n')
+        for onset, length, trial_type, key in sorted(lines, key=lambda line: line[0]):
+            f.write(f"{onset:.3f}\t{length:.3f}\t{trial_type}\t{key}\n")
+
+
+_durations = dict()   # directory of the sounds -> firstlevel.sound_durations, in each worker
+
+
+def convert(path, output, parquet=False, stim_dir=None):
+    """ converts an xpd file; returns its session and error records for the index """
+    import numpy as np
+    info, rows = datalog.read_xpd(path)
+    stat = os.stat(path)
+    subject = info.get('subject') or 'unknown'
+    run = firstlevel.run_number(info.get('csv_file'))
+    date = info.get('date') or datetime.datetime.fromtimestamp(stat.st_mtime).isoformat()
+    name = op.splitext(op.basename(path))[0]
+
+    directory = op.join(output, f"sub-{label(subject)}")
+    os.makedirs(directory, exist_ok=True)
+    data = columns(rows)
+    npz = op.join(directory, f"{name}_events.npz")
+    np.savez(npz, **data)
+    if parquet:
+        import pyarrow
+        import pyarrow.parquet
+        table = pyarrow.Table.from_pydict({k[len('event_'):]: v for k, v in data.items()
+                                           if k.startswith('event_')})
+        pyarrow.parquet.write_table(table, op.join(directory, f"{name}_events.parquet"))
+
+    tsv = None
+    if run is not None:
+        session = label(date[:10])
+        func = op.join(directory, f"ses-{session}", 'func')
+        os.makedirs(func, exist_ok=True)
+        tsv = op.join(func, f"sub-{label(subject)}_ses-{session}_task-{TASK}_run-{run}_events.tsv")
+        bp = stim_dir or op.dirname(info.get('csv_file', ''))
+        if bp not in _durations:
+            _durations[bp] = firstlevel.sound_durations(bp)
+        write_events_tsv(tsv, rows, _durations[bp])
+
+    session = (op.abspath(path), stat.st_mtime, stat.st_size, str(subject), run, date,
+               info.get('csv_file'), len(data['event_time']), len(data['response_time']), npz, tsv)
+    return session, error_stats(data)
+
+
+def open_index(output):
+    os.makedirs(output, exist_ok=True)
+    db = sqlite3.connect(op.join(output, INDEX_NAME))
+    db.executescript(SCHEMA)
+    return db
+
+
+def outdated(db, paths, force=False):
+    """ the files which are not in the index, or have changed since """
+    if force:
+        return list(paths)
+    indexed = {path: (mtime, size) for path, mtime, size
+               in db.execute("SELECT path, mtime, size FROM sessions")}
+    changed = []
+    for path in paths:
+        stat = os.stat(path)
+        if indexed.get(op.abspath(path)) != (stat.st_mtime, stat.st_size):
+            changed.append(path)
+    return changed
+
+
+def store(db, session, errors):
+    db.execute("DELETE FROM errors WHERE path = ?", (session[0],))
+    db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", session)
+    db.executemany("INSERT INTO errors VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   [(session[0],) + e for e in errors])
+
+
+def query(db, group, subject=None, run=None):
+    """ onset errors grouped by `group` (one of GROUPS): (key, sessions, n,
+    mean, sd, max) rows """
+    column = f"e.{group}" if group in ('condition', 'stype') else f"s.{group}"
+    where, parameters = [], []
+    if subject is not None:
+        where.append("s.subject = ?")
+        parameters.append(str(subject))
+    if run is not None:
+        where.append("s.run = ?")
+        parameters.append(run)
+    sql = (f"SELECT {column}, COUNT(DISTINCT s.path), SUM(e.n), SUM(e.total), SUM(e.squares), MAX(e.max) "
+           "FROM errors e JOIN sessions s ON e.path = s.path "
+           + ("WHERE " + " AND ".join(where) + " " if where else "")
+           + f"GROUP BY {column} ORDER BY {column}")
+    results = []
+    for key, sessions, n, total, squares, largest in db.execute(sql, parameters):
+        mean = total / n
+        sd = max(0.0, squares / n - mean ** 2) ** 0.5
+        results.append((key, sessions, n, mean, sd, largest))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('xpd', nargs='*', help="xpd files to convert")
+    parser.add_argument('--output', default=op.join('derivatives', 'events'),
+                        help="directory of the converted files and of the index")
+    parser.add_argument('--parquet', action='store_true', help="also write Parquet files (needs pyarrow)")
+    parser.add_argument('--stim-dir', help="directory of the sounds (default: that of the logged run file)")
+    parser.add_argument('--force', action='store_true', help="convert the files already indexed")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help="worker processes (0: one per core)")
+    parser.add_argument('--query', choices=GROUPS, help="print the onset errors grouped by this column")
+    parser.add_argument('--subject', help="restrict the query to a subject")
+    parser.add_argument('--run', type=int, help="restrict the query to a run")
+    args = parser.parse_args(argv)
+    if args.jobs < 0:
+        parser.error("--jobs must be positive")
+    jobs = args.jobs or os.cpu_count()
+
+    db = open_index(args.output)
+    if args.xpd:
+        try:
+            import numpy
+        except ImportError:
+            print("xpdconvert.py needs NumPy: pip install numpy")
+            return 1
+        if args.parquet:
+            try:
+                import pyarrow
+            except ImportError:
+                print("--parquet needs pyarrow: pip install pyarrow")
+                return 1
+        paths = outdated(db, args.xpd, args.force)
+        start = time.perf_counter()
+        failed = []
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(convert, path, args.output, args.parquet, args.stim_dir): path
+                       for path in paths}
+            for future in as_completed(futures):
+                try:
+                    session, errors = future.result()
+                except Exception as e:
+                    failed.append(futures[future])
+                    print(f"{futures[future]}: {type(e).__name__}: {e}")
+                    continue
+                with db:   # one transaction per file: the files converted stay indexed
+                    store(db, session, errors)
+        elapsed = time.perf_counter() - start
+        print(f"{len(paths) - len(failed)} files converted in {elapsed:.1f} s, {len(failed)} failed, "
+              f"{len(args.xpd) - len(paths)} already indexed; index: {op.join(args.output, INDEX_NAME)}")
+        if failed:
+            db.close()
+            return 1
+
+    if args.query:
+        start = time.perf_counter()
+        results = query(db, args.query, args.subject, args.run)
+        print(f"{args.query:>16} sessions      n  mean err    sd err   max |err|   (ms)")
+        for key, sessions, n, mean, sd, largest in results:
+            print(f"{str(key):>16} {sessions:8d} {n:6d} {mean:9.2f} {sd:9.2f} {largest:11.2f}")
+        print(f"({1000 * (time.perf_counter() - start):.1f} ms)")
+    db.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())